@@ -1 +1,3 @@
+# import timing first, so that startup is timed from here
+from .timing import startup
 from .app import MarkmojiApp
\ No newline at end of file
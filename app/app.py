@@ -1,19 +1,23 @@
-import markdown
+import os
+import sys
 import markmoji
 import time
-import threading
-import traceback
 import PyQt5.QtCore as util
 import PyQt5.QtWidgets as qt
 import PyQt5.QtGui as gui
 
 from pathlib import Path
 
-from . import stc, viewer, toggle, menu
+from . import stc, toggle, menu, render, export, loader, storage, completion, workspace, watcher
+from .timing import timings, startup, TimingPanel
 
 
 class MarkmojiApp(qt.QApplication):
-    def __init__(self, show_splash=True, argv=[]):
+    def __init__(self, show_splash=True, recover=True, argv=[]):
+        startup.mark("imports")
+        # share OpenGL contexts, so that QtWebEngine can be imported once the app exists (it
+        # isn't needed until after the first window is shown)
+        util.QCoreApplication.setAttribute(util.Qt.AA_ShareOpenGLContexts)
         qt.QApplication.__init__(
             self, argv
         )
@@ -24,30 +28,83 @@ class MarkmojiApp(qt.QApplication):
                 gui.QPixmap('markmoji_editor/assets/Splash.png')
             )
             splash.show()
-            splash.start_time = time.time()
+            # make sure it's drawn before doing anything else
+            self.processEvents()
+        startup.mark("qt")
         
         # set theme
         from .theme import current
         self.theme = current
+        startup.mark("theme")
+        # setup background file I/O
+        self.io = storage.IOThread(self)
+        # setup interpreter (shared by all windows, converts in the background)
+        self.render_pool = render.RenderPool()
+        self.aboutToQuit.connect(self.render_pool.stop)
         # make main window
         self.win = MarkmojiFrame(self)
+        startup.mark("window")
 
-        # close splash (if shown)
-        if show_splash:    
-            while time.time() - splash.start_time < 2.5:
-                pass
-            splash.close()
+        # close splash (if shown) once the window is ready
+        if show_splash:
+            self.win.ready.connect(lambda: splash.finish(self.win))
+        # print startup report once the window is ready, if requested
+        if os.environ.get("MARKMOJI_STARTUP_REPORT"):
+            self.win.ready.connect(lambda: print(startup.to_text(), file=sys.stderr))
+        # offer to recover unsaved changes from last time (if requested)
+        if recover:
+            self.win.ready.connect(self.offer_recovery)
+
+    def offer_recovery(self):
+        """
+        Look for autosave journals left behind by windows which didn't close properly, and offer
+        to recover the changes in each.
+        """
+        for path, lock in storage.find_orphans():
+            try:
+                filename, base, content = storage.recover(path)
+            except (OSError, ValueError, KeyError):
+                content = None
+            # only ask if there's something to recover
+            if content is not None and content != base:
+                name = filename.name if filename is not None else "an untitled file"
+                btn = qt.QMessageBox.question(
+                    self.win, "Recover unsaved changes?",
+                    f"Markmoji didn't close properly while editing {name}. Recover the unsaved "
+                    f"changes?"
+                )
+                if btn == qt.QMessageBox.Yes:
+                    # use the first window if it's still empty, otherwise make a new one
+                    if self.win.filename is None and not self.win.md_ctrl.toPlainText():
+                        frame = self.win
+                    else:
+                        frame = MarkmojiFrame(self)
+                    frame.recover(filename, base, content)
+            # done with this journal
+            path.unlink(missing_ok=True)
+            lock.unlock()
 
 class MarkmojiFrame(qt.QMainWindow):
+    # emitted once the window is fully set up (including the rendered HTML view)
+    ready = util.pyqtSignal()
+
     def __init__(self, app, filename=None):
         # create
         qt.QWidget.__init__(self)
         self.app = app
+        self._filename = None
+        self.loader = None
+        # folder of files to search, and line to go to once the file being opened is loaded
+        self.workspace = None
+        self.find_dlg = None
+        self._goto_line = None
 
-        # setup interpreter
-        self.md = markdown.Markdown(
-            extensions=["extra", markmoji.Markmoji()]
-        )
+        # request renders from the app's render pool
+        self.renderer = render.RenderScheduler(self, pool=self.app.render_pool)
+        self.renderer.rendered.connect(self.on_rendered)
+        self.renderer.partial.connect(self.on_partial)
+        self._render_start = None
+        self._paint_start = None
 
         # setup window
         self.setWindowIcon(gui.QIcon('markmoji_editor/assets/Emblem@16w.png'))
@@ -74,9 +131,8 @@ class MarkmojiFrame(qt.QMainWindow):
         # raw html ctrl
         self.html_ctrl = HTMLReader(frame=self)
         self.ctrls.addWidget(self.html_ctrl)
-        # rendered HTML ctrl
-        self.html_view = viewer.HTMLViewer(frame=self)
-        self.ctrls.addWidget(self.html_view)
+        # rendered HTML ctrl (made once the window is shown, see setup_viewer)
+        self.html_view = None
 
         # bind rendering to text edit
         self.md_ctrl.textChanged.connect(self.on_text)
@@ -85,20 +141,32 @@ class MarkmojiFrame(qt.QMainWindow):
         self.view_ctrl = toggle.ViewToggle(self)
         self.view_ctrl.add_button(ctrl=self.md_ctrl, tooltip="Toggle raw markdown view", icon_name="view_md")
         self.view_ctrl.add_button(ctrl=self.html_ctrl, tooltip="Toggle raw HTML view", icon_name="view_html")
-        self.view_ctrl.add_button(ctrl=self.html_view, tooltip="Toggle rendered HTML view", icon_name="view_preview")
-        self.view_ctrl.set_values((True, False, True))
+        self.view_ctrl.set_values((True, False))
         self.sizer.addWidget(self.view_ctrl, alignment=util.Qt.AlignHCenter)
 
+        # add render timings panel (hidden until toggled from the debug menu)
+        self.timing_panel = TimingPanel(self, timings, cache=self.app.render_pool.cache)
+        self.statusBar().addWidget(self.timing_panel)
+        self.statusBar().hide()
+
         # setup shortcuts
         self.shortcuts = {
             qt.QShortcut(gui.QKeySequence('Ctrl+N'), self): self.new,
             qt.QShortcut(gui.QKeySequence('Ctrl+S'), self): self.save,
             qt.QShortcut(gui.QKeySequence('Ctrl+Alt+S'), self): self.save_as,
             qt.QShortcut(gui.QKeySequence('Ctrl+O'), self): self.open,
+            qt.QShortcut(gui.QKeySequence('Ctrl+Shift+F'), self): self.find_in_files,
         }
         for sc, fcn in self.shortcuts.items():
             sc.activated.connect(fcn)
 
+        # autosave changes to a journal, to recover them if the app doesn't close properly
+        self.journal = storage.Journal(self.md_ctrl, self.app.io)
+        self.journal.start(None, "")
+        # reload the file if it's changed by another program
+        self.watcher = watcher.FileWatcher(self)
+        self.watcher.changed.connect(self.on_file_changed)
+
         # load file
         if filename is not None:
             self.open(filename=filename)
@@ -106,6 +174,26 @@ class MarkmojiFrame(qt.QMainWindow):
         # show
         self.apply_theme()
         self.show()
+        # setup rendered HTML view once the window has been drawn
+        util.QTimer.singleShot(0, self.setup_viewer)
+
+    def setup_viewer(self):
+        """
+        Make the rendered HTML view. This is done after the window is first shown, as
+        QtWebEngine is slow to import and start.
+        """
+        from . import viewer
+        startup.mark("import webengine")
+        # make view
+        self.html_view = viewer.HTMLViewer(frame=self)
+        self.ctrls.addWidget(self.html_view)
+        # add toggle
+        self.view_ctrl.add_button(ctrl=self.html_view, tooltip="Toggle rendered HTML view", icon_name="view_preview")
+        self.view_ctrl.set_values((True, False, True))
+        startup.mark("viewer")
+        # render current content into it
+        self.render_html()
+        self.ready.emit()
     
     @property
     def filename(self):
@@ -125,7 +213,9 @@ class MarkmojiFrame(qt.QMainWindow):
         self.app.setStyle("Fusion")
         self.md_ctrl.style_text()
         self.html_ctrl.style_text()
-        self.html_view.refresh_content()
+        # swap stylesheet in the live page
+        if self.html_view is not None:
+            self.html_view.set_style()
     
     def on_text(self, evt=None):
         """
@@ -135,32 +225,77 @@ class MarkmojiFrame(qt.QMainWindow):
         evt (qt.QSignal, optional)
         :    Event generated by the `textChanged` event. Defaults to None.
         """
-        # style markdown
-        self.md_ctrl.style_text()
         # render HTML
-        threading.Thread(target=self.render_html).run()
+        self.render_html()
     
     def render_html(self):
         """
-        Render markdown content into HTML
+        Request that markdown content be rendered into HTML (on a background thread)
         """
+        # start timing
+        self._render_start = self._paint_start = time.perf_counter()
         # get markdown
         content_md = self.md_ctrl.toPlainText()
-        # parse to HTML
-        try:
-            content_html = self.md.convert(content_md)
-        except Exception as err:
-            tb = "\n".join(traceback.format_exception(err))
-            content_html = (
-                f"<h1>Error</h1>\n"
-                f"<p>Could not parse Markdown. Error from Python:</p>\n"
-                f"<pre><code>{tb}</code></pre>\n"
-                )
+        # request render (around the cursor first, if rendering takes a while)
+        self.renderer.request(content_md, focus=self.md_ctrl.textCursor().blockNumber())
+
+    def on_partial(self, generation, fragments):
+        """
+        Handle when the renderer has converted part of a long document, by showing it in the
+        HTML viewer (the HTML ctrl waits for the full result).
+
+        #### Args
+        generation (int)
+        :    Generation number of the text being rendered
+        fragments (list[str])
+        :    Rendered HTML fragments so far, with placeholders for the rest
+        """
+        # ignore results for text which has since changed
+        if not self.renderer.is_current(generation):
+            return
+        # store time from request to first content shown
+        if self._paint_start is not None:
+            timings.record("first_paint", self._paint_start)
+            self._paint_start = None
+        # apply to HTML viewer
+        if self.html_view is not None:
+            self.html_view.set_body("\n".join(fragments), fragments=fragments)
+    
+    def on_rendered(self, generation, content_html, fragments):
+        """
+        Handle when the renderer has finished converting some markdown.
+
+        #### Args
+        generation (int)
+        :    Generation number of the text which was rendered
+        content_html (str)
+        :    Rendered HTML
+        fragments (list[str])
+        :    Rendered HTML split into top-level fragments (which join to make `content_html`)
+        """
+        # ignore results for text which has since changed
+        if not self.renderer.is_current(generation):
+            return
+        # store time from request to result
+        if self._render_start is not None:
+            timings.record("render", self._render_start)
+            self._render_start = None
+        if self._paint_start is not None:
+            timings.record("first_paint", self._paint_start)
+            self._paint_start = None
         # apply to HTML ctrl
-        self.html_ctrl.setPlainText(content_html)
-        self.html_ctrl.style_text()
+        self.html_ctrl.set_body(content_html)
         # apply to HTML viewer
-        self.html_view.set_body(content_html)
+        if self.html_view is not None:
+            self.html_view.set_body(content_html, fragments=fragments)
+    
+    def closeEvent(self, event):
+        # stop background rendering
+        self.renderer.stop()
+        # remove journal, and make sure any saves still underway finish
+        self.journal.close()
+        self.app.io.wait()
+        return qt.QMainWindow.closeEvent(self, event)
     
     def new(self):
         # create a new frame
@@ -173,12 +308,159 @@ class MarkmojiFrame(qt.QMainWindow):
             # cancel if cancelled
             if not filename:
                 return
+        # stop loading the last file, if it's still loading
+        if self.loader is not None:
+            self.loader.finished.disconnect(self.on_loaded)
+            self.loader.cancelled.disconnect(self.on_load_cancelled)
+            self.loader.failed.disconnect(self.on_load_failed)
+            self.loader.cancel()
+            self.loader.deleteLater()
+            self.loader = None
         # store filename
         self.filename = Path(filename)
-        # read file
-        content_md = self.filename.read_text(encoding="utf-8")
-        # set text
-        self.md_ctrl.setText(content_md)
+        # stop watching the last file
+        self.watcher.watch(None, None)
+        # load file a chunk at a time, so large files don't lock up the window
+        self.loader = loader.ProgressiveLoader(self.md_ctrl, self.filename)
+        # show progress (only if loading takes a while)
+        size = max(self.loader.size, 1)
+        dlg = qt.QProgressDialog(f"Opening {self.filename.name}...", "Cancel", 0, 1000, self)
+        dlg.setWindowModality(util.Qt.WindowModal)
+        dlg.setMinimumDuration(500)
+        self.loader.progress.connect(lambda done: dlg.setValue(min(done * 1000 // size, 999)))
+        dlg.canceled.connect(self.loader.cancel)
+        for signal in (self.loader.finished, self.loader.cancelled, self.loader.failed):
+            signal.connect(dlg.deleteLater)
+        # render once the whole file is in
+        self.loader.finished.connect(self.on_loaded)
+        self.loader.cancelled.connect(self.on_load_cancelled)
+        self.loader.failed.connect(self.on_load_failed)
+        self.loader.start()
+
+    def on_loaded(self):
+        # journal changes from the file's content, and watch for it changing
+        content_md = self.md_ctrl.toPlainText()
+        self.journal.start(self.filename, content_md)
+        self.watcher.watch(self.filename, content_md)
+        # go to line, if requested
+        if self._goto_line is not None:
+            self.goto_line(self._goto_line)
+            self._goto_line = None
+        # render HTML
+        self.render_html()
+
+    def on_load_cancelled(self):
+        self.filename = None
+        self._goto_line = None
+        self.journal.start(None, "")
+
+    def on_load_failed(self, msg):
+        qt.QMessageBox.warning(self, "Open failed", f"Could not open {self.filename}:\n\n{msg}")
+        self.filename = None
+        self._goto_line = None
+        self.journal.start(None, "")
+
+    def open_folder(self, folder=None):
+        """
+        Open a folder as this window's workspace, indexing its Markdown files so they can be
+        searched with "Find in files".
+
+        #### Args
+        folder (pathlib.Path, optional)
+        :    Folder to open, if None then the user is asked to choose one
+        """
+        if folder is None:
+            # open folder dlg
+            folder = qt.QFileDialog.getExistingDirectory(self, "Open folder...", "C://")
+            # cancel if cancelled
+            if not folder:
+                return
+        # index folder (picking up where the saved index left off)
+        self.workspace = workspace.WorkspaceIndex(folder, self)
+        self.workspace.refresh()
+        # replace any search dialog for the last workspace
+        if self.find_dlg is not None:
+            self.find_dlg.deleteLater()
+            self.find_dlg = None
+        self.find_in_files()
+
+    def find_in_files(self):
+        """
+        Show a dialog to search every file in the workspace.
+        """
+        # choose a workspace if there isn't one
+        if self.workspace is None:
+            self.open_folder()
+            return
+        # make dialog
+        if self.find_dlg is None:
+            self.find_dlg = workspace.FindInFiles(self, self.workspace)
+        else:
+            # pick up any changes since the dialog was last shown
+            self.workspace.refresh()
+        self.find_dlg.show()
+        self.find_dlg.raise_()
+        self.find_dlg.activateWindow()
+        self.find_dlg.query_ctrl.selectAll()
+        self.find_dlg.query_ctrl.setFocus()
+
+    def goto(self, filename, line=0):
+        """
+        Show a line of a file, opening the file if it isn't already open.
+
+        #### Args
+        filename (pathlib.Path)
+        :    File to show
+        line (int)
+        :    Line number (from 0) to move the cursor to
+        """
+        filename = Path(filename)
+        if self.filename is not None and self.filename.resolve() == filename.resolve():
+            # go straight to the line if the file's open (and not still loading)
+            if self.loader is None or not self.loader.loading:
+                self.goto_line(line)
+            else:
+                self._goto_line = line
+            return
+        # the file may have gone since it was indexed
+        if not filename.is_file():
+            qt.QMessageBox.warning(self, "Open failed", f"Could not open {filename}:\n\nFile not found")
+            return
+        # open file, going to the line once it's loaded
+        self._goto_line = line
+        self.open(filename)
+
+    def goto_line(self, line):
+        """
+        Move the cursor to the start of a line in the markdown ctrl, scrolled into view.
+        """
+        block = self.md_ctrl.document().findBlockByNumber(line)
+        if not block.isValid():
+            return
+        cursor = self.md_ctrl.textCursor()
+        cursor.setPosition(block.position())
+        self.md_ctrl.setTextCursor(cursor)
+        self.md_ctrl.ensureCursorVisible()
+        self.md_ctrl.setFocus()
+
+    def recover(self, filename, base, content):
+        """
+        Show content recovered from an autosave journal, as unsaved changes to the file it came
+        from.
+
+        #### Args
+        filename (pathlib.Path, optional)
+        :    File which was being edited, or None if it was untitled
+        base (str)
+        :    Content of the file (as of the last save)
+        content (str)
+        :    Recovered content
+        """
+        self.filename = filename
+        # journal from the file's content, so the recovered changes are journaled again
+        self.journal.start(filename, base)
+        self.watcher.watch(filename, base)
+        self.md_ctrl.setPlainText(content)
     
     def save(self):
         # call save as on current file
@@ -195,8 +477,45 @@ class MarkmojiFrame(qt.QMainWindow):
         self.filename = Path(filename)
         # get markdown content
         content_md = self.md_ctrl.toPlainText()
-        # save markdown content
-        self.filename.write_text(content_md, encoding="utf-8")
+        # save markdown content in the background (the watcher then ignores the file changing)
+        self.watcher.watch(self.filename, content_md)
+        self.journal.save(self.filename, content_md, callback=self.on_saved)
+
+    def on_file_changed(self, old, new):
+        """
+        Handle when the open file is changed by another program, by applying just the lines
+        which changed (so only they are highlighted and rendered again).
+
+        #### Args
+        old (str)
+        :    Content of the file as last loaded or saved
+        new (str)
+        :    New content of the file
+        """
+        content_md = self.md_ctrl.toPlainText()
+        if content_md == watcher.plain_text(new):
+            return
+        # check before losing unsaved changes
+        if content_md != watcher.plain_text(old):
+            btn = qt.QMessageBox.question(
+                self, "File changed",
+                f"{self.filename.name} has been changed by another program. Reload it and lose "
+                f"your unsaved changes?"
+            )
+            if btn != qt.QMessageBox.Yes:
+                return
+        # apply changes
+        with timings.span("reload"):
+            watcher.reload_text(self.md_ctrl, new)
+        # journal changes from the new content
+        self.journal.start(self.filename, new)
+
+    def on_saved(self, error):
+        if error is not None:
+            qt.QMessageBox.warning(self, "Save failed", f"Could not save {self.filename}:\n\n{error}")
+        # reindex the saved file, if it's in the workspace
+        elif self.workspace is not None:
+            self.workspace.refresh()
     
     def export_raw_html(self, filename=None):
         if filename is None:
@@ -208,11 +527,11 @@ class MarkmojiFrame(qt.QMainWindow):
         # pathify filename
         filename = Path(filename)
         # get HTML
-        content_html = self.html_ctrl.toPlainText()
+        content_html = self.html_ctrl.body
         # export html content
         filename.write_text(content_html, encoding="utf-8")
 
-    def export_styled_html(self, filename=None):
+    def export_styled_html(self, filename=None, inline_images=True):
         if filename is None:
             # open file dlg
             filename, _ = qt.QFileDialog.getSaveFileName(self, "Export as...", "C://", "HTML files (*.html)")
@@ -221,19 +540,111 @@ class MarkmojiFrame(qt.QMainWindow):
                 return
         # pathify filename
         filename = Path(filename)
-        # todo: get HTML
-        content_html = self.html_ctrl.toPlainText()
-        # export html content
-        filename.write_text(content_html, encoding="utf-8")
+        # get relative image paths relative to the current file (if there is one)
+        base = self.filename.parent if self.filename is not None else None
+        title = self.filename.stem if self.filename is not None else filename.stem
+        # write file in the background
+        exporter = export.StyledExporter(
+            self, filename, self.html_ctrl.body,
+            css=self.app.theme.viewer.spec, title=title, base=base, inline_images=inline_images
+        )
+        exporter.failed.connect(self.on_export_failed)
+        exporter.start()
+
+        return exporter
+
+    def on_export_failed(self, filename, msg):
+        qt.QMessageBox.warning(self, "Export failed", f"Could not export to {filename}:\n\n{msg}")
+
+    def toggle_timings(self):
+        # show/hide status bar with render timings
+        self.statusBar().setVisible(not self.statusBar().isVisible())
+
+    def show_startup_report(self):
+        # show how long each phase of startup took
+        dlg = qt.QMessageBox(self)
+        dlg.setWindowTitle("Startup report")
+        dlg.setText(f"<pre>{startup.to_text()}</pre>")
+        dlg.exec_()
+
+    def export_timings(self, filename=None):
+        if filename is None:
+            # open file dlg
+            filename, _ = qt.QFileDialog.getSaveFileName(self, "Export timings...", "C://", "JSON files (*.json)")
+            # cancel if cancelled
+            if not filename:
+                return
+        # pathify filename
+        filename = Path(filename)
+        # export timings
+        extra = {'render_cache': self.app.render_pool.cache.stats()}
+        # the viewer (and its asset cache) may not be set up yet
+        if self.html_view is not None:
+            from . import viewer
+            extra['asset_cache'] = viewer.asset_handler().cache.stats()
+        filename.write_text(timings.to_json(extra=extra), encoding="utf-8")
 
 
 class MarkmojiEditor(stc.StyledTextCtrl):
     def __init__(self, frame):
         stc.StyledTextCtrl.__init__(self, frame, language="markdown")
+        # offer handlers as you type
+        self.completer = completion.HandlerCompleter(self)
+
+    def keyPressEvent(self, event):
+        # let the completion popup handle keys for choosing from it
+        if self.completer.popup().isVisible() and event.key() in (
+            util.Qt.Key_Enter, util.Qt.Key_Return, util.Qt.Key_Escape, util.Qt.Key_Tab, util.Qt.Key_Backtab
+        ):
+            event.ignore()
+            return
+        stc.StyledTextCtrl.keyPressEvent(self, event)
+        # update completions if text was typed or deleted
+        if event.text() or event.key() in (util.Qt.Key_Backspace, util.Qt.Key_Delete):
+            self.completer.update()
+        else:
+            self.completer.popup().hide()
         
         
 class HTMLReader(stc.StyledTextCtrl):
     def __init__(self, frame):
         stc.StyledTextCtrl.__init__(self, frame, language="html")
         self.setReadOnly(True)
+        # current HTML, and whether the ctrl needs updating once it's shown
+        self.body = ""
+        self._dirty = False
+
+    def set_body(self, content):
+        """
+        Set the HTML shown in this ctrl. If the ctrl isn't shown, it's only updated once it is.
+
+        #### Args
+        content (str)
+        :    HTML content to show
+        """
+        # store value
+        self.body = content
+        # stop here if ctrl isn't shown
+        if not self.isVisible():
+            self._dirty = True
+            return
+        # set text
+        with timings.span("highlight_html"):
+            self.setPlainText(content)
+
+    def style_text(self):
+        # stop here if ctrl isn't shown
+        if not self.isVisible():
+            self._dirty = True
+            return
+        stc.StyledTextCtrl.style_text(self)
+
+    def showEvent(self, event):
+        # bring content and style up to date
+        if self._dirty:
+            self._dirty = False
+            with timings.span("highlight_html"):
+                self.setPlainText(self.body)
+            self.style_text()
+        return stc.StyledTextCtrl.showEvent(self, event)
     
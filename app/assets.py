@@ -0,0 +1,263 @@
+import os
+import mimetypes
+import threading
+import PyQt5.QtCore as util
+import PyQt5.QtGui as gui
+import PyQt5.QtWebEngineCore as engine
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .timing import timings
+
+
+# scheme local assets are served from, e.g. markmoji-asset://local/home/me/docs/image.png
+scheme = b"markmoji-asset"
+host = "local"
+
+# image formats which can be downscaled (animated or vector formats are served as they are)
+_scalable = {"image/png": "PNG", "image/jpeg": "JPEG", "image/bmp": "BMP", "image/webp": "WEBP"}
+
+
+def register_scheme():
+    """
+    Register the asset scheme with the web engine. This must be done before any profile or page
+    is made.
+    """
+    if engine.QWebEngineUrlScheme.schemeByName(scheme).name():
+        return
+    url_scheme = engine.QWebEngineUrlScheme(scheme)
+    url_scheme.setSyntax(engine.QWebEngineUrlScheme.Syntax.Host)
+    # pages served from the scheme can still load local files (e.g. bundled fonts)
+    url_scheme.setFlags(
+        engine.QWebEngineUrlScheme.LocalScheme | engine.QWebEngineUrlScheme.LocalAccessAllowed
+    )
+    engine.QWebEngineUrlScheme.registerScheme(url_scheme)
+
+
+def asset_url(path):
+    """
+    Get the URL a local file is served from by the asset scheme.
+
+    #### Args
+    path (pathlib.Path)
+    :    Local file
+
+    #### Returns
+    util.QUrl
+    :    URL of the file in the asset scheme
+    """
+    url = util.QUrl.fromLocalFile(str(path))
+    url.setScheme(scheme.decode())
+    url.setHost(host)
+
+    return url
+
+
+def local_path(url):
+    """
+    Get the local file an asset URL points to.
+    """
+    url = util.QUrl(url)
+    url.setScheme("file")
+    url.setHost("")
+
+    return url.toLocalFile()
+
+
+def load_asset(path, max_size=None):
+    """
+    Read a local file to serve, downscaling it if it's an image larger than needed.
+
+    #### Args
+    path (str)
+    :    File to read
+    max_size (util.QSize, optional)
+    :    Largest size images can be shown at, larger images are scaled down to fit (keeping
+         their aspect ratio). If None, images are served as they are.
+
+    #### Returns
+    bytes
+    :    Content to serve
+    str
+    :    MIME type of the content
+    """
+    mime = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    fmt = _scalable.get(mime)
+    if max_size is not None and fmt is not None:
+        reader = gui.QImageReader(path)
+        size = reader.size()
+        if size.isValid() and (size.width() > max_size.width() or size.height() > max_size.height()):
+            # decode straight to the smaller size (much quicker for JPEGs)
+            reader.setScaledSize(size.scaled(max_size, util.Qt.KeepAspectRatio))
+            image = reader.read()
+            if not image.isNull():
+                data = util.QByteArray()
+                buffer = util.QBuffer(data)
+                buffer.open(util.QIODevice.WriteOnly)
+                image.save(buffer, fmt)
+                buffer.close()
+                return bytes(data), mime
+    with open(path, "rb") as f:
+        return f.read(), mime
+
+
+class AssetCache:
+    """
+    Content of local files served to the viewer, so images aren't read and decoded again
+    every time a page is loaded. Entries are checked against the file's modification time and
+    size, and the cache is bounded by the bytes it holds, dropping the least recently used
+    files first.
+
+    #### Args
+    max_bytes (int)
+    :    Maximum number of bytes of content to keep
+
+    #### Attributes
+    size (int)
+    :    Number of bytes of content currently cached
+    hits (int)
+    :    Number of lookups which found an up to date entry
+    misses (int)
+    :    Number of lookups which didn't
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # (modification time, file size, content, MIME type) for each file, by path, least
+        # recently used first
+        self.entries = OrderedDict()
+        # files are loaded into the cache on background threads
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def stamp(path):
+        """
+        Get the (modification time, size) of a file, or None if it doesn't exist.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        return stat.st_mtime_ns, stat.st_size
+
+    def get(self, path, stamp):
+        """
+        Get the cached (content, MIME type) of a file, or None if it isn't cached or has changed
+        since.
+        """
+        with self._lock:
+            entry = self.entries.get(path)
+            if entry is None or entry[:2] != stamp:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(path)
+            return entry[2], entry[3]
+
+    def put(self, path, stamp, data, mime):
+        """
+        Cache the content of a file, dropping the least recently used files if needed.
+        """
+        # don't cache files which would push everything else out
+        if len(data) > self.max_bytes // 4:
+            return
+        with self._lock:
+            if path in self.entries:
+                self.size -= len(self.entries.pop(path)[2])
+            self.entries[path] = (stamp[0], stamp[1], data, mime)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, dropped = self.entries.popitem(last=False)
+                self.size -= len(dropped[2])
+
+    def clear(self):
+        """
+        Drop all cached files (counters are kept).
+        """
+        with self._lock:
+            self.entries = OrderedDict()
+            self.size = 0
+
+    def stats(self):
+        """
+        Get the number of hits, misses and files cached, and the bytes they take up.
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'files': len(self.entries),
+                'bytes': self.size,
+            }
+
+
+class AssetSchemeHandler(engine.QWebEngineUrlSchemeHandler):
+    """
+    Serves local files to pages from the asset scheme, from an `AssetCache` where possible.
+    Files which aren't cached are read (and downscaled, if requested) on background threads.
+
+    #### Args
+    parent (util.QObject)
+    :    Object which owns this handler (e.g. the profile it's installed in)
+    cache (AssetCache, optional)
+    :    Cache to serve files from, if None then one is made
+    max_size (util.QSize, optional)
+    :    Largest size images can be shown at (see `load_asset`), if None then images are served
+         as they are
+    workers (int)
+    :    Number of threads to read files on
+    """
+    loaded = util.pyqtSignal(object, object, object)
+
+    def __init__(self, parent=None, cache=None, max_size=None, workers=2):
+        engine.QWebEngineUrlSchemeHandler.__init__(self, parent)
+        self.cache = cache if cache is not None else AssetCache()
+        self.max_size = max_size
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        # replies are made on this object's thread
+        self.loaded.connect(self.on_loaded)
+
+    def requestStarted(self, job):
+        path = local_path(job.requestUrl())
+        stamp = self.cache.stamp(path)
+        if stamp is None:
+            job.fail(engine.QWebEngineUrlRequestJob.UrlNotFound)
+            return
+        # serve from the cache if possible
+        cached = self.cache.get(path, stamp)
+        if cached is not None:
+            self.reply(job, *cached)
+            return
+        self._pool.submit(self._load, job, path, stamp)
+
+    def _load(self, job, path, stamp):
+        try:
+            with timings.span("asset"):
+                data, mime = load_asset(path, self.max_size)
+        except OSError:
+            self.loaded.emit(job, None, None)
+            return
+        self.cache.put(path, stamp, data, mime)
+        self.loaded.emit(job, data, mime)
+
+    def on_loaded(self, job, data, mime):
+        # the request may have been cancelled (and the job deleted) meanwhile
+        try:
+            if data is None:
+                job.fail(engine.QWebEngineUrlRequestJob.RequestFailed)
+            else:
+                self.reply(job, data, mime)
+        except RuntimeError:
+            pass
+
+    @staticmethod
+    def reply(job, data, mime):
+        # the buffer is deleted along with the job
+        buffer = util.QBuffer(job)
+        buffer.setData(data)
+        buffer.open(util.QIODevice.ReadOnly)
+        job.reply(mime.encode(), buffer)
@@ -0,0 +1,181 @@
+import re
+import markmoji
+import PyQt5.QtCore as util
+import PyQt5.QtWidgets as qt
+
+
+# emojis of handler base classes, which aren't offered
+_base_emojis = ("?", "〽️", "❓")
+
+# regex to find the start of each word in a CamelCase name
+_word_re = re.compile(r"[A-Z][a-z0-9]*|[a-z0-9]+")
+
+
+class PrefixTrie:
+    """
+    Trie mapping string keys to values, for finding every value whose key starts with a given
+    prefix. Lookups take time proportional to the length of the prefix plus the number of
+    results, however many keys there are.
+
+    #### Args
+    limit (int)
+    :    Maximum number of values to keep at each node for lookups (the first added are kept)
+    """
+    def __init__(self, limit=50):
+        self.limit = limit
+        # each node is a dict of child nodes by character, with the values for every key under
+        # it stored under None
+        self.root = {None: []}
+
+    def insert(self, key, value):
+        """
+        Add a value under the given key.
+        """
+        node = self.root
+        self._add(node, value)
+        for char in key:
+            node = node.setdefault(char, {None: []})
+            self._add(node, value)
+
+    def _add(self, node, value):
+        values = node[None]
+        if len(values) < self.limit and value not in values:
+            values.append(value)
+
+    def search(self, prefix):
+        """
+        Get values whose keys start with the given prefix (up to the limit), in the order they
+        were added.
+        """
+        node = self.root
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return []
+
+        return list(node[None])
+
+
+class HandlerIndex:
+    """
+    Index of Markmoji handlers by emoji and by name, built once from `markmoji.handlers.map`.
+    Names are indexed (lowercase, prefixed with ":") from the start of each word, so
+    `:post` finds `FacebookPostHandler` as well as `:face`.
+
+    #### Attributes
+    size (int)
+    :    Number of entries in `markmoji.handlers.map` when the index was built
+    handlers (list[tuple])
+    :    (emoji, handler class) for each handler, in the order they're registered
+    trie (PrefixTrie)
+    :    Index of (emoji, handler class) pairs
+    """
+    def __init__(self):
+        self.size = len(markmoji.handlers.map)
+        self.handlers = [
+            (emoji, cls) for emoji, cls in markmoji.handlers.map.items()
+            if emoji not in _base_emojis
+        ]
+        self.trie = PrefixTrie()
+        for emoji, cls in self.handlers:
+            self.trie.insert(emoji, (emoji, cls))
+            words = _word_re.findall(cls.__name__)
+            for i in range(len(words)):
+                self.trie.insert(":" + "".join(words[i:]).lower(), (emoji, cls))
+
+    def complete(self, prefix):
+        """
+        Get handlers matching a prefix, either ":" followed by the start of a name or the start
+        of an emoji.
+
+        #### Returns
+        list[tuple]
+        :    (emoji, handler class) for each handler which matches
+        """
+        return self.trie.search(prefix.lower() if prefix.startswith(":") else prefix)
+
+
+_index = None
+
+
+def handler_index():
+    """
+    Get the handler index, building it if needed (or if more handlers have been registered
+    since it was built).
+    """
+    global _index
+    if _index is None or _index.size != len(markmoji.handlers.map):
+        _index = HandlerIndex()
+
+    return _index
+
+
+class HandlerCompleter(qt.QCompleter):
+    """
+    Popup offering handlers to complete a ":name" or partial emoji typed before the cursor in a
+    text control, which replaces it with the handler's emoji and an empty link once chosen.
+
+    #### Args
+    ctrl (qt.QTextEdit)
+    :    Control to complete in
+    """
+    # regex to find a ":name" (not straight after other text, e.g. "https:") or a run of
+    # non-ASCII symbols (a partial emoji) before the cursor
+    prefix_re = re.compile(r"(?:(?<!\S):\w*|[^\x00-\x7f\w]{1,4})$")
+
+    def __init__(self, ctrl):
+        qt.QCompleter.__init__(self, ctrl)
+        self.ctrl = ctrl
+        self.setWidget(ctrl)
+        self.setModel(util.QStringListModel(self))
+        # results are already filtered by the index
+        self.setCompletionMode(qt.QCompleter.UnfilteredPopupCompletion)
+        self.setCaseSensitivity(util.Qt.CaseInsensitive)
+        self.activated[str].connect(self.insert)
+        # prefix being completed
+        self.prefix = ""
+
+    def get_prefix(self):
+        """
+        Get the ":name" or partial emoji before the cursor, or "" if there isn't one.
+        """
+        cursor = self.ctrl.textCursor()
+        # get text before the cursor (positions count UTF-16 code units)
+        text = cursor.block().text().encode("utf-16-le")[:cursor.positionInBlock() * 2]
+        match = self.prefix_re.search(text.decode("utf-16-le", "ignore")[-32:])
+
+        return match.group(0) if match else ""
+
+    def update(self):
+        """
+        Show (or hide) the popup for whatever's before the cursor.
+        """
+        prefix = self.get_prefix()
+        matches = handler_index().complete(prefix) if prefix else []
+        # nothing to offer if the prefix is already a whole emoji
+        if not matches or (len(matches) == 1 and matches[0][0] == prefix):
+            self.popup().hide()
+            return
+        self.prefix = prefix
+        self.model().setStringList([f"{emoji} {cls.__name__}" for emoji, cls in matches])
+        # show under the cursor
+        rect = self.ctrl.cursorRect()
+        rect.setWidth(
+            self.popup().sizeHintForColumn(0) + self.popup().verticalScrollBar().sizeHint().width()
+        )
+        self.complete(rect)
+        self.popup().setCurrentIndex(self.completionModel().index(0, 0))
+
+    def insert(self, text):
+        """
+        Replace the prefix being completed with the chosen handler.
+        """
+        emoji = text.split(" ")[0]
+        cursor = self.ctrl.textCursor()
+        # select prefix (positions count UTF-16 code units)
+        cursor.setPosition(
+            cursor.position() - len(self.prefix.encode("utf-16-le")) // 2, cursor.KeepAnchor
+        )
+        cursor.insertText(emoji + "[]()")
+        self.ctrl.setTextCursor(cursor)
+        self.popup().hide()
@@ -0,0 +1,307 @@
+import io
+import os
+import re
+import base64
+import string
+import logging
+import mimetypes
+import threading
+import PyQt5.QtCore as util
+
+from html import escape, unescape
+from pathlib import Path
+from urllib.parse import urlsplit, unquote
+from urllib.request import url2pathname
+
+from .timing import timings
+
+# fontTools is a requirement, but if it's missing fonts are inlined whole rather than subset
+try:
+    from fontTools import subset
+except ImportError:
+    subset = None
+
+log = logging.getLogger(__name__)
+
+
+# folder containing bundled fonts
+fonts_folder = Path(__file__).parent.parent / "assets" / "fonts"
+
+# family names of bundled fonts whose file names differ
+_font_families = {
+    "JetBrainsMono": "JetBrains Mono",
+    "NotoEmoji": "Noto Emoji",
+}
+
+# characters always kept when subsetting fonts (for punctuation added by CSS, e.g. list bullets)
+_base_chars = set(string.printable) | set("•◦▪–—…‘’“”")
+
+# regex to find tags in HTML
+_tag_re = re.compile(r"<[^>]*>")
+# regex to find the src attribute of an img tag (the value is group 2)
+_img_src_re = re.compile(r"<img\b[^>]*?\bsrc\s*=\s*([\"'])(.*?)\1", re.IGNORECASE | re.DOTALL)
+# regex to find the font families named in CSS
+_font_family_re = re.compile(r"font-family\s*:\s*([^;}]+)", re.IGNORECASE)
+
+# bytes to read at a time when inlining files (a multiple of 3, so each chunk's base64 can be
+# written as soon as it's read)
+_chunk_size = 3 * 64 * 1024
+
+
+def font_files(folder):
+    """
+    Find font files in a folder, along with the family, weight and style of each.
+
+    #### Args
+    folder (pathlib.Path)
+    :    Folder containing .ttf files named like `FamilyName-BoldItalic.ttf`
+
+    #### Returns
+    list[tuple]
+    :    (family name, CSS font weight, CSS font style, pathlib.Path) for each font file
+    """
+    fonts = []
+    for file in sorted(folder.glob("*.ttf")):
+        family, _, variant = file.stem.partition("-")
+        # file names don't have spaces, so look up the real family name
+        family = _font_families.get(family, family)
+        fonts.append(
+            (family, 700 if 'Bold' in variant else 400, 'italic' if 'Italic' in variant else 'normal', file)
+        )
+
+    return fonts
+
+
+def css_families(css):
+    """
+    Get the names of all font families named in some CSS.
+    """
+    families = set()
+    for match in _font_family_re.finditer(css):
+        for name in match.group(1).split(","):
+            families.add(name.strip().strip("\"'").lower())
+
+    return families
+
+
+def used_chars(content_html):
+    """
+    Get the set of characters which appear as text in some HTML (plus some basic characters
+    which CSS may add).
+    """
+    return _base_chars | set(unescape(_tag_re.sub("", content_html)))
+
+
+def subset_font(file, chars):
+    """
+    Cut a font down to only the glyphs needed for the given characters.
+
+    #### Args
+    file (pathlib.Path)
+    :    Font file to subset
+    chars (set[str])
+    :    Characters which need to be displayable
+
+    #### Returns
+    bytes
+    :    Font data, as WOFF if fontTools is installed (otherwise the whole font file as-is)
+    str
+    :    CSS format of the font data
+    """
+    if subset is None:
+        log.warning(f"fontTools isn't installed, so {file.name} is being inlined whole rather than subset")
+        return file.read_bytes(), "truetype"
+    # subset font
+    options = subset.Options()
+    options.flavor = "woff"
+    font = subset.load_font(str(file), options)
+    subsetter = subset.Subsetter(options)
+    subsetter.populate(text="".join(chars))
+    subsetter.subset(font)
+    # save to bytes
+    buffer = io.BytesIO()
+    subset.save_font(font, buffer, options)
+
+    return buffer.getvalue(), "woff"
+
+
+def local_image(src, base):
+    """
+    Get the file an img tag's src points to, if it's a local file which exists.
+
+    #### Args
+    src (str)
+    :    Value of the src attribute (with HTML entities already unescaped)
+    base (pathlib.Path, optional)
+    :    Folder to resolve relative paths against, if None then relative paths are not resolved
+
+    #### Returns
+    pathlib.Path or None
+    :    Path to the image file, or None if it's remote, missing or can't be resolved
+    """
+    url = urlsplit(src)
+    if url.scheme == "file":
+        path = Path(url2pathname(unquote(url.path)))
+    elif len(url.scheme) > 1 or url.netloc:
+        # remote (or data) urls are left as they are
+        return None
+    elif len(url.scheme) == 1:
+        # windows drive letter
+        path = Path(src)
+    elif base is not None:
+        path = base / url2pathname(unquote(url.path))
+    else:
+        return None
+
+    return path if path.is_file() else None
+
+
+class StyledExporter(util.QObject):
+    """
+    Writes rendered HTML to a self-contained HTML file on a background thread: the theme's CSS,
+    the fonts it uses (cut down to just the characters in the content) and, optionally, local
+    images are all inlined. The file is streamed to disk piece by piece rather than built up in
+    memory, and only replaces the target once it's complete.
+
+    #### Args
+    parent (qt.QObject)
+    :    Object which owns this exporter (signals are delivered on its thread)
+    filename (pathlib.Path)
+    :    File to write to
+    content_html (str)
+    :    Rendered HTML for the page body
+    css (str)
+    :    CSS to style the page with (e.g. the current viewer theme's CSS)
+    title (str)
+    :    Title of the page
+    base (pathlib.Path, optional)
+    :    Folder to resolve relative image paths against
+    inline_images (bool)
+    :    Embed local images in the file as data URIs
+
+    #### Attributes
+    finished (util.pyqtSignal)
+    :    Emitted with the filename once the file has been written
+    failed (util.pyqtSignal)
+    :    Emitted with the filename and an error message if the file couldn't be written
+    """
+    finished = util.pyqtSignal(str)
+    failed = util.pyqtSignal(str, str)
+
+    def __init__(self, parent, filename, content_html, css="", title="", base=None, inline_images=True):
+        util.QObject.__init__(self, parent)
+        self.filename = Path(filename)
+        self.content_html = content_html
+        self.css = css
+        self.title = title
+        self.base = base
+        self.inline_images = inline_images
+        self._thread = None
+
+    def start(self):
+        """
+        Start writing the file on a background thread.
+        """
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._thread.start()
+
+    def wait(self, timeout=None):
+        """
+        Block until the file has been written (or writing failed).
+        """
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _work(self):
+        # write to a temporary file alongside the target, so a half written file never replaces it
+        temp = self.filename.with_name(self.filename.name + ".part")
+        try:
+            with timings.span("export"):
+                with open(temp, "w", encoding="utf-8", newline="\n") as f:
+                    self.write(f)
+                os.replace(temp, self.filename)
+        except Exception as err:
+            try:
+                temp.unlink()
+            except OSError:
+                pass
+            self.failed.emit(str(self.filename), str(err))
+        else:
+            self.finished.emit(str(self.filename))
+
+    def write(self, f):
+        """
+        Write the page to an open text file.
+        """
+        f.write(
+            f"<!DOCTYPE html>\n"
+            f"<html>\n"
+            f"<head>\n"
+            f"<meta charset=\"utf-8\">\n"
+            f"<title>{escape(self.title)}</title>\n"
+            f"<style>\n"
+        )
+        self.write_fonts(f)
+        f.write(self.css)
+        f.write(
+            f"\n"
+            f"</style>\n"
+            f"</head>\n"
+            f"<body>\n"
+        )
+        self.write_body(f)
+        f.write(
+            f"\n"
+            f"</body>\n"
+            f"</html>\n"
+        )
+
+    def write_fonts(self, f):
+        """
+        Write an `@font-face` rule for each bundled font used by the CSS, with the font data
+        inlined.
+        """
+        families = css_families(self.css)
+        chars = None
+        for family, weight, style, file in font_files(fonts_folder):
+            if family.lower() not in families:
+                continue
+            # work out which characters are needed (only once, and only if a font is used)
+            if chars is None:
+                chars = used_chars(self.content_html)
+            data, fmt = subset_font(file, chars)
+            f.write(
+                f"@font-face {{\n"
+                f"    font-family: '{family}';\n"
+                f"    src: url('data:font/{'woff' if fmt == 'woff' else 'ttf'};base64,"
+            )
+            f.write(base64.b64encode(data).decode("ascii"))
+            f.write(
+                f"') format('{fmt}');\n"
+                f"    font-weight: {weight};\n"
+                f"    font-style: {style};\n"
+                f"}}\n"
+            )
+
+    def write_body(self, f):
+        """
+        Write the page content, swapping the src of any local images for the image data.
+        """
+        content = self.content_html
+        last = 0
+        if self.inline_images:
+            for match in _img_src_re.finditer(content):
+                path = local_image(unescape(match.group(2)), self.base)
+                if path is None:
+                    continue
+                mime, _ = mimetypes.guess_type(path.name)
+                if mime is None or not mime.startswith("image/"):
+                    continue
+                # write content up to the src value, then the image data in its place
+                f.write(content[last:match.start(2)])
+                f.write(f"data:{mime};base64,")
+                with open(path, "rb") as img:
+                    for chunk in iter(lambda: img.read(_chunk_size), b""):
+                        f.write(base64.b64encode(chunk).decode("ascii"))
+                last = match.end(2)
+        f.write(content[last:])
@@ -0,0 +1,914 @@
+import re
+import time
+import pygments.lexer
+import pygments.token
+import PyQt5.QtCore as util
+import PyQt5.QtGui as gui
+
+from .timing import timings
+
+try:
+    import re._parser as sre_parse
+    import re._compiler as sre_compile
+    import re._constants as sre_constants
+except ImportError:
+    # before Python 3.11
+    import sre_parse, sre_compile, sre_constants
+
+
+# distance ahead for lexing which depends on the rest of the document, however long
+forever = float("inf")
+
+_c = sre_constants
+_repeats = (_c.MAX_REPEAT, _c.MIN_REPEAT, getattr(_c, "POSSESSIVE_REPEAT", _c.MAX_REPEAT))
+_atomic = getattr(_c, "ATOMIC_GROUP", None)
+
+
+def _anything(state):
+    # [\s\S]*
+    return [(_c.MAX_REPEAT, (0, _c.MAXREPEAT, sre_parse.SubPattern(state, [
+        (_c.IN, [(_c.CATEGORY, _c.CATEGORY_SPACE), (_c.CATEGORY, _c.CATEGORY_NOT_SPACE)])
+    ])))]
+
+
+def _whole(state, items):
+    # items as they are, except for anything which looks around (which is assumed to pass) or
+    # refers back to groups (which is assumed to match anything)
+    sub = sre_parse.SubPattern
+    out = []
+    for op, av in items:
+        if op in (_c.LITERAL, _c.NOT_LITERAL, _c.IN, _c.ANY, _c.AT):
+            out.append((op, av))
+        elif op is _c.BRANCH:
+            out.append((op, (None, [sub(state, _whole(state, alt)) for alt in av[1]])))
+        elif op is _c.SUBPATTERN:
+            out.append((op, (None, av[1], av[2], sub(state, _whole(state, av[3])))))
+        elif op is _atomic:
+            out.append((_c.SUBPATTERN, (None, 0, 0, sub(state, _whole(state, av)))))
+        elif op in _repeats:
+            op = _c.MIN_REPEAT if op is _c.MIN_REPEAT else _c.MAX_REPEAT
+            out.append((op, (av[0], av[1], sub(state, _whole(state, av[2])))))
+        elif op is _c.GROUPREF_EXISTS:
+            alts = [sub(state, _whole(state, av[1])), sub(state, _whole(state, av[2] or []))]
+            out.append((_c.BRANCH, (None, alts)))
+        elif op not in (_c.ASSERT, _c.ASSERT_NOT):
+            out.extend(_anything(state))
+
+    return out
+
+
+def _part(state, item):
+    # anything a match of a single item could start with
+    sub = sre_parse.SubPattern
+    op, av = item
+    if op in (_c.LITERAL, _c.NOT_LITERAL, _c.IN, _c.ANY):
+        return [(_c.MAX_REPEAT, (0, 1, sub(state, [item])))]
+    if op in (_c.AT, _c.ASSERT, _c.ASSERT_NOT):
+        return []
+    if op is _c.BRANCH:
+        return [(op, (None, [sub(state, _prefix(state, alt)) for alt in av[1]]))]
+    if op is _c.SUBPATTERN:
+        return [(op, (None, av[1], av[2], sub(state, _prefix(state, av[3]))))]
+    if op is _atomic:
+        return [(_c.SUBPATTERN, (None, 0, 0, sub(state, _prefix(state, av))))]
+    if op in _repeats:
+        # any number of whole repeats (one fewer than the most allowed), then part of another
+        lo, hi, body = av
+        if hi == 0:
+            return []
+        return [
+            (_c.MAX_REPEAT, (0, hi if hi == _c.MAXREPEAT else hi - 1, sub(state, _whole(state, body)))),
+            (_c.SUBPATTERN, (None, 0, 0, sub(state, _prefix(state, body)))),
+        ]
+    if op is _c.GROUPREF_EXISTS:
+        return [(_c.BRANCH, (None, [sub(state, _prefix(state, av[1])), sub(state, _prefix(state, av[2] or []))]))]
+
+    return _anything(state)
+
+
+def _prefix(state, items):
+    # anything a match of a sequence of items could start with: part of the first item, or
+    # the whole first item then anything the rest could start with
+    tail = []
+    for item in reversed(list(items)):
+        part = _part(state, item)
+        if tail:
+            part = [(_c.BRANCH, (None, [
+                sre_parse.SubPattern(state, part),
+                sre_parse.SubPattern(state, _whole(state, [item]) + tail),
+            ]))]
+        tail = part
+
+    return tail
+
+
+def prefix_pattern(patterns):
+    """
+    Make a regex which matches the start of anything any of the given regexes could match, so
+    that when they fail to match some text, `fullmatch` tells whether they could have matched
+    if only the text had gone on differently (i.e. whether they looked as far as its end).
+    Lookarounds and backreferences are allowed to match anything, so this can match more
+    than it strictly needs to, but never less.
+
+    #### Args
+    patterns (list[re.Pattern])
+    :    Compiled regexes
+
+    #### Returns
+    re.Pattern
+    :    Compiled regex
+    """
+    state = sre_parse.State()
+    state.flags = re.UNICODE
+    alts = []
+    for pattern in patterns:
+        tree = sre_parse.parse(pattern.pattern, pattern.flags)
+        # keep each regex's own flags
+        flags = tree.state.flags & (re.IGNORECASE | re.MULTILINE | re.DOTALL)
+        alts.append(sre_parse.SubPattern(state, [
+            (_c.SUBPATTERN, (None, flags, 0, sre_parse.SubPattern(state, _prefix(state, tree.data))))
+        ]))
+
+    return sre_compile.compile(sre_parse.SubPattern(state, [(_c.BRANCH, (None, alts))]), re.UNICODE)
+
+
+# prefix patterns for the first few rules of each lexer state, by lexer class, state and number of rules
+_prefixes = {}
+
+
+def _rule_prefixes(lexer, state, count):
+    key = (type(lexer), state, count)
+    if key not in _prefixes:
+        rules = lexer._tokens[state][:count]
+        try:
+            _prefixes[key] = prefix_pattern([rexmatch.__self__ for rexmatch, _, _ in rules])
+        except (AttributeError, TypeError, re.error, RecursionError):
+            # rules which aren't plain regexes could look anywhere
+            _prefixes[key] = None
+
+    return _prefixes[key]
+
+
+class _Lexing:
+    """
+    Iterate over the tokens of a string with a pygments lexer, starting from a given state
+    stack and keeping track of the stack as it goes (which pygments itself keeps private).
+
+    #### Args
+    lexer (pygments.lexer.Lexer)
+    :    Lexer to tokenise with
+    text (str)
+    :    Text to tokenise
+    stack (tuple[str])
+    :    State stack to start from
+    reach (int or float)
+    :    Index in `text` up to which lexing before it depends on (see `reach` below)
+    complete (bool)
+    :    Does `text` run to the end of the document?
+
+    #### Attributes
+    stack (tuple[str])
+    :    State stack after the most recent match
+    end (int)
+    :    Index in `text` at which the most recent match ended
+    reach (int or float)
+    :    Index in `text` up to which the matches so far depend on, i.e. the furthest any rule
+         could have looked (rules which failed to match may have looked ahead a long way, e.g.
+         for a closing fence), or `forever` if they depend on the rest of the document
+    overrun (bool)
+    :    Did any rule look as far as the end of an incomplete `text`? If so, the matches so far
+         may have been different with more text
+    """
+    def __init__(self, lexer, text, stack=("root",), reach=0, complete=True):
+        self.lexer = lexer
+        self.text = text
+        self.stack = tuple(stack)
+        self.end = 0
+        self.reach = reach
+        self.complete = complete
+        self.overrun = False
+        if self.resumable(lexer):
+            self._iter = self._regex_tokens()
+        else:
+            # lexers which can't be resumed are treated as one big match
+            self.end = len(text)
+            self.reach = forever
+            self._iter = iter(lexer.get_tokens_unprocessed(text))
+
+    @staticmethod
+    def resumable(lexer):
+        """
+        Can the given lexer be started from a state stack part way through a text?
+        """
+        # only plain regex lexers expose enough to resume from a stack
+        return type(lexer).get_tokens_unprocessed is pygments.lexer.RegexLexer.get_tokens_unprocessed
+
+    def __iter__(self):
+        return self._iter
+
+    def __next__(self):
+        return next(self._iter)
+
+    def _regex_tokens(self):
+        """
+        Same as `pygments.lexer.RegexLexer.get_tokens_unprocessed`, except that the state
+        stack is updated before the tokens of each match are yielded.
+        """
+        lexer = self.lexer
+        text = self.text
+        pos = 0
+        tokendefs = lexer._tokens
+        statestack = list(self.stack)
+        statetokens = tokendefs[statestack[-1]]
+        while True:
+            for index, (rexmatch, action, new_state) in enumerate(statetokens):
+                m = rexmatch(text, pos)
+                if m:
+                    # note how far this match (and any rules which didn't match) looked
+                    self.look(statestack[-1], index, pos, m.end() + 1)
+                    # get tokens for this match
+                    if action is None:
+                        tokens = []
+                    elif type(action) is pygments.token._TokenType:
+                        tokens = [(pos, action, m.group())]
+                    else:
+                        tokens = list(action(lexer, m))
+                    pos = m.end()
+                    # state transition
+                    if new_state is not None:
+                        if isinstance(new_state, tuple):
+                            for state in new_state:
+                                if state == "#pop":
+                                    if len(statestack) > 1:
+                                        statestack.pop()
+                                elif state == "#push":
+                                    statestack.append(statestack[-1])
+                                else:
+                                    statestack.append(state)
+                        elif isinstance(new_state, int):
+                            if abs(new_state) >= len(statestack):
+                                del statestack[1:]
+                            else:
+                                del statestack[new_state:]
+                        elif new_state == "#push":
+                            statestack.append(statestack[-1])
+                        statetokens = tokendefs[statestack[-1]]
+                    # store state before handing over tokens
+                    self.stack = tuple(statestack)
+                    self.end = pos
+                    yield from tokens
+                    break
+            else:
+                if pos >= len(text):
+                    break
+                self.look(statestack[-1], len(statetokens), pos, pos + 1)
+                if text[pos] == "\n":
+                    # at EOL, reset state to "root"
+                    statestack = ["root"]
+                    statetokens = tokendefs["root"]
+                    self.stack = ("root",)
+                    self.end = pos + 1
+                    yield pos, pygments.token.Whitespace, "\n"
+                else:
+                    self.end = pos + 1
+                    yield pos, pygments.token.Error, text[pos]
+                pos += 1
+
+    def look(self, state, failed, pos, end):
+        """
+        Note how far ahead lexing has looked, given that the first `failed` rules of `state`
+        didn't match at `pos` and that the rule which did looked up to `end`.
+        """
+        if self.reach is forever:
+            return
+        reach = max(self.reach, end)
+        if failed:
+            text = self.text
+            # only rules which could still match at the end of this line look into the next one
+            eol = text.find("\n", pos) + 1 or len(text)
+            prefixes = _rule_prefixes(self.lexer, state, failed)
+            if prefixes is None:
+                stop = len(text)
+            elif prefixes.fullmatch(text, pos, eol):
+                stop = self.viable_end(prefixes, pos, eol)
+            else:
+                stop = pos
+            if stop >= len(text):
+                # the rules looked as far as the end of the text
+                self.overrun = not self.complete
+                reach = forever
+            else:
+                reach = max(reach, stop + 1)
+        self.reach = reach
+
+    def viable_end(self, prefixes, pos, start):
+        """
+        Find the furthest index in `text` up to which a prefix pattern (see `prefix_pattern`)
+        matches from `pos`, given that it matches up to `start`.
+        """
+        text = self.text
+        if prefixes.fullmatch(text, pos):
+            return len(text)
+        # step forward in ever bigger steps until it doesn't match, then narrow it down
+        lo, step = start, 1
+        while lo + step < len(text) and prefixes.fullmatch(text, pos, lo + step):
+            lo += step
+            step *= 2
+        hi = min(lo + step, len(text))
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if prefixes.fullmatch(text, pos, mid):
+                lo = mid
+            else:
+                hi = mid
+
+        return lo
+
+
+class _BlockData(gui.QTextBlockUserData):
+    """
+    Lexing results stored against each text block.
+
+    #### Attributes
+    spans (list[tuple])
+    :    Pairs of (token type, length) covering the block's text and its trailing newline
+    stack (tuple[str])
+    :    Lexer state stack at the end of the block
+    ahead (int or float)
+    :    Number of characters past the end of the block which lexing up to it depends on
+         (`forever` if it depends on the rest of the document)
+    """
+    def __init__(self, spans, stack, ahead=0):
+        gui.QTextBlockUserData.__init__(self)
+        self.spans = spans
+        self.stack = stack
+        self.ahead = ahead
+
+
+class _Run:
+    """
+    A single pass of the lexer over consecutive blocks, starting from a block boundary at
+    which the lexer state is known.
+
+    Only a window of blocks from the starting block is copied out of the document to lex, as
+    most runs stop after a few blocks. Once half the window has been taken, or any rule has
+    looked as far as the end of the window (e.g. for a closing fence), the run is `short` and
+    should be replaced by a run with a bigger window (lexing from the same block, as rules
+    which look ahead may match differently with more of the document in view).
+
+    #### Args
+    block (gui.QTextBlock)
+    :    Block to start lexing from
+    lexer (pygments.lexer.Lexer)
+    :    Lexer to tokenise with
+    stack (tuple[str])
+    :    Lexer state stack at the start of `block`
+    generation (int)
+    :    Document generation this run was lexed from
+    window (int)
+    :    Number of blocks to copy out to lex (lexers which can't be resumed always get the rest
+         of the document)
+    ahead (int or float)
+    :    Number of characters past the start of `block` which lexing before it depends on
+    """
+    def __init__(self, block, lexer, stack, generation, window, ahead=0):
+        self.generation = generation
+        self.start = block
+        self.stack = stack
+        self.window = window
+        self.ahead = ahead
+        self.next = block
+        self.taken = 0
+        # find the end of the window
+        self.end = block
+        if _Lexing.resumable(lexer):
+            for n in range(window):
+                self.end = self.end.next()
+                if not self.end.isValid():
+                    break
+        else:
+            self.end = gui.QTextBlock()
+        # get text from this block to the end of the window
+        cursor = gui.QTextCursor(block)
+        if self.end.isValid():
+            cursor.setPosition(self.end.position(), cursor.KeepAnchor)
+            text = cursor.selectedText().replace("\u2029", "\n")
+        else:
+            cursor.movePosition(cursor.End, cursor.KeepAnchor)
+            text = cursor.selectedText().replace("\u2029", "\n") + "\n"
+        # start lexing
+        self.lexing = _Lexing(lexer, text, stack, reach=ahead, complete=not self.end.isValid())
+        self.pos = 0
+        self.pending = None
+
+    @property
+    def short(self):
+        """
+        Has this run taken so much of its window (or looked to the end of it) that it needs to
+        see further ahead?
+        """
+        return self.end.isValid() and (self.taken * 2 >= self.window or self.lexing.overrun)
+
+    def continues(self, block, generation):
+        """
+        Can this run carry on into the given block?
+        """
+        return generation == self.generation and block == self.next
+
+    def take(self, block):
+        """
+        Consume tokens for the given block, returning a list of (token type, length) spans and
+        a (stack, carry, ahead) tuple describing the lexer state at the end of the block (where
+        carry is None if no token or match crosses into the next block, and ahead is the number
+        of characters past the end of the block which lexing up to it depends on).
+        """
+        length = len(block.text()) + 1
+        spans = []
+        while length > 0:
+            # get next token if needed
+            if self.pending is None:
+                try:
+                    _, ttype, value = next(self.lexing)
+                except StopIteration:
+                    break
+                if not value:
+                    continue
+                self.pending = [ttype, len(value)]
+            # take as much of it as fits in this block
+            ttype, remaining = self.pending
+            n = min(remaining, length)
+            if spans and spans[-1][0] is ttype:
+                spans[-1] = (ttype, spans[-1][1] + n)
+            else:
+                spans.append((ttype, n))
+            length -= n
+            self.pos += n
+            if n == remaining:
+                self.pending = None
+            else:
+                self.pending[1] -= n
+        # work out whether this is a clean boundary
+        if self.pending is not None:
+            carry = tuple(self.pending)
+        elif self.lexing.end > self.pos:
+            carry = (None, self.lexing.end - self.pos)
+        else:
+            carry = None
+        # move on
+        self.next = block.next()
+        self.taken += 1
+
+        return spans, (self.lexing.stack, carry, max(self.lexing.reach - self.pos, 0))
+
+
+class PygmentsHighlighter(gui.QSyntaxHighlighter):
+    """
+    Syntax highlighter which lexes a document with pygments one block at a time, storing the
+    lexer state against each block so that, after an edit, only the blocks from the edit
+    onwards are re-lexed (and only until the lexer state matches what it was before). Each block
+    also stores how far past its end lexing up to it looked (as some pygments rules, e.g.
+    setext headings or fenced code, look ahead to later lines), so re-lexing starts from a
+    block boundary which nothing before it looks past.
+
+    Formats are applied to each block's layout rather than its text, so highlighting doesn't
+    touch the document's undo stack.
+
+    When a large change is made (e.g. opening or pasting a big file), only a limited number of
+    blocks are lexed straight away. Any visible blocks are then lexed as a priority, and the
+    rest of the document is backfilled in short time slices while the event loop is idle.
+
+    #### Args
+    ctrl (stc.StyledTextCtrl)
+    :    Text control whose document to highlight
+    lexer (pygments.lexer.Lexer)
+    :    Lexer to tokenise with
+
+    #### Attributes
+    lookahead (int)
+    :    Number of blocks past an edit to copy out of the document to lex to begin with (more
+         are copied if re-lexing carries on further)
+    immediate_blocks (int)
+    :    Number of blocks to lex straight away after a change, before deferring the rest
+    margin (int)
+    :    Number of blocks either side of the viewport to lex along with visible blocks
+    backfill_blocks (int)
+    :    Number of blocks to lex in one go when backfilling
+    backfill_time (float)
+    :    Seconds to spend backfilling before giving the event loop a turn
+    """
+    lookahead = 256
+    immediate_blocks = 200
+    margin = 50
+    backfill_blocks = 256
+    backfill_time = 0.01
+
+    def __init__(self, ctrl, lexer):
+        # initialise without a document
+        gui.QSyntaxHighlighter.__init__(self, ctrl)
+        self.ctrl = ctrl
+        self.lexer = lexer
+        # current pass of the lexer
+        self._run = None
+        # number of blocks to lex runs from, grown by runs which carry on past their window
+        self._window = self.lookahead
+        # count changes to the document (connected before setting the document, so it's
+        # updated before the highlighter responds to the change)
+        self._generation = 0
+        ctrl.document().contentsChange.connect(self.on_contents_change)
+        # when the current change was made and when its last block was highlighted, for timing
+        self._change_start = None
+        self._change_end = None
+        # blocks before an edit whose tokens were changed by it
+        self._stale = []
+        # number of blocks which can be lexed before deferring the rest
+        self._budget = self.immediate_blocks
+        self._suspended = False
+        # deferred blocks are backfilled from this position
+        self._backfill = gui.QTextCursor(ctrl.document())
+        self._scanned = 0
+        self._backfill_timer = util.QTimer(self)
+        self._backfill_timer.setSingleShot(True)
+        self._backfill_timer.timeout.connect(self.backfill)
+        # visible blocks are lexed as a priority after changes and when scrolling
+        self._visible_timer = util.QTimer(self)
+        self._visible_timer.setSingleShot(True)
+        self._visible_timer.timeout.connect(self.highlight_visible)
+        # blocks are restyled (without lexing) from this position after the theme changes
+        self._restyle = gui.QTextCursor(ctrl.document())
+        self._restyle_timer = util.QTimer(self)
+        self._restyle_timer.setSingleShot(True)
+        self._restyle_timer.timeout.connect(self.restyle_step)
+        ctrl.verticalScrollBar().valueChanged.connect(self.on_scroll)
+        # attach to document
+        self.setDocument(ctrl.document())
+
+    def on_contents_change(self, position=None, removed=None, added=None):
+        # time from the change until its blocks are highlighted, once control is back with the
+        # event loop
+        if self._change_start is None:
+            self._change_start = time.perf_counter()
+            util.QTimer.singleShot(0, self.record_highlight)
+        self._generation += 1
+        self._window = self.lookahead
+        # allow a limited number of blocks to be lexed straight away (unless suspended)
+        self._budget = 0 if self._suspended else self.immediate_blocks
+
+    def suspend(self):
+        """
+        Defer every changed block rather than lexing some straight away, until `resume` is
+        called (e.g. while a file is inserted a chunk at a time).
+        """
+        self._suspended = True
+        self._budget = 0
+
+    def resume(self):
+        """
+        Go back to lexing changed blocks straight away, and lex any visible blocks deferred while
+        suspended.
+        """
+        self._suspended = False
+        self._visible_timer.start()
+
+    @property
+    def busy(self):
+        """
+        Are any blocks still waiting to be lexed or restyled in the background?
+        """
+        return bool(self._stale) or any(
+            timer.isActive() for timer in (self._backfill_timer, self._visible_timer, self._restyle_timer)
+        )
+
+    def on_scroll(self, value=None):
+        self._visible_timer.start()
+
+    def highlightBlock(self, text):
+        block = self.currentBlock()
+        # defer this block if the budget is used up
+        if self._budget <= 0:
+            self.defer_block(text)
+        else:
+            self._budget -= 1
+            # lex this block
+            spans, state, data = self.lex_block(block)
+            # apply formats
+            self.apply_spans(text, spans)
+            # store results
+            self.setCurrentBlockUserData(data)
+            self.setCurrentBlockState(state)
+        self._change_end = time.perf_counter()
+
+    def record_highlight(self):
+        """
+        Record how long the blocks changed since the last call took to highlight.
+        """
+        if self._change_end is not None and self._change_end >= self._change_start:
+            timings.record("highlight", self._change_start, self._change_end)
+        self._change_start = self._change_end = None
+
+    def lex_block(self, block):
+        """
+        Lex the given block, carrying on from the last block lexed if possible.
+
+        #### Returns
+        list[tuple]
+        :    (token type, length) span for each token in the block
+        int
+        :    State to store for the block
+        _BlockData
+        :    User data to store for the block
+        """
+        # start a new run if we can't carry on from the last block
+        if self._run is None or not self._run.continues(block, self._generation):
+            self._run = self._start_run(block)
+        while True:
+            # lex further ahead if the run is running out of text
+            while self._run.short:
+                self._grow_run(block)
+            # lex this block
+            spans, (stack, carry, ahead) = self._run.take(block)
+            # lex it again with more text if any rule looked to the end of the window
+            if not self._run.lexing.overrun:
+                break
+            self._grow_run(block)
+
+        return spans, self.block_state(stack, carry, ahead), _BlockData(spans, stack, ahead)
+
+    @staticmethod
+    def block_state(stack, carry, ahead):
+        """
+        Get the state to store for a block from the lexer state at the end of it (see
+        `_Run.take`). The lowest bit is set if a token or match crosses into the next block.
+        """
+        key = hash((stack, carry, ahead)) & 0x3FFFFFFF
+
+        return (key << 1) | (carry is not None)
+
+    def _start_run(self, block):
+        """
+        Start lexing from the nearest safe boundary before the given block: one which no token
+        or match crosses, and which nothing lexed before it looked past.
+        """
+        start = block
+        while True:
+            prev = start.previous()
+            # stop at the start of the document, or at unlexed blocks
+            if not prev.isValid() or prev.userState() == -1:
+                break
+            # stop if lexing up to this block didn't look as far as the requested block
+            data = prev.userData()
+            if not prev.userState() & 1 and isinstance(data, _BlockData) and (
+                start.position() + data.ahead <= block.position()
+            ):
+                break
+            start = prev
+        # get stack from the block before the starting block
+        prev = start.previous()
+        stack = ("root",)
+        ahead = 0
+        if prev.isValid() and isinstance(prev.userData(), _BlockData):
+            stack = prev.userData().stack
+            ahead = prev.userData().ahead
+        # start run, with room to look ahead past the requested block
+        steps = block.blockNumber() - start.blockNumber()
+        run = _Run(start, self.lexer, stack, self._generation, self._window + 2 * steps, ahead)
+
+        return self._catch_up(run, block)
+
+    def _grow_run(self, block):
+        """
+        Replace the current run with one lexing from the same block with a bigger window, and
+        catch it up to the given block.
+        """
+        run = self._run
+        # later runs (e.g. for blocks found to be stale) also need to see this far
+        self._window = max(self._window, run.window * 2)
+        self._run = self._catch_up(
+            _Run(run.start, self.lexer, run.stack, self._generation, self._window, run.ahead), block
+        )
+
+    def _catch_up(self, run, block):
+        """
+        Take blocks from a run up to the given block, marking any whose tokens (or state) have
+        changed as stale.
+        """
+        # catch up to the requested block, noting any earlier blocks which have changed
+        while run.next != block:
+            earlier = run.next
+            spans, state = run.take(earlier)
+            data = earlier.userData()
+            if not isinstance(data, _BlockData) or data.spans != spans or (
+                earlier.userState() != self.block_state(*state)
+            ):
+                self.mark_stale(earlier)
+
+        return run
+
+    def defer_block(self, text):
+        """
+        Mark the current block to be lexed later, keeping its previous formatting until then if
+        it still fits.
+        """
+        data = self.currentBlockUserData()
+        if isinstance(data, _BlockData) and sum(n for _, n in data.spans) == len(text) + 1:
+            self.apply_spans(text, data.spans)
+        self.setCurrentBlockState(-1)
+        # make sure visible blocks and the backfill get done
+        self._visible_timer.start()
+        self._scanned = 0
+        if not self._backfill_timer.isActive():
+            self._backfill.setPosition(self.currentBlock().position())
+            self._backfill_timer.start()
+
+    def rehighlight_from(self, block, budget):
+        """
+        Lex the given block, carrying on through later blocks (for as long as they're deferred or
+        their state changes) up to the given number of blocks.
+
+        Formats are set on each block's layout directly and the document is only marked dirty
+        once at the end, as going via `rehighlightBlock` would lay out the rest of the document
+        again for every block.
+        """
+        formats = self.ctrl.app.theme.editor.formats
+        first = last = block
+        while block.isValid() and budget > 0:
+            old = block.userState()
+            # lex block
+            spans, state, data = self.lex_block(block)
+            # apply formats
+            self.set_block_formats(block, spans, formats)
+            # store results
+            block.setUserData(data)
+            block.setUserState(state)
+            budget -= 1
+            last = block
+            # carry on if the next block depends on this one
+            block = block.next()
+            if old == state and block.userState() != -1:
+                break
+        # relayout all changed blocks at once
+        end = last.position() + last.length()
+        self.document().markContentsDirty(first.position(), end - first.position())
+
+    def set_block_formats(self, block, spans, formats):
+        """
+        Set formats for each (token type, length) span directly on a block's layout (the caller
+        is responsible for marking the document dirty afterwards).
+        """
+        ranges = []
+        for start, length, ttype in self.iter_spans(block.text(), spans):
+            rng = gui.QTextLayout.FormatRange()
+            rng.start = start
+            rng.length = length
+            rng.format = formats[ttype]
+            ranges.append(rng)
+        block.layout().setFormats(ranges)
+
+    def visible_blocks(self):
+        """
+        Get the first block in (or near) the viewport, and the number of blocks from there to
+        the last block in (or near) the viewport.
+        """
+        viewport = self.ctrl.viewport()
+        first = self.ctrl.cursorForPosition(util.QPoint(0, 0)).block()
+        last = self.ctrl.cursorForPosition(util.QPoint(0, viewport.height())).block()
+        # add margin
+        for n in range(self.margin):
+            if not first.previous().isValid():
+                break
+            first = first.previous()
+
+        return first, last.blockNumber() - first.blockNumber() + self.margin + 1
+
+    def highlight_visible(self):
+        """
+        Lex any deferred blocks in (or near) the viewport.
+        """
+        first, count = self.visible_blocks()
+        # lex deferred blocks
+        with timings.span("highlight"):
+            block = first
+            while block.isValid() and count > 0:
+                if block.userState() == -1:
+                    self.rehighlight_from(block, budget=count)
+                block = block.next()
+                count -= 1
+
+    def restyle(self):
+        """
+        Apply the current theme's formats to every block from its stored spans, without lexing
+        again. Visible blocks are done straight away and the rest a slice at a time when idle
+        (blocks which haven't been lexed yet get the current formats once they are).
+        """
+        # restyle visible blocks
+        self.restyle_blocks(*self.visible_blocks())
+        # restyle the rest from the start
+        self._restyle.setPosition(0)
+        self._restyle_timer.start()
+
+    def restyle_blocks(self, block, count):
+        """
+        Apply the current theme's formats to the given number of blocks from the given block
+        onwards, returning the block after the last one restyled.
+        """
+        formats = self.ctrl.app.theme.editor.formats
+        first = last = block
+        while block.isValid() and count > 0:
+            data = block.userData()
+            if isinstance(data, _BlockData):
+                self.set_block_formats(block, data.spans, formats)
+            last = block
+            block = block.next()
+            count -= 1
+        # relayout all restyled blocks at once
+        end = last.position() + last.length()
+        self.document().markContentsDirty(first.position(), end - first.position())
+
+        return block
+
+    def restyle_step(self):
+        """
+        Restyle blocks for a short time, then schedule the next slice if any are left.
+        """
+        deadline = time.perf_counter() + self.backfill_time
+        block = self._restyle.block()
+        while block.isValid() and time.perf_counter() < deadline:
+            # restyling is cheap next to lexing, so do more blocks at once
+            block = self.restyle_blocks(block, self.backfill_blocks * 4)
+        # carry on next time the event loop is free
+        if block.isValid():
+            self._restyle.setPosition(block.position())
+            self._restyle_timer.start()
+
+    def backfill(self):
+        """
+        Lex deferred blocks for a short time, then schedule the next slice if any are left.
+        """
+        deadline = time.perf_counter() + self.backfill_time
+        block = self._backfill.block()
+        while time.perf_counter() < deadline:
+            # go back to the start, for blocks deferred before the backfill position
+            if not block.isValid():
+                block = self.document().begin()
+                continue
+            # lex deferred blocks
+            if block.userState() == -1:
+                with timings.span("highlight_backfill"):
+                    self.rehighlight_from(block, budget=self.backfill_blocks)
+                self._scanned = 0
+            else:
+                self._scanned += 1
+            # stop once every block has been checked with nothing left to do
+            if self._scanned > self.document().blockCount():
+                return
+            block = block.next()
+        # carry on next time the event loop is free
+        if block.isValid():
+            self._backfill.setPosition(block.position())
+        self._backfill_timer.start()
+
+    def mark_stale(self, block):
+        """
+        Schedule a block before the current edit to be highlighted again.
+        """
+        if not self._stale:
+            util.QTimer.singleShot(0, self.flush_stale)
+        self._stale.append(block)
+
+    def flush_stale(self):
+        """
+        Highlight again any blocks marked as stale.
+        """
+        stale, self._stale = self._stale, []
+        with timings.span("highlight"):
+            for block in stale:
+                if block.isValid():
+                    self.rehighlight_from(block, budget=self.immediate_blocks)
+
+    def apply_spans(self, text, spans):
+        """
+        Apply the format for each (token type, length) span to the current block.
+        """
+        # get compiled formats for the current theme
+        formats = self.ctrl.app.theme.editor.formats
+        for start, length, ttype in self.iter_spans(text, spans):
+            self.setFormat(start, length, formats[ttype])
+
+    @staticmethod
+    def iter_spans(text, spans):
+        """
+        Iterate through (start, length, token type) for each span in a block, with start and
+        length in UTF-16 code units (as Qt indexes them).
+        """
+        # only convert lengths if there are any astral chars
+        wide = len(text.encode("utf-16-le")) // 2 != len(text)
+        i = 0
+        u = 0
+        for ttype, n in spans:
+            if i >= len(text):
+                break
+            un = n
+            if wide:
+                un = len(text[i:i + n].encode("utf-16-le")) // 2
+            yield u, un, ttype
+            i += n
+            u += un
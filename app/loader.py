@@ -0,0 +1,137 @@
+import os
+import time
+import PyQt5.QtCore as util
+import PyQt5.QtGui as gui
+
+from pathlib import Path
+
+from .timing import timings
+
+
+class ProgressiveLoader(util.QObject):
+    """
+    Loads a (potentially very large) text file into a text control a chunk at a time, so the
+    window stays responsive and the load can be cancelled. The file is decoded incrementally as
+    it's read, and the control's signals are blocked (and its highlighter suspended) while chunks
+    are inserted, so nothing responds to the text changing until the whole file is in.
+
+    #### Args
+    ctrl (stc.StyledTextCtrl)
+    :    Control to load text into (its current content is replaced)
+    filename (pathlib.Path)
+    :    File to load
+    chunk_size (int)
+    :    Number of characters to insert at a time
+    step_time (float)
+    :    Seconds to spend inserting chunks before letting the event loop run
+
+    #### Attributes
+    progress (util.pyqtSignal)
+    :    Emitted with the number of bytes read so far
+    finished (util.pyqtSignal)
+    :    Emitted once the whole file has been loaded
+    cancelled (util.pyqtSignal)
+    :    Emitted if the load is cancelled (the control is then empty)
+    failed (util.pyqtSignal)
+    :    Emitted with an error message if the file couldn't be read
+    """
+    progress = util.pyqtSignal(int)
+    finished = util.pyqtSignal()
+    cancelled = util.pyqtSignal()
+    failed = util.pyqtSignal(str)
+
+    def __init__(self, ctrl, filename, chunk_size=256 * 1024, step_time=0.05):
+        util.QObject.__init__(self, ctrl)
+        self.ctrl = ctrl
+        self.filename = Path(filename)
+        self.chunk_size = chunk_size
+        self.step_time = step_time
+        self.size = os.path.getsize(self.filename)
+        self._file = None
+        self._cursor = None
+        self._start = None
+        self._stepping = False
+        # step through the file whenever the event loop is free
+        self._timer = util.QTimer(self)
+        self._timer.setInterval(0)
+        self._timer.timeout.connect(self.step)
+
+    @property
+    def loading(self):
+        """
+        Is the file still being loaded?
+        """
+        return self._file is not None
+
+    def start(self):
+        """
+        Clear the control and start loading the file into it.
+        """
+        self._start = time.perf_counter()
+        # open file (newlines are translated, as with `Path.read_text`)
+        try:
+            self._file = open(self.filename, "r", encoding="utf-8")
+        except OSError as err:
+            self.failed.emit(str(err))
+            return
+        # stop anything responding to the text changing, and don't keep an undo history of it
+        self.ctrl.blockSignals(True)
+        self.ctrl.highlighter.suspend()
+        self.ctrl.setReadOnly(True)
+        self.ctrl.document().setUndoRedoEnabled(False)
+        self.ctrl.clear()
+        self._cursor = gui.QTextCursor(self.ctrl.document())
+        self._timer.start()
+
+    def step(self):
+        """
+        Insert chunks from the file until the step time is used up or the file ends.
+        """
+        # a modal progress dialog processes events when updated, so this can be called again
+        # from within itself
+        if self._stepping:
+            return
+        self._stepping = True
+        deadline = time.perf_counter() + self.step_time
+        try:
+            while True:
+                chunk = self._file.read(self.chunk_size)
+                if not chunk:
+                    self.stop()
+                    timings.record("open", self._start)
+                    self.finished.emit()
+                    return
+                self._cursor.insertText(chunk)
+                if time.perf_counter() > deadline:
+                    break
+        except (OSError, ValueError) as err:
+            self.stop()
+            self.ctrl.clear()
+            self.failed.emit(str(err))
+            return
+        finally:
+            self._stepping = False
+        self.progress.emit(self._file.buffer.tell())
+
+    def cancel(self):
+        """
+        Stop loading, leaving the control empty.
+        """
+        if not self.loading:
+            return
+        self.stop()
+        self.ctrl.clear()
+        self.cancelled.emit()
+
+    def stop(self):
+        """
+        Stop stepping through the file and give the control back its signals.
+        """
+        self._timer.stop()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self.ctrl.document().setUndoRedoEnabled(True)
+        self.ctrl.setReadOnly(False)
+        self.ctrl.highlighter.resume()
+        self.ctrl.blockSignals(False)
@@ -18,6 +18,12 @@ class MarkmojiMenu(qt.QMenuBar):
         # open
         btn = self.file_menu.addAction("&Open...", self.on_file_menu)
         btn.data = "open"
+        # open folder
+        btn = self.file_menu.addAction("Open &folder...", self.on_file_menu)
+        btn.data = "open_folder"
+        # find in files
+        btn = self.file_menu.addAction("&Find in files...", self.on_file_menu)
+        btn.data = "find_in_files"
         # save
         btn = self.file_menu.addAction("&Save", self.on_file_menu)
         btn.data = "save"
@@ -34,6 +40,28 @@ class MarkmojiMenu(qt.QMenuBar):
         # --- theme menu ---
         self.theme_menu = self.addMenu("&Theme")
         self.theme_menu.submenus = {}
+        # theme modules are only imported when the menu is first opened
+        self.theme_menu.aboutToShow.connect(self.populate_theme_menu)
+
+        # --- debug menu ---
+        self.debug_menu = self.addMenu("&Debug")
+        # show render timings
+        btn = self.debug_menu.addAction("Show render &timings", self.on_file_menu)
+        btn.data = "toggle_timings"
+        btn.setCheckable(True)
+        # export render timings
+        btn = self.debug_menu.addAction("&Export render timings...", self.on_file_menu)
+        btn.data = "export_timings"
+        # startup report
+        btn = self.debug_menu.addAction("&Startup report...", self.on_file_menu)
+        btn.data = "show_startup_report"
+    
+    def populate_theme_menu(self, evt=None):
+        """
+        Add an item for each theme to the theme menu, if not done already.
+        """
+        if self.theme_menu.submenus:
+            return
         themes = get_all_themes()
         # combination themes
         menu = self.theme_menu.submenus['all'] = self.theme_menu.addMenu("&Combination")
@@ -68,7 +96,7 @@ class MarkmojiMenu(qt.QMenuBar):
                 btn = submenu.addAction(item, self.set_theme)
                 btn.data = ("viewer", f"{sub}.{item}")
                 btn.setToolTip(f"{sub}.{item}")
-    
+
     def set_theme(self, evt=None):
         # get button
         btn = self.sender()
@@ -0,0 +1,929 @@
+import re
+import sys
+import time
+import queue
+import hashlib
+import markdown
+import markmoji
+import threading
+import traceback
+import multiprocessing
+import PyQt5.QtCore as util
+
+from html import escape, unescape
+from collections import OrderedDict
+from markdown.preprocessors import Preprocessor
+
+from .timing import timings
+
+
+# patterns for lines which need the whole document to be considered
+_fence_re = re.compile(r"^(`{3,}|~{3,})")
+_html_re = re.compile(r"^<[A-Za-z/!?]")
+_continuation_re = re.compile(r"^(\s|>|:|[*+-]\s|\d+[.)]\s)")
+_footnote_def_re = re.compile(r"^ {0,3}\[\^([^\]]*)\]:")
+_footnote_ref_re = re.compile(r"\[\^([^\]]*)\](?!:)")
+_reference_def_re = re.compile(r"^ {0,3}\[([^\]]*)\]:")
+_abbr_def_re = re.compile(r"^\*\[([^\]]*)\] ?:")
+_bracket_re = re.compile(r"\[([^\[\]]*)\]")
+_footnote_number_re = re.compile(r'(<a class="footnote-ref" href="#fn:([^"]*)">)\d+(</a>)')
+
+
+def split_blocks(content_md):
+    """
+    Split markdown content into top-level blocks which render the same on their own as they
+    do as part of the whole document.
+
+    #### Args
+    content_md (str)
+    :    Markdown content to split
+
+    #### Returns
+    list[str] or None
+    :    Markdown for each block, or None if the document can't be split (e.g. it contains raw
+         HTML blocks, which can span blank lines)
+    dict
+    :    Document-wide definitions, with the keys "footnotes", "references" and "abbreviations"
+         each giving the definitions' markdown, plus "footnote_refs" giving the footnote
+         references in document order
+    """
+    # split into chunks of consecutive non-blank lines (keeping fenced code together)
+    chunks = []
+    chunk = []
+    fence = None
+    for line in content_md.split("\n"):
+        if fence is not None:
+            chunk.append(line)
+            if line.rstrip(" ") == fence:
+                fence = None
+            continue
+        if not line.strip():
+            if chunk:
+                chunks.append(chunk)
+            chunk = []
+            continue
+        if line[0] == "<" and _html_re.match(line):
+            return None, {}
+        if line[0] in "`~":
+            match = _fence_re.match(line)
+            if match:
+                fence = match.group(1)
+        chunk.append(line)
+    if chunk:
+        chunks.append(chunk)
+    # merge chunks which continue the one before (lists, indented content, quotes, etc.)
+    groups = []
+    ticks = 0
+    for chunk in chunks:
+        if groups and (ticks % 2 or _continuation_re.match(chunk[0])):
+            groups[-1].append(chunk)
+            # definitions can add to a definition list from before their term
+            if chunk[0].startswith(":") and len(groups) > 1:
+                term = groups.pop()
+                groups[-1] += term
+        else:
+            groups.append([chunk])
+        # keep track of code markers, as Markmoji toggles on any line containing them
+        if any("```" in line for line in chunk):
+            ticks += sum("```" in line for line in chunk)
+    # pull out document-wide definitions
+    blocks = []
+    defs = {
+        'footnotes': [],
+        'references': [],
+        'abbreviations': [],
+        'footnote_refs': [],
+    }
+    seen_refs = set()
+    for group in groups:
+        text = "\n\n".join("\n".join(chunk) for chunk in group)
+        # look for definitions
+        if "]:" in text or "] :" in text:
+            lines = text.split("\n")
+            # footnote definitions are rendered separately (along with any indented content)
+            if _footnote_def_re.match(lines[0]):
+                if any(not chunk[0][:1].isspace() for chunk in group[1:]):
+                    return None, {}
+                # unindented lines can end the definition (e.g. a heading) or turn it into
+                # something else (e.g. a setext underline), so only lazy continuations are safe
+                # and even those are left to the whole document
+                if any(line[:1] not in (" ", "\t") for line in lines[1:]):
+                    return None, {}
+                defs['footnotes'].append(text)
+                continue
+            if any(_footnote_def_re.match(line) for line in lines):
+                return None, {}
+            # other definitions are collected, but left in place as they render to nothing
+            outside = []
+            fence = None
+            for line in lines:
+                if fence is None:
+                    match = _fence_re.match(line)
+                    if match:
+                        fence = match.group(1)
+                        code = [line]
+                    else:
+                        outside.append(line)
+                else:
+                    code.append(line)
+                    if line.rstrip(" ") == fence:
+                        fence = None
+            # a fence which never closes isn't code, so can't hide definitions
+            if fence is not None:
+                outside += code
+            found = []
+            for line in outside:
+                if _reference_def_re.match(line):
+                    defs['references'].append(line)
+                    found.append(line)
+                elif _abbr_def_re.match(line):
+                    defs['abbreviations'].append(line)
+                    found.append(line)
+            # definitions are taken out before the rest is parsed, joining whatever was
+            # around them (e.g. list items or code), and a setext underline can turn a
+            # definition into a heading, so only blocks of nothing but definitions are safe
+            if found and len(found) < len([line for line in lines if line.strip()]):
+                return None, {}
+        # note footnote references, which can't be repeated across blocks
+        if "[^" in text:
+            refs = _footnote_ref_re.findall(text)
+            if seen_refs.intersection(refs):
+                return None, {}
+            seen_refs.update(refs)
+            defs['footnote_refs'] += refs
+
+        blocks.append(text)
+    # the footnotes placeholder needs the whole document
+    if "///Footnotes Go Here///" in content_md:
+        return None, {}
+
+    return blocks, defs
+
+
+def _normalise_label(label):
+    """
+    Normalise a reference link label the way Python-Markdown does, so labels can be matched
+    with their definitions.
+    """
+    return " ".join(label.split()).lower()
+
+
+class BlockConverter:
+    """
+    Converts markdown to HTML block by block, caching the HTML for each block by a hash of
+    its content so that only blocks which have changed since the last conversion are
+    converted again. Definitions which apply to the whole document (footnotes, reference
+    links and abbreviations) are fed into each block which might use them.
+
+    When converting around a focus position (e.g. the cursor), blocks near it are converted
+    first and the rest are streamed in afterwards, in document order.
+
+    #### Args
+    maxsize (int)
+    :    Maximum number of blocks to keep cached HTML for
+
+    #### Attributes
+    focus_blocks (int)
+    :    Number of blocks either side of the focus to convert before anything else
+    stream_threshold (int)
+    :    Number of blocks which need converting before it's worth streaming them in
+    progress_interval (float)
+    :    Seconds between progress updates while streaming
+    md (markdown.Markdown)
+    :    Markdown interpreter used to convert each block
+    cache (collections.OrderedDict)
+    :    Cached (HTML, Markmoji classes used) for each block, by hash, least recently used first
+    """
+
+    class MarkmojiBlockPreprocessor(Preprocessor):
+        """
+        Same as `markmoji.Markmoji.MarkmojiPreprocessor`, except that the requirements for the
+        classes used are stored rather than prepended, so they can be added once for the
+        whole document.
+        """
+        def run(self, lines):
+            # Keep track of whether we're in a code block
+            inLiteral = False
+            # Iterate through lines
+            new_lines = []
+            self.md.classes_used = []
+            for line in lines:
+                # If code block opener is found, toggle literal
+                if "```" in line:
+                    inLiteral = not inLiteral
+                if not inLiteral:
+                    # Process markmoji syntax on line
+                    line, cls = markmoji.markmoji(line)
+                    self.md.classes_used += cls
+                new_lines.append(line)
+
+            return new_lines
+
+    focus_blocks = 40
+    stream_threshold = 200
+    progress_interval = 0.1
+
+    def __init__(self, maxsize=16384):
+        self.maxsize = maxsize
+        # setup interpreter
+        self.md = markdown.Markdown(
+            extensions=["extra", markmoji.Markmoji()]
+        )
+        self.md.preprocessors.register(self.MarkmojiBlockPreprocessor(self.md), 'markmoji', 175)
+        # setup cache
+        self.cache = OrderedDict()
+
+    def convert(self, content_md):
+        """
+        Convert markdown content to HTML, reusing HTML for any blocks converted before.
+
+        #### Args
+        content_md (str)
+        :    Markdown content to convert
+        """
+        return "\n".join(self.convert_fragments(content_md))
+
+    def convert_fragments(self, content_md, focus=None, progress=None):
+        """
+        Convert markdown content to a list of HTML fragments (Markmoji requirements, then each
+        block in order, then footnotes) which join to make the full HTML.
+
+        #### Args
+        content_md (str)
+        :    Markdown content to convert
+        focus (int, optional)
+        :    Line (e.g. the cursor's) to convert around first
+        progress (callable, optional)
+        :    If given along with `focus`, and enough of the document needs converting, this is
+             called with partial lists of fragments (with placeholders for blocks not yet
+             converted): first once the blocks around the focus are converted, then regularly
+             as the rest are. If it returns False, converting stops and None is returned.
+        """
+        blocks, defs = split_blocks(content_md)
+        # if the document can't be split, convert it in one go
+        if blocks is None:
+            content_html, classes_used = self.convert_block(content_md, part="all")
+            return self.get_requirements(classes_used) + [content_html]
+        # index definitions by the label they're used by (a group of footnotes can define more
+        # than one)
+        footnotes = {}
+        for text in defs['footnotes']:
+            for line in text.split("\n"):
+                match = _footnote_def_re.match(line)
+                if match:
+                    label = match.group(1)
+                    footnotes[label] = line
+                else:
+                    footnotes[label] += "\n" + line
+        references = {}
+        for line in defs['references']:
+            references.setdefault(_normalise_label(_reference_def_re.match(line).group(1)), []).append(line)
+        abbreviations = [
+            (_abbr_def_re.match(line).group(1), line) for line in defs['abbreviations']
+        ]
+        # footnotes are numbered in the order they're defined
+        numbers = {label: str(i + 1) for i, label in enumerate(footnotes)}
+        def definitions(text):
+            # get the reference link and abbreviation definitions used in some markdown
+            context = [line for term, line in abbreviations if term in text]
+            if "[" in text:
+                for label in _bracket_re.findall(text):
+                    context += references.get(_normalise_label(label), [])
+            return context
+
+        # work out which definitions each block needs
+        contexts = []
+        for block in blocks:
+            # give the block only the definitions it uses, so its HTML stays cached until one
+            # of those changes (and converting it doesn't mean converting every definition)
+            context = definitions(block)
+            if "[^" in block:
+                for label in _footnote_ref_re.findall(block):
+                    if label in footnotes:
+                        context.append(footnotes[label])
+            contexts.append("\n\n".join(context))
+        # convert each block
+        output = [None] * len(blocks)
+        classes_used = set()
+
+        def convert(i, cached_only=False):
+            block = blocks[i]
+            value = self.convert_block(block, contexts[i], part="body", cached_only=cached_only)
+            if value is None:
+                return
+            content_html, classes = value
+            # number footnote references by their position in the whole document
+            if "[^" in block:
+                content_html = _footnote_number_re.sub(
+                    lambda m: m.group(1) + numbers.get(unescape(m.group(2)), "0") + m.group(3),
+                    content_html
+                )
+            output[i] = content_html
+            classes_used.update(classes)
+
+        order = range(len(blocks))
+        if focus is not None and progress is not None and len(blocks) > self.stream_threshold:
+            # convert blocks around the focus, and take any others which are already cached
+            first = self.find_block(content_md, blocks, focus)
+            lo, hi = max(first - self.focus_blocks, 0), min(first + self.focus_blocks + 1, len(blocks))
+            for i in range(len(blocks)):
+                convert(i, cached_only=not lo <= i < hi)
+            order = [i for i, html in enumerate(output) if html is None]
+            # if there's a lot left, show what's done so far and stream in the rest
+            if len(order) > self.stream_threshold:
+                if progress(self.partial_fragments(blocks, output, classes_used)) is False:
+                    return None
+                deadline = time.perf_counter() + self.progress_interval
+                for i in order:
+                    convert(i)
+                    if time.perf_counter() > deadline:
+                        if progress(self.partial_fragments(blocks, output, classes_used)) is False:
+                            return None
+                        deadline = time.perf_counter() + self.progress_interval
+                order = []
+        for i in order:
+            convert(i)
+        # convert footnotes (with each reference, so that backlinks match, and the definitions
+        # they use)
+        if footnotes:
+            refs = " ".join(f"[^{ref}]" for ref in defs['footnote_refs'])
+            bodies = "\n\n".join(footnotes.values())
+            content_html, classes = self.convert_block(
+                refs, "\n\n".join([bodies] + definitions(bodies)), part="footnotes"
+            )
+            output.append(content_html)
+            classes_used.update(classes)
+
+        return self.get_requirements(classes_used) + [html for html in output if html]
+
+    @staticmethod
+    def find_block(content_md, blocks, line):
+        """
+        Find the index of the block containing (or nearest after) the given line of the markdown.
+        """
+        pos = 0
+        line_at = 0
+        for i, block in enumerate(blocks):
+            # find where the block starts, and count lines up to there
+            start = content_md.find(block.partition("\n")[0], pos)
+            if start < 0:
+                continue
+            line_at += content_md.count("\n", pos, start)
+            pos = start
+            # stop once the block ends after the line
+            if line_at + block.count("\n") >= line:
+                return i
+
+        return len(blocks) - 1
+
+    def partial_fragments(self, blocks, output, classes_used):
+        """
+        Get fragments for a partly converted document, with a placeholder (of roughly the right
+        height, so content doesn't jump around as it fills in) for each run of blocks not yet
+        converted.
+        """
+        fragments = self.get_requirements(classes_used)
+        pending = 0
+        for block, content_html in zip(blocks, output):
+            if content_html is None:
+                # roughly a line per line of markdown, plus a gap between blocks
+                pending += 1.5 * (block.count("\n") + 1) + 1
+                continue
+            if pending:
+                fragments.append(f'<div class="markmoji-pending" style="height: {pending:.0f}em"></div>')
+                pending = 0
+            if content_html:
+                fragments.append(content_html)
+        if pending:
+            fragments.append(f'<div class="markmoji-pending" style="height: {pending:.0f}em"></div>')
+
+        return fragments
+
+    @staticmethod
+    def get_requirements(classes_used):
+        """
+        Get a list containing one fragment with the requirements for the given Markmoji
+        classes, or an empty list if they have none.
+        """
+        prefix = []
+        for cls in sorted(classes_used, key=lambda cls: cls.__name__):
+            if cls.requirements:
+                prefix.append(cls.requirements)
+        if not prefix:
+            return []
+
+        return ["\n".join(prefix)]
+
+    def convert_block(self, block, context="", part="all", cached_only=False):
+        """
+        Convert a single block of markdown to HTML, or get it from the cache if it's been
+        converted before.
+
+        #### Args
+        block (str)
+        :    Markdown content of the block
+        context (str)
+        :    Definitions to convert the block alongside
+        part (str)
+        :    Part of the converted HTML to return: "body" for everything but the footnotes
+             section, "footnotes" for just the footnotes section or "all" for everything
+        cached_only (bool)
+        :    Only get the block from the cache, returning None if it isn't there
+
+        #### Returns
+        str
+        :    Converted HTML
+        set
+        :    Markmoji classes used in the block
+        """
+        # get hash
+        key = hashlib.blake2b(
+            f"{part}\0{block}\0{context}".encode("utf-8"), digest_size=16
+        ).digest()
+        # use cached value if there is one
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        if cached_only:
+            return None
+        # convert
+        self.md.reset()
+        content_html = self.md.convert(f"{block}\n\n{context}")
+        # split off footnotes section
+        if part != "all":
+            i = content_html.rfind('<div class="footnote">')
+            if i < 0:
+                i = len(content_html)
+            if part == "footnotes":
+                content_html = content_html[i:]
+            else:
+                content_html = content_html[:i].rstrip("\n")
+        # store in cache
+        self.cache[key] = value = (content_html, set(self.md.classes_used))
+        if len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+
+        return value
+
+
+
+def make_page(content_html, css="", title=""):
+    """
+    Wrap converted HTML in a complete, standalone HTML document.
+
+    #### Args
+    content_html (str)
+    :    Converted HTML for the page body
+    css (str)
+    :    CSS to style the page with (e.g. a viewer theme's CSS)
+    title (str)
+    :    Title of the page
+
+    #### Returns
+    str
+    :    HTML document
+    """
+    return (
+        f"<!DOCTYPE html>\n"
+        f"<html>\n"
+        f"<head>\n"
+        f"<meta charset=\"utf-8\">\n"
+        f"<title>{escape(title)}</title>\n"
+        f"<style>\n"
+        f"{css}\n"
+        f"</style>\n"
+        f"</head>\n"
+        f"<body>\n"
+        f"{content_html}\n"
+        f"</body>\n"
+        f"</html>\n"
+    )
+
+
+def _convert_in_process(conn):
+    """
+    Main loop of a ProcessConverter worker: receive markdown over the pipe and send back HTML
+    fragments, until None is received or the pipe is closed.
+    """
+    converter = BlockConverter()
+    while True:
+        try:
+            content_md = conn.recv()
+        except EOFError:
+            return
+        if content_md is None:
+            return
+        try:
+            conn.send((True, converter.convert_fragments(content_md)))
+        except Exception as err:
+            conn.send((False, "".join(traceback.format_exception(err))))
+
+
+class ProcessConverter:
+    """
+    Converts markdown to HTML in a pool of persistent worker processes, each running its own
+    BlockConverter (so the same extensions, and its own cache). Used for very large
+    documents, where converting in a thread would hold the GIL long enough to stall the GUI.
+    Workers are started when first needed, and restarted if they crash.
+
+    #### Args
+    processes (int)
+    :    Number of worker processes
+    """
+
+    class Worker:
+        """
+        A single worker process, and the pipe to talk to it over.
+        """
+        def __init__(self, context):
+            self.context = context
+            self.process = None
+            self.conn = None
+
+        def start(self):
+            self.conn, child_conn = self.context.Pipe()
+            self.process = self.context.Process(
+                target=_convert_in_process, args=(child_conn,), daemon=True
+            )
+            self.process.start()
+            child_conn.close()
+
+        def convert_fragments(self, content_md):
+            # start process if needed
+            if self.process is None or not self.process.is_alive():
+                self.start()
+            # send markdown and wait for HTML
+            self.conn.send(content_md)
+            success, value = self.conn.recv()
+            if not success:
+                raise RuntimeError(f"Error in render process:\n{value}")
+
+            return value
+
+        def close(self):
+            if self.process is None:
+                return
+            try:
+                self.conn.send(None)
+            except OSError:
+                pass
+            self.process.join(timeout=1)
+            if self.process.is_alive():
+                self.process.terminate()
+            self.conn.close()
+            self.process = None
+
+    def __init__(self, processes=1):
+        # spawn rather than fork, as forking a process with Qt threads running isn't safe
+        context = multiprocessing.get_context("spawn")
+        self.workers = [self.Worker(context) for n in range(processes)]
+        self._closed = False
+        # queue of idle workers
+        self._idle = queue.Queue()
+        for worker in self.workers:
+            self._idle.put(worker)
+
+    def convert_fragments(self, content_md):
+        """
+        Convert markdown content to a list of HTML fragments in the next free worker process.
+
+        #### Args
+        content_md (str)
+        :    Markdown content to convert
+        """
+        worker = self._idle.get()
+        try:
+            try:
+                return worker.convert_fragments(content_md)
+            except (EOFError, OSError):
+                if self._closed:
+                    raise
+                # worker crashed, so restart it and try again
+                worker.close()
+                return worker.convert_fragments(content_md)
+        finally:
+            self._idle.put(worker)
+
+    def close(self):
+        """
+        Stop all worker processes.
+        """
+        self._closed = True
+        for worker in self.workers:
+            worker.close()
+
+
+class RenderCache:
+    """
+    Rendered HTML fragments for whole documents, by a hash of their markdown, so returning to an
+    earlier state of a document (e.g. by undoing, redoing or pasting back) doesn't need
+    converting again. The cache is bounded by the memory its fragments take up, dropping the
+    least recently used documents first.
+
+    #### Args
+    max_bytes (int)
+    :    Maximum memory (in bytes) which cached fragments can take up
+
+    #### Attributes
+    size (int)
+    :    Memory (in bytes) currently taken up by cached fragments
+    hits (int)
+    :    Number of lookups which found a cached result
+    misses (int)
+    :    Number of lookups which didn't
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # (fragments, size) for each document, by hash, least recently used first
+        self.entries = OrderedDict()
+        # stats can be read from the GUI thread while the worker thread uses the cache
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(content_md):
+        """
+        Get the key to cache a document under.
+        """
+        return hashlib.blake2b(content_md.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+    def get(self, key):
+        """
+        Get cached fragments for a document, or None if there aren't any.
+        """
+        with self._lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def put(self, key, fragments):
+        """
+        Cache fragments for a document, dropping the least recently used documents if needed.
+        """
+        size = sum(sys.getsizeof(fragment) for fragment in fragments)
+        # don't cache documents which would push everything else out
+        if size > self.max_bytes // 4:
+            return
+        with self._lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (fragments, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, dropped) = self.entries.popitem(last=False)
+                self.size -= dropped
+
+    def clear(self):
+        """
+        Drop all cached documents (counters are kept).
+        """
+        with self._lock:
+            self.entries = OrderedDict()
+            self.size = 0
+
+    def stats(self):
+        """
+        Get the number of hits, misses and documents cached, and the memory they take up.
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'documents': len(self.entries),
+                'bytes': self.size,
+            }
+
+
+class RenderPool:
+    """
+    Converts markdown to HTML on a background thread shared by every window, so there's only
+    one converter (and one cache of converted blocks) however many documents are open. Requests
+    from each RenderScheduler are coalesced, so only the most recent text from each is converted,
+    and each is converted once typing in its window has settled.
+
+    #### Args
+    process_threshold (int)
+    :    Documents longer than this many characters are converted in separate processes (see
+         ProcessConverter) rather than on the worker thread
+
+    #### Attributes
+    cache (RenderCache)
+    :    Fragments for documents converted before
+    """
+    def __init__(self, process_threshold=2_000_000):
+        self.process_threshold = process_threshold
+        # setup interpreter (only used from the worker thread)
+        self.converter = BlockConverter()
+        self.cache = RenderCache()
+        # process converter for very large documents is started when first needed
+        self.process_converter = None
+        # latest request from each scheduler, as (generation, markdown, focus, time requested)
+        self._pending = {}
+        self._running = True
+        self._condition = threading.Condition()
+        # start worker
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._thread.start()
+
+    def request(self, scheduler, generation, content_md, focus=None):
+        """
+        Request that the given markdown be rendered for a scheduler, replacing any request from
+        it not yet started.
+        """
+        with self._condition:
+            self._pending[scheduler] = (generation, content_md, focus, time.monotonic())
+            self._condition.notify()
+
+    def cancel(self, scheduler):
+        """
+        Drop any request from a scheduler not yet started.
+        """
+        with self._condition:
+            self._pending.pop(scheduler, None)
+
+    def stop(self):
+        """
+        Stop the worker thread once any conversion in progress finishes.
+        """
+        with self._condition:
+            self._running = False
+            self._pending = {}
+            self._condition.notify()
+        # stop worker processes
+        if self.process_converter is not None:
+            self.process_converter.close()
+
+    def convert(self, content_md, focus=None, progress=None):
+        """
+        Convert markdown content to a list of HTML fragments, or to an error message if it
+        can't be parsed.
+
+        #### Args
+        content_md (str)
+        :    Markdown content to convert
+        focus (int, optional)
+        :    Line to convert around first (see `BlockConverter.convert_fragments`)
+        progress (callable, optional)
+        :    Called with partial fragments while converting (see
+             `BlockConverter.convert_fragments`), returning False to stop converting (in which
+             case None is returned)
+        """
+        try:
+            # reuse fragments if this document has been converted before (timed as a stage of
+            # its own, so quick hits don't skew the times for converting)
+            start = time.perf_counter()
+            key = self.cache.key(content_md)
+            fragments = self.cache.get(key)
+            if fragments is not None:
+                timings.record("convert_cached", start)
+                return fragments
+            with timings.span("convert"):
+                if len(content_md) > self.process_threshold:
+                    # convert very large documents out of process, so the GIL isn't held
+                    if self.process_converter is None:
+                        self.process_converter = ProcessConverter()
+                    fragments = self.process_converter.convert_fragments(content_md)
+                else:
+                    fragments = self.converter.convert_fragments(content_md, focus=focus, progress=progress)
+                    if fragments is None:
+                        return None
+                self.cache.put(key, fragments)
+        except Exception as err:
+            tb = "\n".join(traceback.format_exception(err))
+            fragments = [(
+                f"<h1>Error</h1>\n"
+                f"<p>Could not parse Markdown. Error from Python:</p>\n"
+                f"<pre><code>{tb}</code></pre>\n"
+                )]
+
+        return fragments
+
+    def _next(self):
+        """
+        Wait for the next request whose typing has settled (called with the lock held).
+        """
+        while True:
+            if not self._running:
+                return None
+            # find the request which was made longest ago, and how long until each is due
+            now = time.monotonic()
+            due = None
+            for scheduler, (generation, content_md, focus, requested) in self._pending.items():
+                wait = requested + scheduler.delay - now
+                if due is None or wait < due[0]:
+                    due = (wait, scheduler)
+            if due is None:
+                self._condition.wait()
+            elif due[0] > 0:
+                self._condition.wait(due[0])
+            else:
+                scheduler = due[1]
+                generation, content_md, focus, _ = self._pending.pop(scheduler)
+                return scheduler, generation, content_md, focus
+
+    def _work(self):
+        while True:
+            with self._condition:
+                request = self._next()
+            if request is None:
+                return
+            scheduler, generation, content_md, focus = request
+            # skip if a newer request has come in since
+            if not scheduler.is_current(generation):
+                continue
+            # convert (outside of the lock, so requests can keep coming in), handing back
+            # partial results as it goes
+            fragments = self.convert(
+                content_md, focus=focus,
+                progress=lambda fragments: self._partial(scheduler, generation, fragments)
+            )
+            if fragments is None:
+                continue
+            # hand result back (delivered on the scheduler's thread via a queued connection)
+            try:
+                scheduler.rendered.emit(generation, "\n".join(fragments), fragments)
+            except RuntimeError:
+                # scheduler was deleted while converting
+                pass
+
+
+    @staticmethod
+    def _partial(scheduler, generation, fragments):
+        # stop converting if a newer request has come in since
+        if not scheduler.is_current(generation):
+            return False
+        try:
+            scheduler.partial.emit(generation, fragments)
+        except RuntimeError:
+            # scheduler was deleted while converting
+            return False
+
+        return True
+
+
+class RenderScheduler(util.QObject):
+    """
+    Requests renders for one window from a RenderPool. Each result is tagged with the generation
+    of the text it came from, so that outdated results can be dropped.
+
+    #### Args
+    parent (qt.QObject)
+    :    Object which owns this scheduler (results are delivered on its thread)
+    pool (RenderPool)
+    :    Pool to render with (shared between windows)
+    delay (float)
+    :    Seconds to wait for further requests before starting a conversion
+
+    #### Attributes
+    generation (int)
+    :    Generation number of the most recently requested text
+    rendered (util.pyqtSignal)
+    :    Emitted with (generation, HTML, HTML fragments) when a conversion finishes
+    partial (util.pyqtSignal)
+    :    Emitted with (generation, HTML fragments) while a long conversion is underway, with
+         placeholders for the parts not yet converted
+    """
+    rendered = util.pyqtSignal(int, str, list)
+    partial = util.pyqtSignal(int, list)
+
+    def __init__(self, parent, pool, delay=0.03):
+        util.QObject.__init__(self, parent)
+        self.pool = pool
+        self.delay = delay
+        self.generation = 0
+
+    def request(self, content_md, focus=None):
+        """
+        Request that the given markdown be rendered, replacing any request not yet started.
+
+        #### Args
+        content_md (str)
+        :    Markdown content to render
+        focus (int, optional)
+        :    Line (e.g. the cursor's) to render around first, if rendering takes a while
+
+        #### Returns
+        int
+        :    Generation number which the result will be tagged with
+        """
+        self.generation += 1
+        self.pool.request(self, self.generation, content_md, focus=focus)
+
+        return self.generation
+
+    def is_current(self, generation):
+        """
+        Is the given generation the most recently requested one?
+        """
+        return generation == self.generation
+
+    def stop(self):
+        """
+        Drop any request not yet started (the pool carries on for other windows).
+        """
+        self.pool.cancel(self)
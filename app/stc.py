@@ -1,9 +1,65 @@
-import markmoji
+import time
 import pygments, pygments.lexers
 import PyQt5.QtCore as util
 import PyQt5.QtWidgets as qt
 import PyQt5.QtGui as gui
 
+from functools import lru_cache
+
+from .highlighter import PygmentsHighlighter
+from .completion import handler_index
+from .timing import timings
+
+
+@lru_cache(maxsize=None)
+def handler_menu(style):
+    """
+    Get the stylesheet for context menus and the "Insert Handler" submenu for an editor style,
+    made the first time they're needed for each style. Each action in the submenu has its
+    handler's emoji as its data.
+
+    #### Args
+    style (theme.theme.EditorStyle)
+    :    Editor style to theme the menu with
+
+    #### Returns
+    str
+    :    Stylesheet for context menus
+    qt.QMenu
+    :    Submenu with an action for each handler
+    """
+    spec = style.spec
+    stylesheet = (
+        f"QMenu::item{{"
+        f"   background-color: {spec.background_color};"
+        f"   color: #{spec.style_for_token(pygments.token.Token)['color']};"
+        f"   font-family: JetBrains Mono,Noto Emoji;"
+        f"}}"
+
+        f"QMenu::item:selected{{"
+        f"   background-color: {spec.line_number_background_color};"
+        f"   color: {spec.line_number_color};"
+        f"}}"
+    )
+    # make submenu
+    submenu = qt.QMenu("Insert &Handler")
+    submenu.setStyleSheet(stylesheet)
+    # add emojis
+    for emoji, cls in handler_index().handlers:
+        action = submenu.addAction(f"{emoji} {cls.__name__}")
+        action.setData(emoji)
+
+    return stylesheet, submenu
+
+
+@lru_cache(maxsize=None)
+def get_lexer(language):
+    """
+    Get a lexer for the given language, shared between all controls using it (lexers don't
+    keep any state between calls, so one instance can lex any number of documents).
+    """
+    return pygments.lexers.get_lexer_by_name(language)
+
 
 class StyledTextCtrl(qt.QTextEdit):
     def __init__(self, frame, language):
@@ -15,47 +71,34 @@ class StyledTextCtrl(qt.QTextEdit):
         # set minimum size
         self.setMinimumWidth(512)
         # setup lexer
-        self.lexer = pygments.lexers.get_lexer_by_name(language)
+        self.lexer = get_lexer(language)
+        # setup highlighter (restyles changed blocks as the text changes)
+        self.highlighter = PygmentsHighlighter(self, lexer=self.lexer)
         # setup right click
         self.setContextMenuPolicy(util.Qt.CustomContextMenu)
         self.customContextMenuRequested.connect(self.on_context_menu)
     
     def on_context_menu(self):
-        # setup menu style
-        style = self.app.theme.editor.spec
-        stylesheet = (
-            f"QMenu::item{{"
-            f"   background-color: {style.background_color};"
-            f"   color: #{style.style_for_token(pygments.token.Token)['color']};"
-            f"   font-family: JetBrains Mono,Noto Emoji;"
-            f"}}"
-
-            f"QMenu::item:selected{{"
-            f"   background-color: {style.line_number_background_color};"
-            f"   color: {style.line_number_color};"
-            f"}}"
-        )
+        # get menu style and handler submenu for the current theme
+        stylesheet, submenu = handler_menu(self.app.theme.editor)
         # make menu
         menu = self.createStandardContextMenu()
         menu.setStyleSheet(stylesheet)
         # add emoji section
         menu.addSeparator()
-        submenu = menu.addMenu("Insert &Handler")
-        submenu.setStyleSheet(stylesheet)
-        # add emojis
-        for emoji, cls in markmoji.handlers.map.items():
-            # skip base classes
-            if emoji in ("?", "〽️", "❓"):
-                continue
-            # add emoji
-            submenu.addAction(f"{emoji} {cls.__name__}", self.insert_emoji)
-            
+        menu.addMenu(submenu)
+        # actions chosen from the submenu are passed up to the menu it was opened from
+        menu.triggered.connect(self.on_menu_action)
+
         menu.exec_(gui.QCursor.pos())
-    
-    def insert_emoji(self, evt=None):
-        # get emoji
-        text = self.sender().text()
-        emoji = text.split(" ")[0]
+
+    def on_menu_action(self, action):
+        # insert emoji if a handler was chosen
+        emoji = action.data()
+        if isinstance(emoji, str):
+            self.insert_emoji(emoji)
+
+    def insert_emoji(self, emoji):
         # insert emoji
         self.insertPlainText(emoji + "[]()")
     
@@ -63,11 +106,11 @@ class StyledTextCtrl(qt.QTextEdit):
         """
         Apply pyments.style to text contents
         """
+        # start timing
+        start = time.perf_counter()
         # don't trigger any events while this method executes
         self.blockSignals(True)
 
-        # get cursor handle
-        cursor = gui.QTextCursor(self.document())
         # get style dict
         style = self.app.theme.editor.spec
         # set base style
@@ -77,28 +120,11 @@ class StyledTextCtrl(qt.QTextEdit):
             f"font-size: 10pt;"
             f"border: 1px solid {style.line_number_background_color};"
         )
-        # lex content to get tokens
-        tokens = pygments.lex(self.toPlainText(), lexer=self.lexer)
-        # re-add characters with styling
-        i = 0
-        for token, text in tokens:
-            # get style for this token
-            token_style = style.style_for_token(token)
-            # create format object
-            char_format = gui.QTextCharFormat()
-            char_format.setFontFamily("JetBrains Mono")
-            char_format.setFontItalic(token_style['italic'])
-            if token_style['bold']:
-                char_format.setFontWeight(600)
-            char_format.setFontUnderline(token_style['underline'])
-            char_format.setForeground(gui.QColor("#" + token_style['color']))
-            # select corresponding chars
-            cursor.setPosition(i)
-            cursor.movePosition(cursor.Right, n=len(text), mode=cursor.KeepAnchor)
-            # format selection
-            cursor.setCharFormat(char_format)
-            # move forward to next token
-            i += len(text)
+        # restyle all blocks from their existing tokens (edits are restyled by the highlighter
+        # as they happen)
+        self.highlighter.restyle()
 
         # allow signals to trigger again
-        self.blockSignals(False)
\ No newline at end of file
+        self.blockSignals(False)
+        # store time taken
+        timings.record("style_text", start)
@@ -0,0 +1,365 @@
+import os
+import json
+import queue
+import hashlib
+import tempfile
+import threading
+import PyQt5.QtCore as util
+
+from pathlib import Path
+
+from .timing import timings
+
+
+# folder to keep autosave journals in
+journal_folder = Path(
+    util.QStandardPaths.writableLocation(util.QStandardPaths.GenericDataLocation)
+) / "markmoji-editor" / "journal"
+
+
+# permissions for new files, read once as the umask can only be read by setting it
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+def atomic_write(filename, content):
+    """
+    Write text to a file such that the file is never left half written: the content is written
+    to a temporary file in the same folder, flushed to disk, then moved over the target.
+
+    #### Args
+    filename (pathlib.Path)
+    :    File to write to
+    content (str)
+    :    Text to write
+    """
+    # replace the file a symlink points to, rather than the symlink
+    filename = Path(filename).resolve()
+    fd, temp = tempfile.mkstemp(dir=filename.parent, prefix=f".{filename.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        # keep the permissions of the file being replaced
+        if filename.exists():
+            os.chmod(temp, filename.stat().st_mode & 0o7777)
+        else:
+            os.chmod(temp, 0o666 & ~_umask)
+        os.replace(temp, filename)
+    except BaseException:
+        try:
+            os.unlink(temp)
+        except OSError:
+            pass
+        raise
+    # make sure the rename itself is on disk
+    if hasattr(os, "O_DIRECTORY"):
+        dirfd = os.open(filename.parent, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dirfd)
+        except OSError:
+            pass
+        finally:
+            os.close(dirfd)
+
+
+def text_hash(content):
+    """
+    Get a short hash of some text, to check a file still has the content a journal started from.
+    """
+    return hashlib.blake2b(content.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def text_delta(old, new):
+    """
+    Get the smallest single replacement which turns one string into another.
+
+    #### Returns
+    tuple
+    :    (position, number of characters removed, text added)
+    """
+    # find common prefix (comparing slices, so the comparisons happen in C)
+    lo, hi = 0, min(len(old), len(new))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if old[lo:mid] == new[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    start = lo
+    # find common suffix (not overlapping the prefix)
+    lo, hi = 0, min(len(old), len(new)) - start
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if old[len(old) - mid:len(old) - lo] == new[len(new) - mid:len(new) - lo]:
+            lo = mid
+        else:
+            hi = mid - 1
+    end = lo
+
+    return start, len(old) - start - end, new[start:len(new) - end]
+
+
+class IOThread(util.QObject):
+    """
+    Runs file I/O jobs one at a time, in order, on a background thread, so slow disks (e.g.
+    network home folders) don't freeze the window.
+
+    #### Args
+    parent (qt.QObject)
+    :    Object which owns this thread (callbacks are called on its thread)
+    """
+    done = util.pyqtSignal(object, object)
+
+    def __init__(self, parent=None):
+        util.QObject.__init__(self, parent)
+        self._jobs = queue.Queue()
+        self.done.connect(self.on_done)
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._thread.start()
+
+    def submit(self, fcn, *args, callback=None):
+        """
+        Queue a job to run on the I/O thread.
+
+        #### Args
+        fcn (callable)
+        :    Function to run
+        args
+        :    Arguments to call the function with
+        callback (callable, optional)
+        :    Called (on this object's thread) once the job finishes, with the exception it raised
+             or None if it succeeded
+        """
+        self._jobs.put((fcn, args, callback))
+
+    def wait(self):
+        """
+        Block until every job queued so far has finished.
+        """
+        self._jobs.join()
+
+    def _work(self):
+        while True:
+            fcn, args, callback = self._jobs.get()
+            try:
+                fcn(*args)
+            except Exception as err:
+                error = err
+            else:
+                error = None
+            if callback is not None:
+                self.done.emit(callback, error)
+            self._jobs.task_done()
+
+    def on_done(self, callback, error):
+        callback(error)
+
+
+class Journal(util.QObject):
+    """
+    Autosave journal for a text control. Every so often, if the text has changed, a single
+    compact delta from the last journaled text is appended to a journal file (on the I/O
+    thread), so unsaved changes can be recovered if the app doesn't close properly. The journal
+    starts from the content of the file being edited (checked by hash when recovering), and is
+    compacted into a snapshot if it grows too large.
+
+    While the journal is open it holds a lock file, so journals left behind by a crash can be
+    told apart from those of other running windows.
+
+    #### Args
+    ctrl (qt.QTextEdit)
+    :    Control whose text to journal
+    io (IOThread)
+    :    Thread to do file I/O on
+    interval (int)
+    :    Milliseconds between autosaves
+    max_size (int)
+    :    Size in bytes the journal can grow to before it's compacted
+    folder (pathlib.Path)
+    :    Folder to keep the journal in
+    """
+    def __init__(self, ctrl, io, interval=5000, max_size=4 * 1024 * 1024, folder=journal_folder):
+        util.QObject.__init__(self, ctrl)
+        self.ctrl = ctrl
+        self.io = io
+        self.max_size = max_size
+        # pick a journal file and lock it
+        folder.mkdir(parents=True, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=folder, prefix="journal-", suffix=".jsonl")
+        os.close(fd)
+        self.path = Path(path)
+        self.lock = util.QLockFile(str(self.path) + ".lock")
+        self.lock.tryLock(0)
+        # text as of the last entry
+        self.filename = None
+        self._text = ""
+        self._size = 0
+        self._dirty = False
+        ctrl.textChanged.connect(self.on_text)
+        # autosave regularly
+        self.timer = util.QTimer(self)
+        self.timer.setInterval(interval)
+        self.timer.timeout.connect(self.flush)
+        self.timer.start()
+
+    def on_text(self, evt=None):
+        self._dirty = True
+
+    def start(self, filename, content):
+        """
+        Start the journal again from the given file and its content (e.g. once a file is opened
+        or saved).
+
+        #### Args
+        filename (pathlib.Path, optional)
+        :    File being edited, or None if it's untitled
+        content (str)
+        :    Content of the file
+        """
+        self.filename = filename
+        self._text = content
+        self._dirty = False
+        self._size = 0
+        self.io.submit(self._write_header, self.path, filename, content, False)
+
+    def save(self, filename, content, callback=None):
+        """
+        Save content to a file on the I/O thread (see `atomic_write`), starting the journal
+        again from it once it's written. Changes made meanwhile are journaled after it.
+
+        #### Args
+        filename (pathlib.Path)
+        :    File to save to
+        content (str)
+        :    Content to save (should be the control's current text)
+        callback (callable, optional)
+        :    Called once saving finishes, with the exception raised or None if it succeeded
+        """
+        # bring the journal up to date, so it's consistent whether or not the save succeeds
+        self.flush()
+        self.filename = filename
+        self._text = content
+        self._size = 0
+        self.io.submit(self._save, self.path, filename, content, callback=callback)
+
+    def flush(self):
+        """
+        Append the change since the last entry to the journal, if there is one.
+        """
+        if not self._dirty:
+            return
+        self._dirty = False
+        content = self.ctrl.toPlainText()
+        if content == self._text:
+            return
+        # compact into a snapshot if the journal's getting large
+        if self._size > self.max_size:
+            self._text = content
+            self._size = 0
+            self.io.submit(self._write_header, self.path, self.filename, content, True)
+            return
+        # append delta
+        position, removed, added = text_delta(self._text, content)
+        line = json.dumps({'p': position, 'r': removed, 't': added}, ensure_ascii=False) + "\n"
+        self._text = content
+        self._size += len(line)
+        self.io.submit(self._append, self.path, line)
+
+    def close(self):
+        """
+        Stop journaling and remove the journal (once any queued writes are done).
+        """
+        self.timer.stop()
+        self.io.submit(self._remove, self.path, self.lock)
+
+    @staticmethod
+    def _write_header(path, filename, content, snapshot):
+        with timings.span("journal"):
+            header = {
+                'file': None if filename is None else str(filename),
+                'hash': text_hash(content),
+            }
+            # without a file to start from, the content itself is needed
+            if snapshot or filename is None:
+                header['snapshot'] = content
+            atomic_write(path, json.dumps(header, ensure_ascii=False) + "\n")
+
+    @staticmethod
+    def _save(path, filename, content):
+        with timings.span("save"):
+            atomic_write(filename, content)
+        Journal._write_header(path, filename, content, False)
+
+    @staticmethod
+    def _append(path, line):
+        with timings.span("journal"):
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(line)
+
+    @staticmethod
+    def _remove(path, lock):
+        path.unlink(missing_ok=True)
+        lock.unlock()
+
+
+def find_orphans(folder=journal_folder):
+    """
+    Find journals left behind by windows which didn't close properly (i.e. whose lock isn't
+    held by a running process).
+
+    #### Returns
+    list[tuple]
+    :    (path to journal, util.QLockFile now held by this process) for each journal found
+    """
+    orphans = []
+    for path in sorted(folder.glob("journal-*.jsonl")):
+        lock = util.QLockFile(str(path) + ".lock")
+        if lock.tryLock(0):
+            orphans.append((path, lock))
+
+    return orphans
+
+
+def recover(path):
+    """
+    Rebuild text from a journal.
+
+    #### Returns
+    pathlib.Path or None
+    :    File which was being edited (None if it was untitled)
+    str
+    :    Content of the file when the journal started
+    str or None
+    :    Content with all journaled changes applied, or None if the journal can't be used (e.g.
+         the file has changed since)
+    """
+    # entries are split on "\n" only, as text in them can contain other line breaks
+    with open(path, encoding="utf-8", newline="") as f:
+        lines = f.read().split("\n")
+    if not lines[0]:
+        return None, "", None
+    header = json.loads(lines[0])
+    filename = None if header['file'] is None else Path(header['file'])
+    # get the content the journal started from
+    if 'snapshot' in header:
+        base = header['snapshot']
+    else:
+        try:
+            base = filename.read_text(encoding="utf-8")
+        except OSError:
+            return filename, "", None
+    if text_hash(base) != header['hash']:
+        return filename, base, None
+    # apply changes
+    content = base
+    for line in lines[1:]:
+        try:
+            delta = json.loads(line)
+        except ValueError:
+            # last line may be partly written
+            break
+        content = content[:delta['p']] + delta['t'] + content[delta['p'] + delta['r']:]
+
+    return filename, base, content
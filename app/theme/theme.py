@@ -1,7 +1,10 @@
+import ast
+import json
 import importlib
 from pathlib import Path
 
-from PyQt5.QtGui import QPalette
+from PyQt5.QtCore import QStandardPaths
+from PyQt5.QtGui import QPalette, QTextCharFormat, QFont, QColor
 from pygments.style import Style as PygmentsStyle
 
 
@@ -22,7 +25,7 @@ class ViewerStyle:
     path (pathlib.Path)
     :    Path to the CSS file used to style the HTML preview
     spec (str)
-    :    Loaded CSS style string
+    :    Loaded CSS style string (read the first time it's needed)
     """
     def __init__(self, stem):
         # store stem
@@ -39,8 +42,61 @@ class ViewerStyle:
         assert self.path.is_file(), (
             f"Could not find file for viewer style '{self.stem}'"
         )
-        # read style file
-        self.spec = self.path.read_text(encoding="utf-8")
+        # style file is read on first use
+        self._spec = None
+
+    @property
+    def spec(self):
+        if self._spec is None:
+            self._spec = self.path.read_text(encoding="utf-8")
+
+        return self._spec
+
+
+class TokenFormats(dict):
+    """
+    Table of ready-made text formats for each pygments token type in a style. Formats for
+    token types not in the style are worked out from their nearest parent type the first
+    time they're asked for, so looking up a format is just a dict lookup.
+
+    #### Args
+    style (pygments.style.Style)
+    :    Pygments style to make formats from
+    """
+    def __init__(self, style):
+        dict.__init__(self)
+        self.style = style
+        # compile every token type the style knows about
+        for ttype, _ in style:
+            self[ttype] = self.make_format(ttype)
+
+    def __missing__(self, ttype):
+        # use the parent token's format (or make one if this is a root token)
+        if ttype.parent is not None:
+            char_format = self[ttype.parent]
+        else:
+            char_format = self.make_format(ttype)
+        self[ttype] = char_format
+
+        return char_format
+
+    def make_format(self, ttype):
+        """
+        Create a text format for the given token type.
+        """
+        token_style = self.style.style_for_token(ttype)
+        # create format object (setting only these font properties, so the rest, e.g. size, come
+        # from the ctrl)
+        char_format = QTextCharFormat()
+        char_format.setFontFamily("JetBrains Mono")
+        char_format.setFontItalic(token_style['italic'])
+        if token_style['bold']:
+            char_format.setFontWeight(QFont.DemiBold)
+        char_format.setFontUnderline(token_style['underline'])
+        if token_style['color']:
+            char_format.setForeground(QColor("#" + token_style['color']))
+
+        return char_format
 
 
 class EditorStyle:
@@ -58,6 +114,8 @@ class EditorStyle:
     :    Import path (from the "editor" folder) to the subclass of pygments.Style for the editor's colours, e.g. `catppuccin.latte`.
     spec (str)
     :    Loaded pygments.Style object
+    formats (TokenFormats)
+    :    Text formats for each token type in the style, compiled the first time they're needed
     """    
     def __init__(self, stem):
         # store stem
@@ -72,6 +130,18 @@ class EditorStyle:
         package = importlib.import_module(f".app.theme.editor.{package_name}", package="markmoji_editor")
         # get spec
         self.spec = getattr(package, variable)
+        # formats are compiled on first use
+        self._formats = None
+    
+    @property
+    def formats(self):
+        """
+        TokenFormats object for the editor's style, shared by all editors using this theme.
+        """
+        if self._formats is None:
+            self._formats = TokenFormats(self.spec)
+        
+        return self._formats
 
 
 class AppStyle:
@@ -138,7 +208,7 @@ class Theme:
     
     @viewer.setter
     def viewer(self, value):
-        self._viewer = ViewerStyle(value)
+        self._viewer = registry.get_style("viewer", value)
     
     @property
     def editor(self):
@@ -149,7 +219,7 @@ class Theme:
     
     @editor.setter
     def editor(self, value):
-        self._editor = EditorStyle(value)
+        self._editor = registry.get_style("editor", value)
     
     @property
     def app(self):
@@ -160,99 +230,160 @@ class Theme:
     
     @app.setter
     def app(self, value):
-        self._app = AppStyle(value)
+        self._app = registry.get_style("app", value)
 
 
-def get_all_themes():
-    from PyQt5.QtGui import QPalette
-    from pygments.style import Style
+class ThemeRegistry:
+    """
+    Index of the available themes, built the first time it's needed and then kept for the
+    rest of the process. Theme names are read from each theme file without importing it, and
+    can be saved to an index file (keyed by each file's modification time) so that later runs
+    only need to check which files have changed. Style objects are made when first asked for
+    and then reused, so switching back to a theme doesn't load it again.
+
+    #### Args
+    index (pathlib.Path, optional)
+    :    File to save the index to between runs, or None to not save it
+
+    #### Attributes
+    themes (dict)
+    :    Names of themes by type ("app", "editor" or "viewer") then by set, e.g.
+         `themes['editor']['catppuccin']` is `["frappe", "latte", "macchiato", "mocha"]`
+    combi_themes (dict)
+    :    Names of themes by set, for only themes present for every type
+    """
+    # class used for each type of style
+    styles = {
+        'app': AppStyle,
+        'editor': EditorStyle,
+        'viewer': ViewerStyle,
+    }
+
+    def __init__(self, index=None):
+        self.index = index
+        self._themes = None
+        self._combi_themes = None
+        self._styles = {}
+
+    @property
+    def themes(self):
+        if self._themes is None:
+            self._themes = self.scan()
+
+        return self._themes
+
+    @property
+    def combi_themes(self):
+        if self._combi_themes is None:
+            themes = self.themes
+            self._combi_themes = {}
+            for this_set in themes['app']:
+                # skip sets not present for every type
+                if this_set not in themes['editor'] or this_set not in themes['viewer']:
+                    continue
+                # keep themes present for every type
+                self._combi_themes[this_set] = [
+                    this_theme for this_theme in themes['app'][this_set]
+                    if this_theme in themes['editor'][this_set]
+                    and this_theme in themes['viewer'][this_set]
+                ]
 
-    def get_modules(module, cls):
+        return self._combi_themes
+
+    def get_style(self, target, stem):
         """
-        Get the spec objects for the given module (editor or app) which match the given class
+        Get the style object for a theme, making it if this is the first time it's been asked
+        for.
+
+        #### Args
+        target (str)
+        :    Type of style, one of "app", "editor" or "viewer"
+        stem (str)
+        :    Name of the theme, e.g. `catppuccin.latte`
         """
-        themes = {}
-        # import folder as package
-        pkg = importlib.import_module(f".app.theme.{module}", package="markmoji_editor")
-        # iterate through names
-        for name in dir(pkg):
-            # skip private names
-            if name.startswith("_"):
-                continue
-            # get names from __all__
-            themes[name] = getattr(pkg, name).__all__
-        
-        return themes
-    
-    def get_files(folder, ext):
-        themes = {}
-        # iterate through subfolders
-        for subfolder in folder.glob("*/"):
-            # add key to dict
-            themes[subfolder.stem] = []
-            # iterate through theme files
-            for file in subfolder.glob(f"*.{ext}"):
-                # add its name to dict
-                themes[subfolder.stem].append(file.stem)
-        
+        key = (target, stem)
+        if key not in self._styles:
+            self._styles[key] = self.styles[target](stem)
+
+        return self._styles[key]
+
+    def scan(self):
+        """
+        Find all available themes, using the saved index for any files which haven't changed.
+        """
+        # load saved index
+        entries = {}
+        if self.index is not None:
+            try:
+                entries = json.loads(self.index.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                entries = {}
+        # get names from each file (or folder, for viewer styles)
+        themes = {'app': {}, 'editor': {}, 'viewer': {}}
+        found = {}
+        for target in themes:
+            folder = __folder__ / target
+            if target == "viewer":
+                # viewer themes are CSS files in a subfolder for each set
+                paths = sorted(path for path in folder.glob("*/") if path.is_dir())
+            else:
+                # app and editor themes are names in a Python file for each set
+                paths = sorted(path for path in folder.glob("*.py") if not path.stem.startswith("_"))
+            for path in paths:
+                key = path.relative_to(__folder__).as_posix()
+                mtime = path.stat().st_mtime
+                entry = entries.get(key)
+                # read names again if file has changed
+                if entry is None or entry['mtime'] != mtime:
+                    entry = {'mtime': mtime, 'names': self.read_names(path)}
+                found[key] = entry
+                # skip sets with no themes
+                if entry['names']:
+                    themes[target][path.stem] = entry['names']
+        # save index if anything changed
+        if self.index is not None and found != entries:
+            try:
+                self.index.parent.mkdir(parents=True, exist_ok=True)
+                self.index.write_text(json.dumps(found), encoding="utf-8")
+            except OSError:
+                pass
+
         return themes
 
+    @staticmethod
+    def read_names(path):
+        """
+        Get the names of themes in a theme file (from its `__all__`, without importing it) or in
+        a folder of CSS files.
+        """
+        if path.is_dir():
+            return sorted(file.stem for file in path.glob("*.css"))
+        # find __all__
+        tree = ast.parse(path.read_text(encoding="utf-8"))
+        for node in tree.body:
+            if isinstance(node, ast.Assign) and any(
+                isinstance(target, ast.Name) and target.id == "__all__" for target in node.targets
+            ):
+                return list(ast.literal_eval(node.value))
 
-    themes = {}
-    # get app themes
-    themes['app'] = get_modules("app", QPalette)
-    # get editor themes
-    themes['editor'] = get_modules("editor", Style)
-    # get viewer themes
-    themes['viewer'] = get_files(__folder__ / "viewer", "css")
+        return []
 
-    return themes
+
+def get_all_themes():
+    """
+    Get the names of all available themes, by type ("app", "editor" or "viewer") then by set
+    """
+    return registry.themes
 
 
 def get_combi_themes():
     """
     Get themes dict for only items present across all types (app, editor and viewer)
     """
-    themes = get_all_themes()
-    # split all sets by target
-    app_sets = list(themes['app'])
-    editor_sets = list(themes['editor'])
-    viewer_sets = list(themes['viewer'])
-    # get list of unique set names
-    all_sets = list(set(app_sets + editor_sets + viewer_sets))
-    combi_sets = []
-    for this_set in all_sets:
-        # where is it present?
-        present_in = (
-            this_set in app_sets, 
-            this_set in editor_sets, 
-            this_set in viewer_sets
-        )
-        # if present in all, add to combi sets
-        if all(present_in):
-            combi_sets.append(this_set)
-    
-    # iterate through combi sets
-    combi_themes = {}
-    for this_set in combi_sets:
-        app_themes = themes['app'][this_set]
-        editor_themes = themes['editor'][this_set]
-        viewer_themes = themes['viewer'][this_set]
-        # get list of unique theme names
-        all_themes = list(set(app_themes + editor_themes + viewer_themes))
-        combi_themes[this_set] = []
-        for this_theme in all_themes:
-            # where is it present?
-            present_in = (
-                this_theme in app_themes,
-                this_theme in editor_themes,
-                this_theme in viewer_themes
-            )
-            # if present in all, add to combi themes
-            if all(present_in):
-                combi_themes[this_set].append(this_theme)
-    
-    return combi_themes
+    return registry.combi_themes
 
 
+# themes are indexed once per process, with the index saved in the user's cache folder
+_cache_folder = Path(QStandardPaths.writableLocation(QStandardPaths.GenericCacheLocation))
+registry = ThemeRegistry(index=_cache_folder / "markmoji-editor" / "themes.json")
 current = Theme()
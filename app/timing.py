@@ -0,0 +1,205 @@
+import json
+import time
+import threading
+import PyQt5.QtCore as util
+import PyQt5.QtWidgets as qt
+
+from collections import deque
+from contextlib import contextmanager
+
+
+class Timings:
+    """
+    Keeps a bounded record of how long each stage of the render pipeline takes, from keystroke
+    to pixels.
+
+    #### Args
+    maxlen (int)
+    :    Number of spans to keep for each stage (older spans are dropped)
+
+    #### Attributes
+    spans (dict[str, collections.deque])
+    :    Ring buffer of (wall clock time, duration in seconds) pairs for each stage
+    """
+    def __init__(self, maxlen=256):
+        self.maxlen = maxlen
+        self.spans = {}
+        # spans can be recorded from the render thread as well as the GUI thread
+        self._lock = threading.Lock()
+
+    def record(self, stage, start, end=None):
+        """
+        Record a span for the given stage.
+
+        #### Args
+        stage (str)
+        :    Name of the stage
+        start (float)
+        :    Value of `time.perf_counter()` when the stage started
+        end (float, optional)
+        :    Value of `time.perf_counter()` when the stage ended, if None then now
+        """
+        if end is None:
+            end = time.perf_counter()
+        dur = end - start
+        with self._lock:
+            if stage not in self.spans:
+                self.spans[stage] = deque(maxlen=self.maxlen)
+            self.spans[stage].append((time.time() - dur, dur))
+
+    @contextmanager
+    def span(self, stage):
+        """
+        Context manager which records how long its body takes as a span for the given stage.
+
+        #### Args
+        stage (str)
+        :    Name of the stage
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, start)
+
+    def stats(self):
+        """
+        Get summary statistics for each stage.
+
+        #### Returns
+        dict[str, dict]
+        :    For each stage, a dict with the number of spans kept ("count") and the "p50",
+             "p95" and "max" durations (in seconds)
+        """
+        with self._lock:
+            spans = {stage: [dur for _, dur in values] for stage, values in self.spans.items()}
+        # calculate stats
+        stats = {}
+        for stage, durs in spans.items():
+            durs.sort()
+            stats[stage] = {
+                'count': len(durs),
+                'p50': durs[round(0.5 * (len(durs) - 1))],
+                'p95': durs[round(0.95 * (len(durs) - 1))],
+                'max': durs[-1],
+            }
+
+        return stats
+
+    def to_json(self, extra=None):
+        """
+        Get stats and all spans currently kept as a JSON string.
+
+        #### Args
+        extra (dict, optional)
+        :    Anything else to include (e.g. cache counters)
+        """
+        with self._lock:
+            spans = {
+                stage: [{'time': t, 'dur': dur} for t, dur in values]
+                for stage, values in self.spans.items()
+            }
+
+        return json.dumps({'stats': self.stats(), 'spans': spans, **(extra or {})}, indent=2)
+
+    def clear(self):
+        """
+        Drop all spans.
+        """
+        with self._lock:
+            self.spans = {}
+
+
+class TimingPanel(qt.QLabel):
+    """
+    Label (shown in the status bar) summarising the timings of each render stage.
+
+    #### Args
+    parent (qt.QWidget)
+    :    Widget to parent this panel to
+    timings (Timings)
+    :    Timings to summarise
+    cache (render.RenderCache, optional)
+    :    Cache to show hit and miss counts for
+    interval (int)
+    :    Milliseconds between updates while the panel is shown
+    """
+    def __init__(self, parent, timings, cache=None, interval=1000):
+        # initialise
+        qt.QLabel.__init__(self, parent)
+        self.timings = timings
+        self.cache = cache
+        self.setStyleSheet("font-family: JetBrains Mono; font-size: 8pt;")
+        # update regularly while shown
+        self.timer = util.QTimer(self)
+        self.timer.setInterval(interval)
+        self.timer.timeout.connect(self.refresh)
+
+    def refresh(self, evt=None):
+        """
+        Update the summary from the current timings.
+        """
+        items = []
+        for stage, stats in self.timings.stats().items():
+            items.append(
+                f"{stage} {stats['p50'] * 1000:.1f}/{stats['p95'] * 1000:.1f}/"
+                f"{stats['max'] * 1000:.1f}ms"
+            )
+        text = "p50/p95/max: " + " · ".join(items)
+        # add cache counters
+        if self.cache is not None:
+            stats = self.cache.stats()
+            text += f" | render cache {stats['hits']} hits/{stats['misses']} misses"
+        self.setText(text)
+
+    def showEvent(self, event):
+        self.refresh()
+        self.timer.start()
+        return qt.QLabel.showEvent(self, event)
+
+    def hideEvent(self, event):
+        self.timer.stop()
+        return qt.QLabel.hideEvent(self, event)
+
+
+class StartupReport:
+    """
+    Records when each phase of startup finished, to show where startup time goes.
+
+    #### Attributes
+    start (float)
+    :    Value of `time.perf_counter()` when the report was started
+    phases (list[tuple])
+    :    (phase name, seconds since start) for each phase, in the order they finished
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = []
+
+    def mark(self, phase):
+        """
+        Note that the given phase has just finished.
+
+        #### Args
+        phase (str)
+        :    Name of the phase
+        """
+        self.phases.append((phase, time.perf_counter() - self.start))
+
+    def to_text(self):
+        """
+        Get the report as text, with the time each phase took and the total time at its end.
+        """
+        lines = []
+        last = 0
+        for phase, elapsed in self.phases:
+            lines.append(f"{phase:<16} {(elapsed - last) * 1000:8.1f}ms {elapsed * 1000:8.1f}ms")
+            last = elapsed
+
+        return "\n".join(lines)
+
+
+# timings shared across the app
+timings = Timings()
+# startup times (started when this module is first imported, so includes most imports)
+startup = StartupReport()
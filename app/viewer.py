@@ -1,9 +1,233 @@
 import time
+import json
+import difflib
 import PyQt5.QtWebEngineWidgets as html
 import PyQt5.QtCore as util
+import PyQt5.QtGui as gui
 
 from pathlib import Path
 
+from . import assets
+from .timing import timings
+from .export import font_files, fonts_folder
+
+
+# script for the shell page, which keeps track of the nodes made from each fragment of HTML
+_shell_script = """
+var markmoji = {
+    fragments: [],
+    patch: function(start, count, htmls) {
+        // find the node to insert before
+        var after = null;
+        for (var i = start + count; i < this.fragments.length && after === null; i++) {
+            if (this.fragments[i].length) {
+                after = this.fragments[i][0];
+            }
+        }
+        // remove old nodes
+        this.fragments.slice(start, start + count).forEach(function(nodes) {
+            nodes.forEach(function(node) { node.remove(); });
+        });
+        // make and insert new nodes
+        var added = htmls.map(function(content) {
+            var template = document.createElement("template");
+            template.innerHTML = content;
+            markmoji.activate_scripts(template.content);
+            var nodes = Array.prototype.slice.call(template.content.childNodes);
+            document.body.insertBefore(template.content, after);
+            return nodes;
+        });
+        Array.prototype.splice.apply(this.fragments, [start, count].concat(added));
+    },
+    activate_scripts: function(root) {
+        // scripts parsed via innerHTML don't run, so swap them for fresh ones which will
+        root.querySelectorAll("script").forEach(function(old) {
+            var script = document.createElement("script");
+            Array.prototype.forEach.call(old.attributes, function(attr) {
+                script.setAttribute(attr.name, attr.value);
+            });
+            script.text = old.text;
+            old.replaceWith(script);
+        });
+    }
+};
+"""
+
+# HTML of the shell page, which content is patched into
+_shell_html = (
+    f"<head>\n"
+    f"<script>\n"
+    f"{_shell_script}\n"
+    f"</script>\n"
+    f"</head>\n"
+    f"<body>\n"
+    f"</body>"
+)
+
+# script to add (or update) a stylesheet in the page, filled in with the style's id and CSS
+_style_script = """
+(function() {{
+    var style = document.getElementById({id});
+    if (style === null) {{
+        style = document.createElement("style");
+        style.id = {id};
+        document.head.appendChild(style);
+    }}
+    style.textContent = {css};
+}})();
+"""
+
+
+def font_faces(folder):
+    """
+    Make CSS `@font-face` rules for each font file in a folder, so the viewer can use bundled
+    fonts rather than fetching them from the web.
+
+    #### Args
+    folder (pathlib.Path)
+    :    Folder containing .ttf files named like `FamilyName-BoldItalic.ttf`
+
+    #### Returns
+    str
+    :    CSS containing an `@font-face` rule for each font file
+    """
+    rules = []
+    for family, weight, style, file in font_files(folder):
+        rules.append(
+            f"@font-face {{\n"
+            f"    font-family: '{family}';\n"
+            f"    src: url('{util.QUrl.fromLocalFile(str(file)).toString()}') format('truetype');\n"
+            f"    font-weight: {weight};\n"
+            f"    font-style: {style};\n"
+            f"}}\n"
+        )
+
+    return "".join(rules)
+
+
+def make_style_script(name, css):
+    """
+    Make a script which adds a stylesheet to each page once its document is ready.
+
+    #### Args
+    name (str)
+    :    Name of the script, also used as the id of the stylesheet element
+    css (str)
+    :    CSS content of the stylesheet
+
+    #### Returns
+    html.QWebEngineScript
+    :    Script to insert into a page or profile's script collection
+    """
+    script = html.QWebEngineScript()
+    script.setName(name)
+    script.setSourceCode(_style_script.format(id=json.dumps(name), css=json.dumps(css)))
+    script.setInjectionPoint(html.QWebEngineScript.DocumentReady)
+    script.setWorldId(html.QWebEngineScript.MainWorld)
+    script.setRunsOnSubFrames(False)
+
+    return script
+
+
+# url to resolve relative links against when there's no file
+untitled_url = util.QUrl.fromLocalFile(str(Path(__file__).parent.parent / "assets" / "untitled.html"))
+
+# scale images down to the size of the screen, as they can't be shown any bigger
+downscale_images = True
+
+# profile shared by every viewer, the handler serving local files to it, and a spare page ready
+# for the next viewer (all made when first needed)
+_profile = None
+_assets = None
+_spare = None
+
+
+def shared_profile():
+    """
+    Get the web engine profile shared by every viewer, making it (with `@font-face` rules for
+    the bundled fonts added to every page, and local files served from the asset scheme) if
+    needed.
+    """
+    global _profile, _assets
+    if _profile is None:
+        # the scheme has to be registered before the web engine starts
+        assets.register_scheme()
+        _profile = html.QWebEngineProfile(util.QCoreApplication.instance())
+        _profile.scripts().insert(make_style_script("markmoji-fonts", font_faces(fonts_folder)))
+        # serve local files (e.g. images) from a cache
+        max_size = None
+        screen = gui.QGuiApplication.primaryScreen()
+        if downscale_images and screen is not None:
+            max_size = screen.size() * screen.devicePixelRatio()
+        _assets = assets.AssetSchemeHandler(_profile, max_size=max_size)
+        _profile.installUrlSchemeHandler(assets.scheme, _assets)
+
+    return _profile
+
+
+def asset_handler():
+    """
+    Get the handler serving local files to the shared profile (see `shared_profile`).
+    """
+    shared_profile()
+
+    return _assets
+
+
+class ShellPage(html.QWebEnginePage):
+    """
+    Page in the shared profile which starts loading the (empty) shell page as soon as it's made,
+    so it can be made ahead of time and be ready by the time a viewer needs it.
+
+    #### Attributes
+    base_url (util.QUrl)
+    :    URL the shell page was loaded with
+    loaded (bool)
+    :    Has the shell page finished loading?
+    load_start (float)
+    :    Value of `time.perf_counter()` when the shell page started loading
+    """
+    def __init__(self):
+        profile = shared_profile()
+        html.QWebEnginePage.__init__(self, profile, profile)
+        self.base_url = untitled_url
+        self.loaded = False
+        self.load_start = time.perf_counter()
+        self.loadFinished.connect(self.on_load_finished)
+        self.setHtml(_shell_html, self.base_url)
+
+    def on_load_finished(self, ok):
+        # only the first load is of interest
+        self.loaded = ok
+        self.loadFinished.disconnect(self.on_load_finished)
+
+
+def take_page():
+    """
+    Take the spare page (making one if there isn't one), and make the next spare once the event
+    loop is free.
+
+    #### Returns
+    ShellPage
+    :    Page which has loaded (or is loading) the shell page
+    """
+    global _spare
+    page, _spare = _spare, None
+    if page is None:
+        page = ShellPage()
+    util.QTimer.singleShot(0, prewarm)
+
+    return page
+
+
+def prewarm():
+    """
+    Make a spare page, if there isn't one already.
+    """
+    global _spare
+    if _spare is None:
+        _spare = ShellPage()
+
 
 class HTMLViewer(html.QWebEngineView):
     def __init__(self, frame):
@@ -12,60 +236,190 @@ class HTMLViewer(html.QWebEngineView):
         self.frame = frame
         self.app = self.frame.app
 
-        # array to store render times in
-        self._render_durs = [0]
-        self._last_render = 0
+        # use a page made ahead of time (in the profile shared by every viewer), which has
+        # hopefully already loaded the shell page
+        page = take_page()
+        page.setParent(self)
+        self.setPage(page)
+        # state of the shell page
+        self._loading = not page.loaded
+        self._loaded = page.loaded
+        self._base_url = page.base_url
+        self._scroll = None
+        self._load_start = page.load_start
+        self._style_pending = False
+        # fragments currently in the page
+        self._shown = []
+        self.loadFinished.connect(self.on_load_finished)
 
         # set minimum size
         self.setMinimumWidth(512)
         # set initial content
         self.body = ""
-        self.refresh_content()
-    
+        self.fragments = [""]
+        self.set_style()
+        self.set_body(self.body, fragments=self.fragments)
+
+    def set_style(self):
+        """
+        Set the stylesheet added to pages in this viewer from the current theme, also swapping it
+        into the current page (so changing theme doesn't need a reload).
+        """
+        scripts = self.page().scripts()
+        # replace the old style
+        old = scripts.findScript("markmoji-theme")
+        if not old.isNull():
+            scripts.remove(old)
+        script = make_style_script("markmoji-theme", self.app.theme.viewer.spec)
+        scripts.insert(script)
+        # apply to the current page (or once it's loaded, if a load is already underway)
+        if self._loaded:
+            self.page().runJavaScript(script.sourceCode())
+        else:
+            self._style_pending = self._loading
+
     def refresh_content(self, evt=None):
+        """
+        Reload the page from scratch, e.g. if it's navigated away from the content. Scroll position
+        is kept.
+        """
+        self._loading = False
+        self._loaded = False
+        # update style
+        self.set_style()
         # set content again
-        self.set_body(self.body)
-    
-    def set_body(self, content):
-        # start timing
-        start = time.time()
+        self.set_body(self.body, fragments=self.fragments)
+
+    def set_body(self, content, fragments=None):
+        """
+        Set the HTML content of the page. If the shell page is already loaded, only fragments
+        which have changed are replaced in the live page, otherwise the shell page is loaded
+        (and the content added once it's ready).
+
+        #### Args
+        content (str)
+        :    HTML content for the page body
+        fragments (list[str], optional)
+        :    Content split into top-level fragments, each of which can be replaced on its own.
+             If None, the content is treated as one fragment.
+        """
         # store value
         self.body = content
+        if fragments is None:
+            fragments = [content]
+        self.fragments = list(fragments)
         # stop here if viewer isn't shown
         if not self.isVisible():
             return
-        # construct HTML
-        content_html = (
-            f"<head>\n"
-            f"<style>\n"
-            f"{self.app.theme.viewer.spec}\n"
-            f"</style>\n"
-            f"</head>\n"
-            f"<body>\n"
-            f"{self.body}\n"
-            f"</body>"
-        )
-        # get base url
+        # get base url (served from the asset scheme, so local images are cached)
         if hasattr(self.frame, "filename") and self.frame.filename is not None:
             filename = Path(self.frame.filename)
-            base = filename.parent / (filename.stem + ".html")
+            base_url = assets.asset_url(filename.parent / (filename.stem + ".html"))
         else:
-            filename = Path(__file__)
-            base = filename.parent.parent / "assets" / "untitled.html"
-        base_url = util.QUrl.fromLocalFile(str(base))
+            base_url = untitled_url
+        # reload shell page if needed (content is added when it finishes loading)
+        if base_url != self._base_url or not (self._loaded or self._loading):
+            self.load_shell(base_url)
+            return
+        if self._loading:
+            return
+        # patch changed fragments into the page
+        self.patch()
+
+    def load_shell(self, base_url):
+        """
+        Load an empty page with the script used to patch content into it (this is the fallback
+        when content can't just be patched in). The theme's style is added by a page script, so
+        isn't part of the page itself.
+
+        #### Args
+        base_url (util.QUrl)
+        :    URL to resolve relative links against
+        """
+        # remember scroll position, to restore once loaded
+        if self._scroll is None and self._shown:
+            self._scroll = self.page().scrollPosition()
+        # mark as loading
+        self._loading = True
+        self._loaded = False
+        self._base_url = base_url
+        self._shown = []
         # set HTML
-        self.setHtml(content_html, base_url)
-        # store time of this render
-        self._last_render = time.time()
-        # store render dur
-        self._render_durs.append(self._last_render - start)
-        # only keep last 10 render durs
-        if len(self._render_durs) > 10:
-            self._render_durs = self._render_durs[-10:]
+        self._load_start = time.perf_counter()
+        with timings.span("set_html"):
+            self.setHtml(_shell_html, base_url)
+
+    def on_load_finished(self, ok):
+        """
+        Handle when the shell page has finished loading, by adding the current content.
+        """
+        # if anything else was loaded (e.g. a link was followed), the shell is gone
+        if not self._loading:
+            self._loaded = False
+            return
+        # if loading failed (e.g. because it was superseded), wait for the next load
+        if not ok:
+            return
+        self._loading = False
+        self._loaded = True
+        timings.record("load", self._load_start)
+        # apply style if it changed while loading
+        if self._style_pending:
+            self._style_pending = False
+            self.page().runJavaScript(self.page().scripts().findScript("markmoji-theme").sourceCode())
+        # add content
+        self.patch()
+        # restore scroll position
+        if self._scroll is not None:
+            self.page().runJavaScript(
+                f"window.scrollTo({self._scroll.x()}, {self._scroll.y()});"
+            )
+            self._scroll = None
+
+    def patch(self):
+        """
+        Replace whichever fragments in the page differ from the current fragments.
+        """
+        old = self._shown
+        new = self.fragments
+        # find unchanged fragments at the start and end
+        start = 0
+        while start < min(len(old), len(new)) and old[start] == new[start]:
+            start += 1
+        end = 0
+        while end < min(len(old), len(new)) - start and old[-end - 1] == new[-end - 1]:
+            end += 1
+        # stop if nothing has changed
+        if start == len(old) == len(new):
+            return
+        # find runs of changed fragments in between, so unchanged fragments (e.g. those on screen
+        # while the rest of a long document streams in) are left alone
+        old_mid = old[start:len(old) - end]
+        new_mid = new[start:len(new) - end]
+        hunks = []
+        if len(old_mid) > 1 and len(new_mid) > 1:
+            matcher = difflib.SequenceMatcher(None, old_mid, new_mid)
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+                if tag != "equal":
+                    hunks.append((start + i1, i2 - i1, new_mid[j1:j2]))
+        else:
+            hunks.append((start, len(old_mid), new_mid))
+        # replace each run, last first so earlier positions stay the same (timed until the script
+        # has run in the page)
+        t = time.perf_counter()
+        self.page().runJavaScript(
+            "".join(
+                f"markmoji.patch({i}, {count}, {json.dumps(htmls)});"
+                for i, count, htmls in reversed(hunks)
+            ),
+            lambda result: timings.record("patch", t)
+        )
+        self._shown = list(new)
 
     def showEvent(self, event):
-        self.refresh_content()
+        # bring content up to date
+        self.set_body(self.body, fragments=self.fragments)
         return html.QWebEngineView.showEvent(self, event)
-    
+
     def hideEvent(self, event):
         return html.QWebEngineView.hideEvent(self, event)
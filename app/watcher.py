@@ -0,0 +1,228 @@
+import re
+import difflib
+import PyQt5.QtCore as util
+import PyQt5.QtGui as gui
+
+from pathlib import Path
+
+from .storage import text_delta
+
+
+# characters which a text control's plain text gives back differently (line and paragraph
+# separators come back as newlines, non-breaking spaces as spaces)
+_plain_chars = {0x2028: "\n", 0x2029: "\n", 0xa0: " "}
+
+# regex to split text into lines, keeping each line's newline (text controls only start a new
+# line at "\n", unlike `str.splitlines`)
+_line_re = re.compile(r"(?<=\n)")
+
+
+def plain_text(text):
+    """
+    Get the plain text a text control would give back after being set to some text.
+    """
+    return text.translate(_plain_chars)
+
+
+def split_lines(text):
+    """
+    Split text into lines at each "\n" only, keeping the newlines.
+    """
+    lines = _line_re.split(text)
+    # text ending in a newline leaves an empty last item
+    if lines[-1] == "":
+        lines.pop()
+
+    return lines
+
+
+def line_edits(old, new):
+    """
+    Get the changes which turn one text into another, as runs of replaced lines.
+
+    #### Args
+    old (str)
+    :    Current text
+    new (str)
+    :    Text to change it to
+
+    #### Returns
+    list[tuple]
+    :    (start position, end position, replacement text) in `old` for each run of changed
+         lines, in order. Positions are counted in UTF-16 code units, as in a text control.
+    """
+    old_lines = split_lines(old)
+    new_lines = split_lines(new)
+    # find unchanged lines at the start and end
+    start, removed, added = text_delta(old_lines, new_lines)
+    if not removed and not added:
+        return []
+    # find runs of changed lines in between
+    if removed > 1 and len(added) > 1:
+        matcher = difflib.SequenceMatcher(None, old_lines[start:start + removed], added)
+        runs = [
+            (start + i1, start + i2, "".join(added[j1:j2]))
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != "equal"
+        ]
+    else:
+        runs = [(start, start + removed, "".join(added))]
+    # get the position of each run, counting up from the last
+    edits = []
+    line = position = 0
+    for first, last, text in runs:
+        position += _utf16_len("".join(old_lines[line:first]))
+        end = position + _utf16_len("".join(old_lines[first:last]))
+        edits.append((position, end, text))
+        line, position = last, end
+
+    return edits
+
+
+def _utf16_len(text):
+    return len(text.encode("utf-16-le", "surrogatepass")) // 2
+
+
+def apply_edits(ctrl, edits):
+    """
+    Apply runs of replaced lines (see `line_edits`) to a text control, leaving unchanged lines
+    (and their highlighting) as they are, and keeping the cursor and scroll position. Each run is
+    a separate edit, as Qt reports all the changes in an edit block as one change spanning all of
+    them (so everything in between would be highlighted again).
+
+    #### Args
+    ctrl (qt.QTextEdit)
+    :    Control to edit
+    edits (list[tuple])
+    :    (start position, end position, replacement text) for each run of changed lines
+    """
+    # remember scroll position
+    h = ctrl.horizontalScrollBar().value()
+    v = ctrl.verticalScrollBar().value()
+    # replace each run, last first so earlier positions stay the same
+    cursor = gui.QTextCursor(ctrl.document())
+    for start, end, text in reversed(edits):
+        cursor.setPosition(start)
+        cursor.setPosition(end, gui.QTextCursor.KeepAnchor)
+        cursor.insertText(text)
+    # restore scroll position
+    ctrl.horizontalScrollBar().setValue(h)
+    ctrl.verticalScrollBar().setValue(v)
+
+
+def reload_text(ctrl, new):
+    """
+    Change the text in a text control to new text by replacing only the lines which differ (see
+    `apply_edits`). If that doesn't give the new text, the whole text is set instead.
+
+    #### Args
+    ctrl (qt.QTextEdit)
+    :    Control to change
+    new (str)
+    :    Text to change it to
+
+    #### Returns
+    bool
+    :    True if only the changed lines were replaced, False if the whole text was set
+    """
+    new = plain_text(new)
+    apply_edits(ctrl, line_edits(ctrl.toPlainText(), new))
+    if ctrl.toPlainText() == new:
+        return True
+    ctrl.setPlainText(new)
+
+    return False
+
+
+class FileWatcher(util.QObject):
+    """
+    Watches the file open in a window for changes made by other programs (e.g. git checkout,
+    or a script generating it). Bursts of changes are debounced, and changes which leave the
+    file as it was last loaded or saved (such as this app's own saves) are ignored.
+
+    The folder containing the file is watched too, as files replaced by renaming a new file
+    over them (as many programs, including this one, save) are otherwise no longer watched.
+
+    #### Args
+    parent (qt.QObject)
+    :    Object which owns this watcher
+    delay (int)
+    :    Milliseconds to wait for changes to stop before reading the file
+
+    #### Attributes
+    changed (util.pyqtSignal)
+    :    Emitted with the file's content as last loaded or saved and its new content, once it
+         has changed
+    """
+    changed = util.pyqtSignal(str, str)
+
+    def __init__(self, parent, delay=200):
+        util.QObject.__init__(self, parent)
+        self.filename = None
+        # content of the file as last loaded or saved
+        self.content = None
+        # (modification time, size) of the file when last read
+        self._stat = None
+        self._watcher = util.QFileSystemWatcher(self)
+        self._watcher.fileChanged.connect(self.on_change)
+        self._watcher.directoryChanged.connect(self.on_change)
+        # read the file once changes stop
+        self._timer = util.QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(delay)
+        self._timer.timeout.connect(self.check)
+
+    def watch(self, filename, content):
+        """
+        Start watching a file.
+
+        #### Args
+        filename (pathlib.Path, optional)
+        :    File to watch, or None to stop watching
+        content (str, optional)
+        :    Content of the file as loaded or saved
+        """
+        self._timer.stop()
+        # stop watching the last file
+        paths = self._watcher.files() + self._watcher.directories()
+        if paths:
+            self._watcher.removePaths(paths)
+        self.filename = None if filename is None else Path(filename)
+        self.content = content
+        self._stat = None
+        if self.filename is not None:
+            self._watcher.addPath(str(self.filename.parent))
+            self._rewatch()
+
+    def _rewatch(self):
+        # start watching the file again if it's been replaced
+        if str(self.filename) not in self._watcher.files() and self.filename.is_file():
+            self._watcher.addPath(str(self.filename))
+
+    def on_change(self, path=None):
+        # wait for changes to stop
+        self._timer.start()
+
+    def check(self):
+        """
+        Read the file, and emit `changed` if its content is different from when it was last
+        loaded or saved.
+        """
+        if self.filename is None:
+            return
+        self._rewatch()
+        # a file which has gone (or is still being written) is left until it changes again
+        try:
+            stat = self.filename.stat()
+            # only read the file if it's been touched (changes to other files in its folder are
+            # picked up too)
+            if (stat.st_mtime_ns, stat.st_size) == self._stat:
+                return
+            content = self.filename.read_text(encoding="utf-8")
+        except (OSError, ValueError):
+            return
+        self._stat = (stat.st_mtime_ns, stat.st_size)
+        if content == self.content:
+            return
+        old = self.content
+        self.content = content
+        self.changed.emit(old, content)
@@ -0,0 +1,435 @@
+import os
+import re
+import math
+import json
+import bisect
+import hashlib
+import threading
+import PyQt5.QtCore as util
+import PyQt5.QtWidgets as qt
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from pathlib import Path
+
+from .storage import atomic_write
+from .timing import timings
+
+
+# folder to keep workspace indexes in
+index_folder = Path(
+    util.QStandardPaths.writableLocation(util.QStandardPaths.GenericDataLocation)
+) / "markmoji-editor" / "index"
+
+# version of the on-disk index format (indexes saved with any other version are rebuilt)
+_index_version = 1
+
+# regex to find terms in text: words, or single non-ASCII symbols (so emojis can be searched for)
+_term_re = re.compile(r"\w+|[^\w\s\x00-\x7f\ufe0f\u200d]")
+
+# maximum number of terms a partly typed last word of a query can expand to
+_max_expansions = 64
+
+# ranking parameters (see Okapi BM25)
+_k1 = 1.2
+_b = 0.75
+
+
+SearchResult = namedtuple("SearchResult", ["path", "score", "lines"])
+SearchResult.__doc__ = """
+File matching a search.
+
+#### Attributes
+path (pathlib.Path)
+:    Path to the file
+score (float)
+:    How well the file matches (higher is better)
+lines (list[int])
+:    Line numbers (from 0) containing any of the search terms, in order
+"""
+
+
+def terms(text):
+    """
+    Split text into lowercase search terms.
+    """
+    return _term_re.findall(text.lower())
+
+
+def index_file(path):
+    """
+    Get the terms in a file and the lines each appears on.
+
+    #### Args
+    path (pathlib.Path)
+    :    File to index
+
+    #### Returns
+    int
+    :    Total number of terms in the file
+    dict[str, list[int]]
+    :    Line numbers (from 0) each term appears on, in order
+    """
+    postings = {}
+    length = 0
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for i, line in enumerate(f):
+            found = terms(line)
+            length += len(found)
+            for term in set(found):
+                postings.setdefault(term, []).append(i)
+
+    return length, postings
+
+
+@lru_cache(maxsize=256)
+def _read_lines(path, mtime):
+    # cached by modification time, so lines are read again once a file changes
+    with open(path, encoding="utf-8", errors="replace") as f:
+        # split on newlines only, to number lines the same way as `index_file`
+        return f.read().split("\n")
+
+
+def line_text(path, line):
+    """
+    Get the text of a line in a file, or "" if the file (or line) no longer exists.
+    """
+    try:
+        lines = _read_lines(path, os.stat(path).st_mtime_ns)
+    except OSError:
+        return ""
+
+    return lines[line] if line < len(lines) else ""
+
+
+class WorkspaceIndex(util.QObject):
+    """
+    Inverted index of every Markdown file in a folder (and its subfolders), for searching them
+    all at once. The index is saved to disk and, when refreshed, only files whose modification
+    time or size has changed since are indexed again (on a pool of background threads). It can
+    be searched while refreshing, results just won't include changes not yet indexed.
+
+    #### Args
+    folder (pathlib.Path)
+    :    Folder to index
+    parent (qt.QObject, optional)
+    :    Object which owns this index (signals are delivered on its thread)
+    workers (int, optional)
+    :    Number of threads to index files on, if None then one per CPU (up to 8)
+
+    #### Attributes
+    progress (util.pyqtSignal)
+    :    Emitted with the number of files indexed and the number to index during a refresh
+    updated (util.pyqtSignal)
+    :    Emitted once a refresh has finished and the index has been saved (if any terms changed)
+    """
+    progress = util.pyqtSignal(int, int)
+    updated = util.pyqtSignal()
+
+    def __init__(self, folder, parent=None, workers=None):
+        util.QObject.__init__(self, parent)
+        self.folder = Path(folder).resolve()
+        self.workers = workers or min(8, os.cpu_count() or 1)
+        self.path = index_folder / (
+            hashlib.blake2b(str(self.folder).encode("utf-8"), digest_size=16).hexdigest() + ".json"
+        )
+        # (modification time, size, number of terms) of each indexed file, by relative path
+        self.files = {}
+        # lines each term appears on, by relative path, by term
+        self.postings = {}
+        # terms in alphabetical order, for expanding partly typed words (made when needed)
+        self._sorted = None
+        self._total = 0
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pending = False
+
+    def refresh(self):
+        """
+        Bring the index up to date with the folder, in the background. If a refresh is already
+        underway, another is done once it finishes.
+        """
+        with self._lock:
+            # the refresh underway goes again once it's done
+            if self._thread is not None and self._thread.is_alive():
+                self._pending = True
+                return
+            thread = self._thread = threading.Thread(target=self._refresh, daemon=True)
+        thread.start()
+
+    def wait(self, timeout=None):
+        """
+        Block until the current refresh has finished.
+        """
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def scan(self):
+        """
+        Find every Markdown file in the folder, skipping hidden folders.
+
+        #### Returns
+        dict[str, tuple]
+        :    (modification time, size) of each file, by path relative to the folder
+        """
+        found = {}
+        for root, dirs, files in os.walk(self.folder):
+            dirs[:] = [name for name in dirs if not name.startswith(".")]
+            for name in files:
+                if not name.lower().endswith(".md"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                found[Path(os.path.relpath(path, self.folder)).as_posix()] = (stat.st_mtime_ns, stat.st_size)
+
+        return found
+
+    def _refresh(self):
+        while True:
+            self._update()
+            # go again if another refresh was asked for meanwhile, otherwise finish before saying
+            # so (so a refresh asked for in response to `updated` isn't taken as already underway)
+            with self._lock:
+                again = self._pending
+                self._pending = False
+                if not again:
+                    self._thread = None
+            self.updated.emit()
+            if not again:
+                return
+
+    def _update(self):
+        with timings.span("index"):
+            if not self._loaded:
+                self.load()
+            found = self.scan()
+            # work out which files need (re)indexing
+            with self._lock:
+                stale = {
+                    rel for rel, entry in self.files.items()
+                    if rel not in found or tuple(entry[:2]) != found[rel]
+                }
+                changed = [
+                    rel for rel, stat in found.items()
+                    if rel not in self.files or rel in stale
+                ]
+                # remove old entries for stale files, keeping them to compare against
+                old = self._remove(stale) if stale else {}
+            if not changed and not stale:
+                return
+            # the saved index only needs writing again if any file's terms have changed (files
+            # which have just been saved again often haven't)
+            modified = any(rel not in found for rel in stale)
+            # index changed files on the pool, adding each to the index as it's done
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                jobs = {pool.submit(index_file, self.folder / rel): rel for rel in changed}
+                for i, job in enumerate(as_completed(jobs)):
+                    rel = jobs[job]
+                    try:
+                        length, postings = job.result()
+                    except OSError:
+                        modified = modified or rel in old
+                        continue
+                    with self._lock:
+                        self._add(rel, found[rel], length, postings)
+                    modified = modified or old.get(rel) != (length, postings)
+                    self.progress.emit(i + 1, len(changed))
+            if modified:
+                self.save()
+
+    def _add(self, rel, stat, length, postings):
+        self.files[rel] = (stat[0], stat[1], length)
+        self._total += length
+        for term, lines in postings.items():
+            self.postings.setdefault(term, {})[rel] = lines
+        self._sorted = None
+
+    def _remove(self, rels):
+        # one pass over the postings removes any number of files, giving back the (number of
+        # terms, postings) each file had
+        removed = {}
+        for rel in rels:
+            length = self.files.pop(rel)[2]
+            self._total -= length
+            removed[rel] = (length, {})
+        for term in list(self.postings):
+            entries = self.postings[term]
+            for rel in rels.intersection(entries):
+                removed[rel][1][term] = entries.pop(rel)
+            if not entries:
+                del self.postings[term]
+        self._sorted = None
+
+        return removed
+
+    def load(self):
+        """
+        Load the index saved for this folder, if there is one.
+        """
+        self._loaded = True
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('version') != _index_version or data.get('folder') != str(self.folder):
+            return
+        with self._lock:
+            self.files = {rel: tuple(entry) for rel, entry in data['files'].items()}
+            self.postings = data['postings']
+            self._total = sum(entry[2] for entry in self.files.values())
+            self._sorted = None
+
+    def save(self):
+        """
+        Save the index for this folder to disk.
+        """
+        index_folder.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            content = json.dumps({
+                'version': _index_version,
+                'folder': str(self.folder),
+                'files': self.files,
+                'postings': self.postings,
+            }, ensure_ascii=False, separators=(",", ":"))
+        atomic_write(self.path, content)
+
+    def expand(self, prefix):
+        """
+        Get indexed terms starting with the given prefix (up to a limit).
+        """
+        if self._sorted is None:
+            self._sorted = sorted(self.postings)
+        i = bisect.bisect_left(self._sorted, prefix)
+        found = []
+        while i < len(self._sorted) and self._sorted[i].startswith(prefix) and len(found) < _max_expansions:
+            found.append(self._sorted[i])
+            i += 1
+
+        return found
+
+    def search(self, query, limit=50):
+        """
+        Find the files containing every term in a query, best matches first. The last term
+        matches any term starting with it, so results can be shown as the query is typed.
+
+        #### Args
+        query (str)
+        :    Text to search for
+        limit (int)
+        :    Maximum number of results
+
+        #### Returns
+        list[SearchResult]
+        :    Matching files, ranked by how often (and how rarely elsewhere) the terms appear
+        """
+        words = terms(query)
+        if not words:
+            return []
+        with self._lock:
+            n = len(self.files)
+            if not n:
+                return []
+            avg = max(self._total / n, 1)
+            # postings for each word (the last word is expanded to every term it starts)
+            groups = [[word] for word in words[:-1]]
+            if query[-1:].isspace():
+                groups.append([words[-1]])
+            else:
+                groups.append(self.expand(words[-1]))
+            matched = None
+            scores = {}
+            lines = {}
+            for group in groups:
+                # files containing any term in the group
+                docs = {}
+                for term in group:
+                    for rel, found in self.postings.get(term, {}).items():
+                        docs.setdefault(rel, []).append(found)
+                # files must contain every group
+                matched = set(docs) if matched is None else matched & docs.keys()
+                if not matched:
+                    return []
+                idf = math.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+                for rel in matched:
+                    tf = sum(len(found) for found in docs[rel])
+                    norm = _k1 * (1 - _b + _b * self.files[rel][2] / avg)
+                    scores[rel] = scores.get(rel, 0) + idf * tf * (_k1 + 1) / (tf + norm)
+                    lines.setdefault(rel, set()).update(*docs[rel])
+            ranked = sorted(matched, key=lambda rel: (-scores[rel], rel))[:limit]
+
+        return [
+            SearchResult(self.folder / rel, scores[rel], sorted(lines[rel])) for rel in ranked
+        ]
+
+
+class FindInFiles(qt.QDialog):
+    """
+    Dialog to search every file in a workspace, showing results as the query is typed.
+    Activating a result opens its file at the matching line.
+
+    #### Args
+    frame (app.MarkmojiFrame)
+    :    Window to open results in
+    index (WorkspaceIndex)
+    :    Index of the workspace to search
+    """
+    def __init__(self, frame, index):
+        qt.QDialog.__init__(self, frame)
+        self.frame = frame
+        self.index = index
+        self.setWindowTitle(f"Find in {index.folder.name}")
+        self.resize(640, 480)
+        # setup layout
+        self.sizer = qt.QVBoxLayout(self)
+        self.setLayout(self.sizer)
+        # query ctrl
+        self.query_ctrl = qt.QLineEdit(self)
+        self.query_ctrl.setPlaceholderText("Search files...")
+        self.query_ctrl.textChanged.connect(self.update_results)
+        self.sizer.addWidget(self.query_ctrl)
+        # results ctrl
+        self.results_ctrl = qt.QTreeWidget(self)
+        self.results_ctrl.setHeaderHidden(True)
+        self.results_ctrl.itemActivated.connect(self.on_activated)
+        self.sizer.addWidget(self.results_ctrl)
+        # status
+        self.status_lbl = qt.QLabel(self)
+        self.sizer.addWidget(self.status_lbl)
+        # show results again as the index changes
+        index.progress.connect(self.on_progress)
+        index.updated.connect(self.update_results)
+
+    def on_progress(self, done, total):
+        self.status_lbl.setText(f"Indexing {done}/{total} files...")
+
+    def update_results(self, evt=None):
+        """
+        Show results for the current query.
+        """
+        with timings.span("search"):
+            results = self.index.search(self.query_ctrl.text())
+        self.results_ctrl.clear()
+        for result in results:
+            # item for the file (opens at the first match)
+            item = qt.QTreeWidgetItem(self.results_ctrl, [str(result.path.relative_to(self.index.folder))])
+            item.setData(0, util.Qt.UserRole, (result.path, result.lines[0]))
+            # item for each matching line (only the first few, to keep it quick)
+            for line in result.lines[:5]:
+                child = qt.QTreeWidgetItem(item, [f"{line + 1}: {line_text(result.path, line).strip()}"])
+                child.setData(0, util.Qt.UserRole, (result.path, line))
+        self.results_ctrl.expandAll()
+        if self.query_ctrl.text():
+            self.status_lbl.setText(f"{len(results)} files ({len(self.index.files)} indexed)")
+        else:
+            self.status_lbl.setText(f"{len(self.index.files)} files indexed")
+
+    def on_activated(self, item, column=0):
+        path, line = item.data(0, util.Qt.UserRole)
+        self.frame.goto(path, line)
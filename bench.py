@@ -0,0 +1,458 @@
+"""
+Headless benchmarks for the editor, renderer and viewer. Run from the folder containing
+`markmoji_editor`, e.g.
+
+    python -m markmoji_editor.bench --json before.json
+    python -m markmoji_editor.bench --compare before.json
+
+Corpora are generated from a fixed seed, so results from separate runs on the same machine can
+be compared (with `--compare`, the exit code is 1 if anything got slower than the tolerance).
+"""
+import os
+# run without a display unless told otherwise
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import platform
+import statistics
+import PyQt5.QtCore as util
+
+from .app import MarkmojiApp
+
+
+# corpus sizes (in characters) to benchmark
+sizes = {
+    "1KB": 1_000,
+    "10KB": 10_000,
+    "100KB": 100_000,
+    "1MB": 1_000_000,
+    "10MB": 10_000_000,
+}
+
+# words to make prose from
+_words = (
+    "markdown", "emoji", "handler", "preview", "render", "theme", "block", "syntax", "font",
+    "lorem", "ipsum", "dolor", "sit", "amet", "quick", "brown", "fox", "lazy", "dog", "the",
+    "a", "of", "and", "to", "in", "is", "with", "for", "on", "as",
+)
+
+
+def make_corpus(size, seed=0):
+    """
+    Make synthetic markdown with headings, prose, lists, tables, fenced code, footnotes and
+    Markmoji handlers.
+
+    #### Args
+    size (int)
+    :    Approximate number of characters to make
+    seed (int)
+    :    Seed for the random generator, so the same corpus is made each time
+
+    #### Returns
+    str
+    :    Markdown content
+    """
+    rng = random.Random(seed)
+
+    def sentence():
+        words = rng.choices(_words, k=rng.randint(6, 16))
+        # add some inline markup
+        i = rng.randrange(len(words))
+        words[i] = rng.choice(("*{}*", "**{}**", "`{}`", "[{}](https://example.com)")).format(words[i])
+        return " ".join(words).capitalize() + "."
+
+    sections = []
+    length = 0
+    n = 0
+    while length < size:
+        n += 1
+        section = [f"## Section {n}", " ".join(sentence() for _ in range(rng.randint(2, 5)))]
+        kind = n % 5
+        if kind == 0:
+            # list
+            section.append("\n".join(f"- {sentence()}" for _ in range(rng.randint(2, 6))))
+        elif kind == 1:
+            # table
+            rows = [
+                "| Name | Value | Note |",
+                "| --- | --- | --- |",
+            ] + [
+                f"| {rng.choice(_words)} | {rng.randint(0, 999)} | {sentence()} |"
+                for _ in range(rng.randint(2, 6))
+            ]
+            section.append("\n".join(rows))
+        elif kind == 2:
+            # fenced code
+            lines = [f"x{i} = {rng.randint(0, 99)} + {rng.choice(_words)!r}" for i in range(rng.randint(2, 8))]
+            section.append("```python\n" + "\n".join(lines) + "\n```")
+        elif kind == 3:
+            # footnote
+            section.append(f"See the note[^n{n}] for details.\n\n[^n{n}]: {sentence()}")
+        else:
+            # markmoji handler
+            section.append(f"Say it like 🗣️[{rng.choice(_words)}](ˈmɑːkdaʊn) when reading aloud.")
+        sections.append("\n\n".join(section))
+        length += len(sections[-1]) + 2
+
+    return "# Benchmark corpus\n\n" + "\n\n".join(sections) + "\n"
+
+
+def process_memory():
+    """
+    Get the resident memory of this process and all its descendants (e.g. QtWebEngine's
+    renderer processes), in bytes. Only works on Linux, elsewhere returns None.
+    """
+    try:
+        pids = [int(name) for name in os.listdir("/proc") if name.isdigit()]
+        page_size = os.sysconf("SC_PAGE_SIZE")
+    except (OSError, AttributeError, ValueError):
+        return None
+    # find each process's parent
+    children = {}
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat", encoding="utf-8") as f:
+                # parent pid is the second field after the command name (which may have spaces)
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(pid)
+    # add up memory of this process and its descendants
+    total = 0
+    todo = [os.getpid()]
+    while todo:
+        pid = todo.pop()
+        todo += children.get(pid, [])
+        try:
+            with open(f"/proc/{pid}/statm", encoding="utf-8") as f:
+                total += int(f.read().split()[1]) * page_size
+        except (OSError, IndexError, ValueError):
+            continue
+
+    return total
+
+
+class Bench:
+    """
+    Runs benchmarks against a headless app window.
+
+    #### Args
+    repeat (int)
+    :    Number of times to time each benchmark at each size
+    keystrokes (int)
+    :    Number of keystrokes in each simulated typing burst
+    """
+    def __init__(self, repeat=5, keystrokes=50):
+        self.repeat = repeat
+        self.keystrokes = keystrokes
+        # make app
+        self.app = MarkmojiApp(show_splash=False, recover=False)
+        self.frame = self.app.win
+        # wait for the rendered HTML view to be set up
+        self.wait(lambda: self.frame.html_view is not None)
+        # render as soon as asked, rather than waiting for typing to settle
+        self.frame.renderer.delay = 0
+        # show the raw HTML view too, so it's included
+        self.frame.view_ctrl.set_values((True, True, True))
+        # note the generation of each render as it arrives
+        self._rendered = 0
+        self.frame.renderer.rendered.connect(self.on_rendered)
+
+    def on_rendered(self, generation, content_html, fragments):
+        self._rendered = generation
+
+    def wait(self, condition, timeout=600):
+        """
+        Process events until the given condition is met.
+        """
+        deadline = time.perf_counter() + timeout
+        while not condition():
+            if time.perf_counter() > deadline:
+                raise TimeoutError("Timed out waiting for the app")
+            self.app.processEvents(util.QEventLoop.AllEvents, 10)
+
+    def wait_render(self):
+        """
+        Wait for the most recently requested render to arrive.
+        """
+        generation = self.frame.renderer.generation
+        self.wait(lambda: self._rendered >= generation)
+
+    def settle(self):
+        """
+        Wait for any pending render, page load and background highlighting to finish.
+        """
+        highlighters = (self.frame.md_ctrl.highlighter, self.frame.html_ctrl.highlighter)
+        self.wait_render()
+        self.wait(lambda: not self.frame.html_view._loading)
+        self.wait(lambda: not any(hl.busy for hl in highlighters))
+        self.roundtrip()
+
+    def roundtrip(self):
+        """
+        Wait for the page to run a script, which means any scripts sent before it have run.
+        """
+        done = []
+        self.frame.html_view.page().runJavaScript("0", lambda result: done.append(True))
+        self.wait(lambda: done)
+
+    def load(self, corpus):
+        """
+        Load a corpus into the editor (if not already loaded) and wait for everything to catch up.
+        """
+        if self.frame.md_ctrl.toPlainText() != corpus:
+            self.frame.md_ctrl.setPlainText(corpus)
+        self.settle()
+
+    def bench_style_text(self, corpus):
+        """
+        Time restyling the whole document, up until the highlighter has nothing left to do in the
+        background.
+        """
+        self.load(corpus)
+        start = time.perf_counter()
+        self.frame.md_ctrl.style_text()
+        self.wait(lambda: not self.frame.md_ctrl.highlighter.busy)
+        return time.perf_counter() - start
+
+    def bench_style_visible(self, corpus):
+        """
+        Time restyling just the visible part of the document (the rest is done in the background).
+        """
+        self.load(corpus)
+        start = time.perf_counter()
+        self.frame.md_ctrl.style_text()
+        end = time.perf_counter()
+        # let the background restyle finish before the next run
+        self.settle()
+        return end - start
+
+    def bench_render_html(self, corpus):
+        self.load(corpus)
+        # time converting, rather than fetching the whole document from the cache
+        self.frame.renderer.pool.cache.clear()
+        start = time.perf_counter()
+        self.frame.render_html()
+        self.wait_render()
+        return time.perf_counter() - start
+
+    def bench_set_body(self, corpus):
+        self.load(corpus)
+        view = self.frame.html_view
+        body, fragments = view.body, view.fragments
+        # clear the page, so the whole body is patched in
+        view.set_body("", fragments=[])
+        self.roundtrip()
+        start = time.perf_counter()
+        view.set_body(body, fragments=fragments)
+        self.wait(lambda: not view._loading)
+        self.roundtrip()
+        return time.perf_counter() - start
+
+    def bench_typing(self, corpus):
+        """
+        Time a burst of keystrokes in the middle of the document, returning the mean time per
+        keystroke (including the render it ends with).
+        """
+        self.load(corpus)
+        ctrl = self.frame.md_ctrl
+        cursor = ctrl.textCursor()
+        cursor.setPosition(ctrl.document().characterCount() // 2)
+        ctrl.setTextCursor(cursor)
+        start = time.perf_counter()
+        for char in ("typing " * self.keystrokes)[:self.keystrokes]:
+            ctrl.insertPlainText(char)
+            self.app.processEvents()
+        self.wait_render()
+        return (time.perf_counter() - start) / self.keystrokes
+
+    def window_memory(self, count=4, size=10_000):
+        """
+        Measure how much memory each extra window takes, once its rendered HTML view is set up
+        and it's rendered a corpus.
+
+        #### Args
+        count (int)
+        :    Number of windows to open
+        size (int)
+        :    Number of characters in the corpus each window renders
+
+        #### Returns
+        float or None
+        :    Mean increase in resident memory per window (in bytes), or None if memory can't be
+             measured on this platform
+        """
+        from .app.app import MarkmojiFrame
+        corpus = make_corpus(size)
+        # let anything pending (e.g. making a spare page) finish first
+        self.settle()
+        before = process_memory()
+        if before is None:
+            return None
+        # open windows
+        frames = []
+        for n in range(count):
+            frame = MarkmojiFrame(self.app)
+            self.wait(lambda: frame.html_view is not None)
+            frame.renderer.delay = 0
+            frame.md_ctrl.setPlainText(corpus)
+            frames.append(frame)
+        # wait for them to render
+        for frame in frames:
+            self.wait(lambda: frame.html_ctrl.body and not frame.html_view._loading)
+        self.roundtrip()
+        after = process_memory()
+        # close windows
+        for frame in frames:
+            frame.close()
+
+        return (after - before) / count
+
+    def run(self, sizes, benches=None, log=print):
+        """
+        Run benchmarks at each size.
+
+        #### Args
+        sizes (dict[str, int])
+        :    Label and number of characters for each corpus size
+        benches (list[str], optional)
+        :    Names of benchmarks to run (e.g. "typing"), if None then all
+        log (callable)
+        :    Function to report progress with
+
+        #### Returns
+        dict
+        :    Results, as {bench: {size label: {"chars", "median", "min", "times"}}}
+        """
+        if benches is None:
+            benches = [name[6:] for name in dir(self) if name.startswith("bench_")]
+        results = {}
+        for label, size in sizes.items():
+            corpus = make_corpus(size)
+            for name in benches:
+                times = [getattr(self, f"bench_{name}")(corpus) for _ in range(self.repeat)]
+                results.setdefault(name, {})[label] = {
+                    'chars': len(corpus),
+                    'median': statistics.median(times),
+                    'min': min(times),
+                    'times': times,
+                }
+                log(f"{name:<14} {label:>6} {statistics.median(times) * 1000:10.2f}ms")
+
+        return results
+
+    def close(self):
+        self.frame.close()
+
+
+def scaling(results):
+    """
+    Estimate how each benchmark scales with document size, as the exponent of a power law
+    between each pair of consecutive sizes (1 is linear, 2 is quadratic).
+
+    #### Returns
+    dict
+    :    {bench: [(from size label, to size label, exponent), ...]}
+    """
+    curves = {}
+    for name, by_size in results.items():
+        points = list(by_size.items())
+        curves[name] = []
+        for (a, ra), (b, rb) in zip(points, points[1:]):
+            if ra['median'] > 0 and rb['median'] > 0:
+                exponent = math.log(rb['median'] / ra['median']) / math.log(rb['chars'] / ra['chars'])
+                curves[name].append((a, b, exponent))
+
+    return curves
+
+
+def compare(results, baseline, tolerance=0.25):
+    """
+    Compare results against a previous run.
+
+    #### Args
+    results (dict)
+    :    Results from `Bench.run`
+    baseline (dict)
+    :    Results from a previous run
+    tolerance (float)
+    :    Fraction slower than the baseline a median can be before counting as a regression
+
+    #### Returns
+    list[tuple]
+    :    (bench, size label, ratio of median to baseline median, regressed) for each result
+         also present in the baseline
+    """
+    rows = []
+    for name, by_size in results.items():
+        for label, result in by_size.items():
+            old = baseline.get(name, {}).get(label)
+            if old is None or old['median'] <= 0:
+                continue
+            ratio = result['median'] / old['median']
+            rows.append((name, label, ratio, ratio > 1 + tolerance))
+
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", choices=list(sizes), default=list(sizes), help="corpus sizes to run")
+    parser.add_argument("--bench", nargs="+", choices=("style_text", "style_visible", "render_html", "set_body", "typing"), help="benchmarks to run (default all)")
+    parser.add_argument("--repeat", type=int, default=5, help="times to run each benchmark at each size")
+    parser.add_argument("--json", help="file to save results to")
+    parser.add_argument("--compare", help="results file from a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="fraction slower than the baseline which counts as a regression")
+    parser.add_argument("--windows", type=int, default=0, help="also measure memory per window, over this many extra windows")
+    args = parser.parse_args(argv)
+
+    # run benchmarks
+    bench = Bench(repeat=args.repeat)
+    results = bench.run({label: sizes[label] for label in args.sizes}, benches=args.bench)
+    # measure memory per window
+    memory = None
+    if args.windows:
+        memory = bench.window_memory(count=args.windows)
+        if memory is None:
+            print("\nmemory per window: can't be measured on this platform")
+        else:
+            print(f"\nmemory per window: {memory / 2**20:.1f}MB")
+    bench.close()
+    # report scaling
+    print("\nscaling (power law exponent between sizes):")
+    for name, curve in scaling(results).items():
+        print(f"{name:<14} " + "  ".join(f"{a}->{b} {exp:.2f}" for a, b, exp in curve))
+    # save results
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({
+                'environment': {
+                    'python': platform.python_version(),
+                    'qt': util.QT_VERSION_STR,
+                    'platform': platform.platform(),
+                    'machine': platform.machine(),
+                },
+                'results': results,
+                'memory_per_window': memory,
+            }, f, indent=2)
+    # compare to baseline
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)['results']
+        print("\ncompared to baseline:")
+        regressed = False
+        for name, label, ratio, slower in compare(results, baseline, tolerance=args.tolerance):
+            print(f"{name:<14} {label:>6} {ratio:6.2f}x" + ("  REGRESSED" if slower else ""))
+            regressed = regressed or slower
+        return 1 if regressed else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
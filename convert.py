@@ -0,0 +1,205 @@
+"""
+Convert a tree of markdown files to standalone HTML pages, without a display (and without
+QtWebEngine). Run from the folder containing `markmoji_editor`, e.g.
+
+    python -m markmoji_editor.convert docs/ site/ --theme catppuccin.latte
+
+Files are converted in parallel. A manifest in the output folder records each source file's
+modification time, size and content hash, so files which haven't changed since the last run
+are skipped (as long as the theme is the same).
+"""
+import os
+import sys
+import json
+import hashlib
+import argparse
+import multiprocessing
+
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .app.render import BlockConverter, make_page
+from .app.theme.theme import registry
+
+
+# name of the manifest file, kept in the output folder
+manifest_name = ".markmoji-manifest.json"
+
+# converter for the current worker process (each worker makes its own)
+_converter = None
+
+
+def _init_worker():
+    global _converter
+    _converter = BlockConverter()
+
+
+def _convert_file(src, dst, css):
+    """
+    Convert one markdown file to an HTML page (run in a worker process).
+    """
+    content_md = Path(src).read_text(encoding="utf-8")
+    content_html = _converter.convert(content_md)
+    # write page
+    dst = Path(dst)
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    dst.write_text(make_page(content_html, css=css, title=Path(src).stem), encoding="utf-8")
+
+
+class BatchConverter:
+    """
+    Converts every markdown file in a folder (and its subfolders) to an HTML page in an output
+    folder, mirroring the folder structure.
+
+    #### Args
+    src (pathlib.Path)
+    :    Folder to find markdown files in
+    dst (pathlib.Path)
+    :    Folder to write HTML pages to
+    theme (str)
+    :    Viewer theme to style pages with, e.g. `catppuccin.latte`
+    jobs (int, optional)
+    :    Number of worker processes, if None then one per CPU
+    force (bool)
+    :    Convert every file, even if it hasn't changed since the last run
+    """
+    def __init__(self, src, dst, theme="catppuccin.latte", jobs=None, force=False):
+        self.src = Path(src)
+        self.dst = Path(dst)
+        self.theme = theme
+        self.jobs = jobs or os.cpu_count() or 1
+        self.force = force
+        self.manifest_path = self.dst / manifest_name
+
+    def load_manifest(self):
+        """
+        Load the manifest from the last run, or an empty one if there isn't one (or it was made
+        with a different theme).
+        """
+        try:
+            manifest = json.loads(self.manifest_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return {}
+        if self.force or manifest.get('theme') != self.theme:
+            return {}
+
+        return manifest.get('files', {})
+
+    def save_manifest(self, files):
+        self.dst.mkdir(parents=True, exist_ok=True)
+        self.manifest_path.write_text(
+            json.dumps({'theme': self.theme, 'files': files}, indent=1), encoding="utf-8"
+        )
+
+    def get_target(self, rel):
+        """
+        Get the output path for a source file, from its path relative to the source folder.
+        """
+        return self.dst / Path(rel).with_suffix(".html")
+
+    def plan(self, old):
+        """
+        Work out which files need converting.
+
+        #### Args
+        old (dict)
+        :    Manifest entries from the last run
+
+        #### Returns
+        list[str]
+        :    Relative paths of files to convert
+        dict
+        :    Manifest entries for every source file found
+        """
+        todo = []
+        files = {}
+        for path in sorted(self.src.rglob("*.md")):
+            rel = path.relative_to(self.src).as_posix()
+            stat = path.stat()
+            entry = {'mtime': stat.st_mtime, 'size': stat.st_size}
+            prev = old.get(rel)
+            exists = self.get_target(rel).is_file()
+            # unchanged if modification time and size are the same...
+            if exists and prev and prev['mtime'] == entry['mtime'] and prev['size'] == entry['size']:
+                files[rel] = prev
+                continue
+            # ...or if the content is the same (e.g. the file was touched or checked out again)
+            entry['hash'] = hashlib.blake2b(path.read_bytes(), digest_size=16).hexdigest()
+            files[rel] = entry
+            if exists and prev and prev.get('hash') == entry['hash']:
+                continue
+            todo.append(rel)
+
+        return todo, files
+
+    def run(self, log=print):
+        """
+        Convert all files which have changed, and remove pages for files which no longer exist.
+
+        #### Returns
+        dict
+        :    Lists of relative paths which were "converted", "skipped", "removed" and "failed"
+        """
+        old = self.load_manifest()
+        todo, files = self.plan(old)
+        result = {
+            'converted': [],
+            'skipped': [rel for rel in files if rel not in todo],
+            'removed': [],
+            'failed': [],
+        }
+        # remove pages for source files which are gone
+        for rel in old:
+            if rel not in files:
+                self.get_target(rel).unlink(missing_ok=True)
+                result['removed'].append(rel)
+        # convert changed files
+        if todo:
+            css = registry.get_style("viewer", self.theme).spec
+            pool = ProcessPoolExecutor(
+                max_workers=min(self.jobs, len(todo)),
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+            )
+            with pool:
+                futures = {
+                    pool.submit(_convert_file, str(self.src / rel), str(self.get_target(rel)), css): rel
+                    for rel in todo
+                }
+                for future in as_completed(futures):
+                    rel = futures[future]
+                    try:
+                        future.result()
+                    except Exception as err:
+                        log(f"failed: {rel} ({err})")
+                        result['failed'].append(rel)
+                        # make sure it's tried again next time
+                        del files[rel]
+                    else:
+                        log(f"converted: {rel}")
+                        result['converted'].append(rel)
+        # save manifest
+        self.save_manifest(files)
+
+        return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("src", help="folder of markdown files")
+    parser.add_argument("dst", help="folder to write HTML pages to")
+    parser.add_argument("--theme", default="catppuccin.latte", help="viewer theme to style pages with")
+    parser.add_argument("--jobs", "-j", type=int, help="number of worker processes (default one per CPU)")
+    parser.add_argument("--force", action="store_true", help="convert every file, even if unchanged")
+    parser.add_argument("--quiet", "-q", action="store_true", help="only print the summary")
+    args = parser.parse_args(argv)
+
+    converter = BatchConverter(args.src, args.dst, theme=args.theme, jobs=args.jobs, force=args.force)
+    result = converter.run(log=(lambda msg: None) if args.quiet else print)
+    print(", ".join(f"{len(paths)} {key}" for key, paths in result.items()))
+
+    return 1 if result['failed'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
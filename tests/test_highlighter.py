@@ -0,0 +1,136 @@
+import os
+# run without a display unless told otherwise
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import time
+import types
+import random
+import pytest
+import pygments.lexers
+import PyQt5.QtCore as util
+import PyQt5.QtGui as gui
+import PyQt5.QtWidgets as qt
+
+from collections import defaultdict
+
+from ..app.highlighter import PygmentsHighlighter
+from ..app.timing import timings
+
+
+# app has to outlive the controls made in tests
+app = qt.QApplication.instance() or qt.QApplication([])
+
+lexers = {language: pygments.lexers.get_lexer_by_name(language) for language in ("markdown", "html")}
+
+
+def make_ctrl(text, lookahead=256, language="markdown"):
+    ctrl = qt.QTextEdit()
+    # highlighter only needs formats from the app's theme
+    ctrl.app = types.SimpleNamespace(
+        theme=types.SimpleNamespace(editor=types.SimpleNamespace(formats=defaultdict(gui.QTextCharFormat)))
+    )
+    ctrl.highlighter = PygmentsHighlighter(ctrl, lexer=lexers[language])
+    ctrl.highlighter.lookahead = lookahead
+    ctrl.setPlainText(text)
+    settle(ctrl)
+
+    return ctrl
+
+
+def settle(ctrl):
+    deadline = time.perf_counter() + 60
+    while ctrl.highlighter.busy and time.perf_counter() < deadline:
+        app.processEvents(util.QEventLoop.AllEvents, 50)
+
+
+def spans(ctrl):
+    result = []
+    block = ctrl.document().begin()
+    while block.isValid():
+        result.append(block.userData().spans)
+        block = block.next()
+
+    return result
+
+
+# a fenced code block longer than the lookahead, between ordinary paragraphs
+doc = "".join(
+    ["# Title\n\n"]
+    + [f"Some *text* on line {i}\n\n" for i in range(100)]
+    + ["```\n"] + [f"# not a heading {i}\n" for i in range(300)] + ["```\n\n"]
+    + [f"- item **{i}**\n" for i in range(200)]
+)
+
+
+def test_open_matches_whole_document():
+    assert spans(make_ctrl(doc, lookahead=8)) == spans(make_ctrl(doc, lookahead=10 ** 9))
+
+
+@pytest.mark.parametrize("position, text", [
+    # open a fence which closes at the long fence, so the rest of the document changes
+    (doc.index("```") - 20, "```\n"),
+    # open a fence at the top, which closes at the long fence
+    (0, "```\n"),
+    # close the long fence early
+    (len(doc) // 2, "```\n"),
+    # ordinary edit
+    (len(doc) - 20, "x"),
+])
+def test_edit_matches_whole_document(position, text):
+    ctrl = make_ctrl(doc, lookahead=8)
+    cursor = gui.QTextCursor(ctrl.document())
+    cursor.setPosition(position)
+    cursor.insertText(text)
+    settle(ctrl)
+    assert spans(ctrl) == spans(make_ctrl(ctrl.toPlainText(), lookahead=10 ** 9))
+
+
+def test_highlighting_timed():
+    timings.spans.pop("highlight", None)
+    timings.spans.pop("highlight_backfill", None)
+    # the document is longer than can be lexed straight away, so the rest is backfilled
+    ctrl = make_ctrl(doc)
+    assert len(timings.spans["highlight_backfill"]) > 0
+    edit(ctrl, len(doc) - 20, "x")
+    assert len(timings.spans["highlight"]) > 0
+
+
+def edit(ctrl, position, text, removed=0):
+    cursor = gui.QTextCursor(ctrl.document())
+    cursor.setPosition(position)
+    cursor.setPosition(position + removed, gui.QTextCursor.KeepAnchor)
+    cursor.insertText(text)
+    settle(ctrl)
+
+
+def test_close_fence_with_blank_line():
+    # the opening fence is before a blank line, so is further back than lexing restarts from
+    ctrl = make_ctrl("intro\n\n```\ncode\n\nmore code\n")
+    edit(ctrl, len(ctrl.toPlainText()), "```\n")
+    assert spans(ctrl) == spans(make_ctrl(ctrl.toPlainText()))
+
+
+# pieces to build documents and edits from, including constructs which span blank lines
+pieces = {
+    'markdown': [
+        "# Head\n", "Title\n===\n", "text *em* **strong**\n", "\n", "\n", "```\n", "```py\n",
+        "- item\n", "> quote\n", "    indented\n", "`code`\n", "[a]: http://a\n",
+    ],
+    'html': [
+        "<p>text</p>\n", "<!--\n", "-->\n", "<script>\n", "</script>\n", "var x = 1;\n",
+        "<style>\n", "</style>\n", "\n", "\n", "<div class=\"a\">\n", "</div>\n",
+    ],
+}
+
+
+@pytest.mark.parametrize("language", list(pieces))
+def test_edits_fuzz(language):
+    rng = random.Random(1)
+    for _ in range(40):
+        ctrl = make_ctrl("".join(rng.choices(pieces[language], k=30)), lookahead=8, language=language)
+        for _ in range(3):
+            content = ctrl.toPlainText()
+            position = rng.randint(0, len(content))
+            removed = rng.randint(0, min(10, len(content) - position))
+            edit(ctrl, position, rng.choice(pieces[language]), removed)
+            assert spans(ctrl) == spans(make_ctrl(ctrl.toPlainText(), language=language))
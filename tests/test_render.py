@@ -0,0 +1,79 @@
+import re
+import random
+import pytest
+import markdown
+import markmoji
+
+from ..app.render import BlockConverter, RenderPool, split_blocks
+from ..app.timing import timings
+
+
+def convert_whole(content_md):
+    # convert the whole document in one go, as the reference output
+    return markdown.markdown(content_md, extensions=["extra", markmoji.Markmoji()])
+
+
+def normalise(content_html):
+    # fragments are joined with newlines, so ignore whitespace between tags
+    return re.sub(r">\s+<", "><", content_html).strip()
+
+
+@pytest.mark.parametrize("content_md", [
+    # footnotes using reference links and abbreviations defined elsewhere
+    "Text[^1].\n\n[^1]: See [the docs].\n\n[the docs]: http://d",
+    "Para[^a] HTML\n\n[^a]: uses HTML here\n\n*[HTML]: Hyper Text",
+    # footnote definition turned into a heading by a setext underline
+    "Text[^1] and[^2].\n\n[^1]: a note\n---\n\n[^2]: other",
+    # footnote definition followed by an unindented heading
+    "More[^1].\n\n[^1]: See this.\n# Head\n",
+    # reference definition turned into a heading by a setext underline
+    "[the docs]: http://d\n===\n\nSee [the docs].",
+    # definitions between parts of the same list or code block
+    "- item\n\n*[HTML]: Hyper\n\n- item HTML",
+    "    code\n    code\n\n[a]: http://a\n    code\n",
+    # definitions after a fence, in the same block as it
+    "See [foo].\n\n```\ncode\n```\n[foo]: http://example.com\n",
+    "Uses HTML.\n\n```\ncode\n```\n*[HTML]: Hyper Text\n",
+    # definitions after a fence which never closes
+    "See [foo] and HTML.\n\n```\ncode\n\n[foo]: http://example.com\n\n*[HTML]: Hyper Text\n",
+    # definitions inside fenced code are just code
+    "See [foo].\n\n```\n[foo]: http://example.com\n```\n",
+    # ordinary document
+    "# Title\n\nSee [a] and[^1] and[^2].\n\n- x\n- y\n\n[^1]: note [a]\n\n[^2]: two\n\n[a]: http://a\n*[Title]: T",
+])
+def test_blocks_match_whole(content_md):
+    assert normalise(BlockConverter().convert(content_md)) == normalise(convert_whole(content_md))
+
+
+def test_ordinary_document_splits():
+    blocks, defs = split_blocks("# Title\n\nSee [a][^1].\n\n[^1]: note [a]\n\n[a]: http://a")
+    assert blocks is not None
+    assert defs['footnote_refs'] == ["1"]
+
+
+def test_blocks_match_whole_fuzz():
+    parts = [
+        "Text[^1].", "More[^2] and [the docs].", "[^1]: See [the docs].", "[^2]: note *[HTML]",
+        "---", "===", "[the docs]: http://d", "*[HTML]: Hyper", "HTML here", "# Head", "- item",
+        "    indented", "plain para", "[^3]: third", "ref[^3]",
+    ]
+    rng = random.Random(1)
+    for i in range(500):
+        content_md = "".join(
+            rng.choice(parts) + rng.choice(["\n", "\n\n"]) for _ in range(rng.randint(1, 7))
+        )
+        assert normalise(BlockConverter().convert(content_md)) == normalise(convert_whole(content_md)), content_md
+
+
+def test_cache_hits_timed_apart():
+    pool = RenderPool()
+    try:
+        timings.spans.pop("convert", None)
+        timings.spans.pop("convert_cached", None)
+        content_md = "# Cached\n\nOnly converted once."
+        first = pool.convert(content_md)
+        assert pool.convert(content_md) == first
+        assert len(timings.spans["convert"]) == 1
+        assert len(timings.spans["convert_cached"]) == 1
+    finally:
+        pool.stop()
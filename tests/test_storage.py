@@ -0,0 +1,60 @@
+import os
+# run without a display unless told otherwise
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import pytest
+import PyQt5.QtWidgets as qt
+
+from ..app.storage import IOThread, Journal, atomic_write, recover, text_delta
+
+
+# app has to outlive the objects made in tests
+app = qt.QApplication.instance() or qt.QApplication([])
+
+
+@pytest.mark.parametrize("old, new", [
+    ("", "abc"),
+    ("abc", ""),
+    ("hello world", "hello there world"),
+    ("aaa", "aaaa"),
+])
+def test_text_delta(old, new):
+    position, removed, added = text_delta(old, new)
+    assert old[:position] + added + old[position + removed:] == new
+
+
+@pytest.mark.parametrize("typed", [
+    "hello\x85world more",
+    "line\u2028separated\u2029paragraphs",
+    "form\x0cfeed\x1cand\x1d\x1e\r\nnewlines\n",
+])
+def test_journal_recovers_line_breaks(tmp_path, typed):
+    ctrl = qt.QTextEdit()
+    io = IOThread()
+    journal = Journal(ctrl, io, folder=tmp_path)
+    journal.start(None, "")
+    # journal each change separately
+    for i in range(1, len(typed) + 1):
+        ctrl.setPlainText(typed[:i])
+        journal.flush()
+    io.wait()
+
+    filename, base, content = recover(journal.path)
+    assert filename is None
+    assert content == ctrl.toPlainText()
+
+
+def test_atomic_write_new_file_mode(tmp_path):
+    atomic_write(tmp_path / "new.md", "text")
+    # same as an ordinary new file, rather than the temporary file's private mode
+    with open(tmp_path / "plain.md", "w"):
+        pass
+    assert (tmp_path / "new.md").stat().st_mode == (tmp_path / "plain.md").stat().st_mode
+
+
+def test_atomic_write_through_symlink(tmp_path):
+    (tmp_path / "target.md").write_text("old")
+    (tmp_path / "link.md").symlink_to(tmp_path / "target.md")
+    atomic_write(tmp_path / "link.md", "new")
+    assert (tmp_path / "link.md").is_symlink()
+    assert (tmp_path / "target.md").read_text() == "new"
@@ -0,0 +1,60 @@
+import os
+# run without a display unless told otherwise
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import random
+import pytest
+import PyQt5.QtWidgets as qt
+
+from ..app.watcher import line_edits, reload_text, plain_text
+
+
+# app has to outlive the controls made in tests
+app = qt.QApplication.instance() or qt.QApplication([])
+
+
+@pytest.fixture
+def ctrl():
+    return qt.QTextEdit()
+
+
+# characters which str.splitlines treats as line breaks but text controls don't
+separators = ["\x0b", "\x0c", "\x1c", "\x1d", "\x1e", "\x85", "\u2028", "\u2029"]
+
+
+def test_split_only_on_newlines():
+    assert line_edits("x\x0cy\nz\n", "x\x0cy\nq\n") == [(4, 6, "q\n")]
+
+
+@pytest.mark.parametrize("old, new", [
+    ("x\x0cy\nz\n", "x\x0cy\nq\n"),
+    ("a\x85b\nc\nd", "a\x85b\nc\ne"),
+    ("a\u2028b\nc\n", "a\u2028b\nd\n"),
+    ("a\u2029b\nc", "a\u2029b\nc\nd"),
+    ("\U0001f600\nb\nc", "\U0001f600\nb\nd"),
+    ("a\xa0b\nc", "a\xa0b\nd"),
+])
+def test_reload_special_characters(ctrl, old, new):
+    ctrl.setPlainText(old)
+    reload_text(ctrl, new)
+    assert ctrl.toPlainText() == plain_text(new)
+
+
+def test_reload_fuzz(ctrl):
+    rng = random.Random(0)
+    alphabet = ["a", "b", "\n", "\n", "\U0001f600"] + separators
+    for i in range(1000):
+        old = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 16)))
+        new = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 16)))
+        ctrl.setPlainText(old)
+        reload_text(ctrl, new)
+        assert ctrl.toPlainText() == plain_text(new), (old, new)
+
+
+def test_reload_keeps_unchanged_lines(ctrl):
+    ctrl.setPlainText("one\x0c\ntwo\nthree\n")
+    changes = []
+    ctrl.document().contentsChange.connect(lambda *args: changes.append(args))
+    assert reload_text(ctrl, "one\x0c\nTWO\nthree\n")
+    ctrl.document().contentsChange.disconnect()
+    assert changes == [(5, 4, 4)]
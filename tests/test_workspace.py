@@ -0,0 +1,85 @@
+import os
+# run without a display unless told otherwise
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import pytest
+import threading
+import PyQt5.QtWidgets as qt
+
+from ..app import workspace
+
+
+# app has to outlive the objects made in tests
+app = qt.QApplication.instance() or qt.QApplication([])
+
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    # keep indexes out of the real data folder
+    monkeypatch.setattr(workspace, "index_folder", tmp_path / "index")
+    folder = tmp_path / "notes"
+    folder.mkdir()
+
+    return workspace.WorkspaceIndex(folder, workers=1)
+
+
+def test_line_text_matches_index(tmp_path):
+    path = tmp_path / "note.md"
+    path.write_text("a\x0cb\nc d\x85e\nlast\n", encoding="utf-8")
+    _, postings = workspace.index_file(path)
+    for term, lines in postings.items():
+        for line in lines:
+            assert term in workspace.terms(workspace.line_text(str(path), line))
+    assert workspace.line_text(str(path), postings["last"][0]) == "last"
+
+
+def refresh(index):
+    index.refresh()
+    index.wait()
+
+
+def test_saved_only_when_terms_change(index):
+    note = index.folder / "note.md"
+    note.write_text("some words\n", encoding="utf-8")
+    refresh(index)
+    assert index.path.is_file()
+    # saving the file again without changing it leaves the saved index alone
+    index.path.unlink()
+    note.write_text("some words\n", encoding="utf-8")
+    os.utime(note, ns=(0, 0))
+    refresh(index)
+    assert not index.path.exists()
+    assert index.search("words")
+    # changing its terms saves the index again
+    note.write_text("other words\n", encoding="utf-8")
+    refresh(index)
+    assert index.path.is_file()
+    # as does removing it
+    index.path.unlink()
+    note.unlink()
+    refresh(index)
+    assert index.path.is_file()
+    assert not index.search("words")
+
+
+def test_refresh_while_indexing(index, monkeypatch):
+    # hold up indexing the first file until a refresh has been asked for
+    started = threading.Event()
+    release = threading.Event()
+    index_file = workspace.index_file
+
+    def slow_index_file(path):
+        started.set()
+        release.wait(10)
+        return index_file(path)
+
+    monkeypatch.setattr(workspace, "index_file", slow_index_file)
+    (index.folder / "first.md").write_text("first\n", encoding="utf-8")
+    index.refresh()
+    started.wait(10)
+    (index.folder / "second.md").write_text("second\n", encoding="utf-8")
+    index.refresh()
+    release.set()
+    index.wait()
+    assert index.search("first")
+    assert index.search("second")